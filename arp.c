@@ -95,6 +95,7 @@
 
 /* Exported */
 int need_arp = 0;	/* We set this if we need to listen to arp traffic */
+int narp_reqs = 0;	/* Number of outstanding and cached arp entries */
 
 /* Imported */
 extern struct network *reverse;
@@ -166,6 +167,8 @@ arp_free(struct arp_req *req)
 	evtimer_del(req->active);
 	evtimer_del(req->discover);
 	free(req);
+
+	narp_reqs--;
 }
 
 static void
@@ -283,7 +286,8 @@ arp_new(struct interface *inter,
 
 	req->active = evtimer_new(libevent_base, arp_timeout, req);
 	req->discover = evtimer_new(libevent_base, arp_discovercb, req);
-			
+	narp_reqs++;
+
 	return (req);
 }
 
@@ -1180,6 +1180,7 @@ template_delay_cb(int fd, short which, void *arg)
 {
 	extern struct pool *pool_pkt;
 	extern struct pool *pool_delay;
+	extern struct stats_network stats_network;
 	struct delay *delay = arg;
 	struct ip_hdr *ip = delay->ip;
 	struct template *tmpl = delay->tmpl;
@@ -1207,8 +1208,10 @@ template_delay_cb(int fd, short which, void *arg)
 		pool_free(pool_pkt, ip);
 	template_free(tmpl);
 
-	if (delay->flags & DELAY_NEEDFREE)
+	if (delay->flags & DELAY_NEEDFREE) {
+		stats_network.delayed--;
 		pool_free(pool_delay, delay);
+	}
 }
 
 static void
@@ -178,6 +178,7 @@ int					honeyd_disable_webserver = 0;
 int					honeyd_ignore_parse_errors = 0;
 int					honeyd_verify_config = 0;
 int					honeyd_webserver_fix_permissions = 0;
+int					honeyd_python_workers = 0;
 const char			*honeyd_webserver_address = "127.0.0.1";
 int					honeyd_webserver_port = 80;
 const char			*honeyd_webserver_root = PATH_HONEYDDATA \
@@ -219,6 +220,7 @@ static struct option honeyd_long_opts[] = {
 	{"webserver-port", required_argument, NULL, 'W'},
 	{"webserver-root", required_argument, NULL, 'X'},
 	{"rrdtool-path", required_argument, NULL, 'Y'},
+	{"python-workers", required_argument, NULL, 'N'},
 	{"disable-webserver", 0, &honeyd_disable_webserver, 1},
 	{"verify-config", 0, &honeyd_verify_config, 1},
 	{"ignore-parse-errors", 0, &honeyd_ignore_parse_errors, 1},
@@ -254,6 +256,7 @@ usage(void)
 	    "  --fix-webserver-permissions Change ownership and permissions.\n"
 	    "  --rrdtool-path=path    Path to rrdtool.\n"
 	    "  --disable-webserver    Disables internal webserver\n"
+	    "  --python-workers=num   Run internal Python services in num processes.\n"
 	    "  --verify-config        Verify configuration file then exit.\n"
 	    "  -V, --version          Print program version and exit.\n"
 	    "  -h, --help             Print this message and exit.\n"
@@ -898,8 +901,10 @@ honeyd_delay_cb(int fd, short which, void *arg)
 		pool_free(pool_pkt, ip);
 	template_free(tmpl);
 
-	if (delay->flags & DELAY_NEEDFREE)
+	if (delay->flags & DELAY_NEEDFREE) {
+		stats_network.delayed--;
 		pool_free(pool_delay, delay);
+	}
 }
 
 /*
@@ -958,6 +963,7 @@ honeyd_delay_packet(struct template *tmpl, const struct interface* iface, struct
 		tv.tv_sec = ms / 1000;
 		tv.tv_usec = (ms % 1000) * 1000;
 		evtimer_add(delay->timeout, &tv);
+		stats_network.delayed++;
 	} else
 		honeyd_delay_callback(-1, EV_TIMEOUT, delay);
 }
@@ -3071,17 +3077,21 @@ honeyd_dispatch(struct template *tmpl, const struct interface* iface, struct ip_
 
 	switch(ip->ip_p) {
 	case IP_PROTO_TCP:
+		stats_network.packets_tcp++;
 		tcp_recv_cb(tmpl, iface, (u_char *)ip, iplen);
 		break;
 	case IP_PROTO_UDP:
+		stats_network.packets_udp++;
 		udp_recv_cb(tmpl, iface, (u_char *)ip, iplen);
 		break;
 	case IP_PROTO_ICMP:
+		stats_network.packets_icmp++;
 		hooks_dispatch(ip->ip_p, HD_INCOMING, &iphdr,
 		    (u_char *)ip, iplen);
 		icmp_recv_cb(tmpl, (u_char *)ip, iplen);
 		break;
 	default:
+		stats_network.packets_other++;
 		hooks_dispatch(ip->ip_p, HD_INCOMING, &iphdr,
 		    (u_char *)ip, iplen);
 		honeyd_log_probe(honeyd_logfp, ip->ip_p, &iphdr, iplen, 0, NULL);
@@ -3509,6 +3519,11 @@ honeyd_sighup(int fd, short what, void *arg)
 {
 	syslog(LOG_NOTICE, "rereading configuration on signal %d", fd);
 
+#ifdef HAVE_PYTHON
+	/* Pick up changed Python modules before they get bound again */
+	pyextend_reload();
+#endif
+
 	template_free_all(TEMPLATE_FREE_REGULAR);
 	router_end();
 	if (config.config != NULL)
@@ -3606,6 +3621,14 @@ main(int argc, char *argv[])
 		case 'X':
 			honeyd_webserver_root = optarg;
 			break;
+		case 'N':
+			if (safe_atoi(optarg, &honeyd_python_workers, "python workers") != 0 ||
+			    honeyd_python_workers < 0) {
+				fprintf(stderr, "Bad number of Python workers: %s\n",
+				    optarg);
+				usage();
+			}
+			break;
 		case 'T':
 			want_unittest = 1;
 			break;
@@ -4031,6 +4054,12 @@ main(int argc, char *argv[])
 	if (servicelog != NULL)
 		honeyd_servicefp = honeyd_logstart(servicelog);
 
+#ifdef HAVE_PYTHON
+	/* Workers inherit the configuration and the dropped privileges */
+	if (honeyd_python_workers > 0)
+		pyextend_workers_start(honeyd_python_workers);
+#endif
+
 	event_base_dispatch(libevent_base);
 
 	syslog(LOG_ERR, "Kqueue does not recognize bpf filedescriptor.");
@@ -71,6 +71,14 @@ struct count;
 struct stats_network {
 	struct count *input_bytes;
 	struct count *output_bytes;
+
+	/* Packets dispatched to virtual hosts by protocol */
+	uint64_t packets_tcp;
+	uint64_t packets_udp;
+	uint64_t packets_icmp;
+	uint64_t packets_other;
+
+	int delayed;		/* packets waiting in the delay queue */
 };
 
 struct spoof {
@@ -64,6 +64,22 @@
 #include "osfp.h"
 #include "log.h"
 
+static void (*log_listener)(int, int, const struct tuple *, int, int, void *);
+static void *log_listener_arg;
+
+/*
+ * Registers a function that is called for every probe and flow event,
+ * even if there is no log file.  Passing NULL removes the listener.
+ */
+
+void
+honeyd_log_listen(void (*cb)(int, int, const struct tuple *, int, int, void *),
+    void *arg)
+{
+	log_listener = cb;
+	log_listener_arg = arg;
+}
+
 static char *
 honeyd_logtuple(const struct tuple *hdr)
 {
@@ -310,6 +326,10 @@ void
 honeyd_log_probe(FILE *fp, int proto, const struct tuple *hdr,
     int size, int flags, const char *comment)
 {
+	if (log_listener != NULL)
+		(*log_listener)(HONEYD_LOG_PROBE, proto, hdr, size, flags,
+		    log_listener_arg);
+
 	if (fp == NULL)
 		return;
 
@@ -327,6 +347,10 @@ honeyd_log_flownew(FILE *fp, int proto, const struct tuple *hdr)
 {
 	char *tuple, *logtime, *protoname;
 
+	if (log_listener != NULL)
+		(*log_listener)(HONEYD_LOG_FLOWNEW, proto, hdr, 0, 0,
+		    log_listener_arg);
+
 	if (fp == NULL)
 		return;
 
@@ -343,6 +367,10 @@ honeyd_log_flowend(FILE *fp, int proto, const struct tuple *hdr)
 {
 	char *tuple, *logtime, *protoname;
 
+	if (log_listener != NULL)
+		(*log_listener)(HONEYD_LOG_FLOWEND, proto, hdr, 0, 0,
+		    log_listener_arg);
+
 	if (fp == NULL)
 		return;
 
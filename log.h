@@ -42,4 +42,12 @@ void honeyd_log_flowend(FILE *, int, const struct tuple *);
 void honeyd_log_service(FILE *, int, const struct tuple *, const char *);
 char *honeyd_logdate(void);
 
+/* Probe and flow events are also passed to a listener if there is one */
+#define HONEYD_LOG_PROBE	0
+#define HONEYD_LOG_FLOWNEW	1
+#define HONEYD_LOG_FLOWEND	2
+
+void honeyd_log_listen(void (*)(int, int, const struct tuple *, int, int,
+	void *), void *);
+
 #endif /* _LOG_ */
@@ -0,0 +1,187 @@
+/*
+ * Copyright (c) 2004 Niels Provos <provos@citi.umich.edu>
+ * All rights reserved.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+ */
+
+/*
+ * Exports the internal counters of Honeyd in the Prometheus text format.
+ * The output is written straight from our data structures into an
+ * evbuffer, so that scraping does not need to create Python objects.
+ */
+
+#include <sys/types.h>
+#include <sys/param.h>
+
+#ifdef HAVE_CONFIG_H
+#include "config.h"
+#endif
+
+#include <sys/queue.h>
+#include <sys/tree.h>
+
+#ifdef HAVE_SYS_TIME_H
+#include <sys/time.h>
+#endif
+
+#include <err.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <syslog.h>
+
+#include <dnet.h>
+#include <event.h>
+
+#include "honeyd.h"
+#include "template.h"
+#include "subsystem.h"
+#include "histogram.h"
+#include "metrics.h"
+#ifdef HAVE_PYTHON
+#include "pyextend.h"
+#endif
+
+void
+metrics_header(struct evbuffer *buf, const char *name, const char *type,
+    const char *help)
+{
+	evbuffer_add_printf(buf, "# HELP %s %s\n# TYPE %s %s\n",
+	    name, help, name, type);
+}
+
+static void
+metrics_rate(struct evbuffer *buf, const char *name, struct count *count)
+{
+	evbuffer_add_printf(buf, "%s{window=\"minute\"} %.3f\n",
+	    name, (double)count_get_minute(count) / 60.0);
+	evbuffer_add_printf(buf, "%s{window=\"hour\"} %.3f\n",
+	    name, (double)count_get_hour(count) / 3600.0);
+	evbuffer_add_printf(buf, "%s{window=\"day\"} %.3f\n",
+	    name, (double)count_get_day(count) / 86400.0);
+}
+
+static int
+metrics_count_tuple(struct tuple *hdr, void *arg)
+{
+	int *num = arg;
+
+	(*num)++;
+
+	return (0);
+}
+
+static int
+metrics_count_template(struct template *tmpl, void *arg)
+{
+	int *num = arg;
+
+	(*num)++;
+
+	return (0);
+}
+
+/*
+ * Appends all metrics to buf.
+ */
+
+void
+metrics_print(struct evbuffer *buf)
+{
+	extern struct stats_network stats_network;
+	extern struct timeval honeyd_uptime;
+	extern struct conlru tcplru;
+	extern struct conlru udplru;
+	extern struct subsystemqueue subsystems;
+	extern int honeyd_nchildren;
+	extern int nfragments, nfragmem;
+	extern int narp_reqs;
+	struct subsystem *sub;
+	struct timeval tv;
+	int ntcp = 0, nudp = 0, ntemplates = 0, nsubsystems = 0;
+
+	tuple_iterate(&tcplru, metrics_count_tuple, &ntcp);
+	tuple_iterate(&udplru, metrics_count_tuple, &nudp);
+	template_iterate(metrics_count_template, &ntemplates);
+	TAILQ_FOREACH(sub, &subsystems, next)
+		nsubsystems++;
+
+	gettimeofday(&tv, NULL);
+	timersub(&tv, &honeyd_uptime, &tv);
+
+	metrics_header(buf, "honeyd_uptime_seconds", "gauge",
+	    "Seconds since Honeyd was started.");
+	evbuffer_add_printf(buf, "honeyd_uptime_seconds %ld\n",
+	    (long)tv.tv_sec);
+
+	metrics_header(buf, "honeyd_input_bytes_per_second", "gauge",
+	    "Average rate of captured bytes.");
+	metrics_rate(buf, "honeyd_input_bytes_per_second",
+	    stats_network.input_bytes);
+	metrics_header(buf, "honeyd_output_bytes_per_second", "gauge",
+	    "Average rate of sent bytes.");
+	metrics_rate(buf, "honeyd_output_bytes_per_second",
+	    stats_network.output_bytes);
+
+	metrics_header(buf, "honeyd_packets_total", "counter",
+	    "Packets dispatched to virtual hosts.");
+	evbuffer_add_printf(buf,
+	    "honeyd_packets_total{proto=\"tcp\"} %llu\n"
+	    "honeyd_packets_total{proto=\"udp\"} %llu\n"
+	    "honeyd_packets_total{proto=\"icmp\"} %llu\n"
+	    "honeyd_packets_total{proto=\"other\"} %llu\n",
+	    (unsigned long long)stats_network.packets_tcp,
+	    (unsigned long long)stats_network.packets_udp,
+	    (unsigned long long)stats_network.packets_icmp,
+	    (unsigned long long)stats_network.packets_other);
+
+	metrics_header(buf, "honeyd_connections", "gauge",
+	    "Active connections.");
+	evbuffer_add_printf(buf,
+	    "honeyd_connections{proto=\"tcp\"} %d\n"
+	    "honeyd_connections{proto=\"udp\"} %d\n", ntcp, nudp);
+
+	metrics_header(buf, "honeyd_delay_queue_packets", "gauge",
+	    "Packets waiting for their simulated network delay.");
+	evbuffer_add_printf(buf, "honeyd_delay_queue_packets %d\n",
+	    stats_network.delayed);
+
+	metrics_header(buf, "honeyd_fragments", "gauge",
+	    "Packets in the fragment reassembly cache.");
+	evbuffer_add_printf(buf, "honeyd_fragments %d\n", nfragments);
+	metrics_header(buf, "honeyd_fragment_bytes", "gauge",
+	    "Memory used by the fragment reassembly cache.");
+	evbuffer_add_printf(buf, "honeyd_fragment_bytes %d\n", nfragmem);
+
+	metrics_header(buf, "honeyd_arp_entries", "gauge",
+	    "Pending ARP requests and cached ARP entries.");
+	evbuffer_add_printf(buf, "honeyd_arp_entries %d\n", narp_reqs);
+
+	metrics_header(buf, "honeyd_templates", "gauge",
+	    "Configured templates, including bound addresses.");
+	evbuffer_add_printf(buf, "honeyd_templates %d\n", ntemplates);
+
+	metrics_header(buf, "honeyd_subsystems", "gauge",
+	    "Configured subsystems.");
+	evbuffer_add_printf(buf, "honeyd_subsystems %d\n", nsubsystems);
+	metrics_header(buf, "honeyd_children", "gauge",
+	    "Running child processes for subsystems and scripts.");
+	evbuffer_add_printf(buf, "honeyd_children %d\n", honeyd_nchildren);
+
+#ifdef HAVE_PYTHON
+	pyextend_metrics(buf);
+#endif
+}
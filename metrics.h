@@ -0,0 +1,31 @@
+/*
+ * Copyright (c) 2004 Niels Provos <provos@citi.umich.edu>
+ * All rights reserved.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+ */
+#ifndef _METRICS_H_
+#define _METRICS_H_
+
+/* Content type of the Prometheus text exposition format */
+#define METRICS_CONTENT_TYPE	"text/plain; version=0.0.4; charset=utf-8"
+
+void metrics_print(struct evbuffer *);
+
+/* Helpers for modules that export their own metrics */
+void metrics_header(struct evbuffer *, const char *, const char *,
+    const char *);
+
+#endif /* _METRICS_H_ */
@@ -45,6 +45,9 @@
 #include <sys/time.h>
 #endif
 #include <sys/tree.h>
+#include <sys/stat.h>
+#include <sys/socket.h>
+#include <sys/wait.h>
 
 #include <err.h>
 #include <errno.h>
@@ -55,11 +58,14 @@
 #include <unistd.h>
 #include <ctype.h>
 #include <syslog.h>
+#include <signal.h>
+#include <fcntl.h>
 #ifdef HAVE_TIME_H
 #include <time.h>
 #endif
 #include <dnet.h>
 #include <pcap.h>
+#include <sha1.h>
 
 #undef timeout_pending
 #undef timeout_initialized
@@ -76,6 +82,8 @@
 #include "osfp.h"
 #include "debug.h"
 #include "util.h"
+#include "fdpass.h"
+#include "metrics.h"
 
 int make_socket(int (*f)(int, const struct sockaddr *, socklen_t), int type,
     char *, uint16_t);
@@ -88,16 +96,36 @@ PyObject *pyextend_dict_local;
 
 /* 
  * Functions that we need to call for this script.
- * This is stateless and shared among connections.
+ * This is stateless and shared among connections.  Each reload of a
+ * script creates a new version; connections keep a reference to the
+ * version that they were started with.
  */
 
-struct pyextend {
-	SPLAY_ENTRY(pyextend) node;
-	char *name;
+struct pymodule {
+	int refcnt;
+	PyObject *pModule;
 	PyObject *pFuncInit;
 	PyObject *pFuncReadData;
 	PyObject *pFuncWriteData;
 	PyObject *pFuncEnd;
+
+	/* Callbacks created for an asyncio handle() coroutine */
+	PyObject *pService;
+
+	int delivery;		/* string or memoryview for readdata */
+	Py_ssize_t readsize;	/* initial size of the receive buffer */
+
+	time_t mtime;		/* of the source file when it was loaded */
+};
+
+/* A script as it is referenced from the configuration */
+
+struct pyextend {
+	SPLAY_ENTRY(pyextend) node;
+	char *name;
+
+	struct pymodule *module;	/* current version */
+	time_t failed_mtime;		/* of the last source that failed */
 };
 
 SPLAY_HEAD(pyetree, pyextend) pyextends;
@@ -111,17 +139,10 @@ pye_compare(struct pyextend *a, struct pyextend *b)
 SPLAY_PROTOTYPE(pyetree, pyextend, node, pye_compare);
 SPLAY_GENERATE(pyetree, pyextend, node, pye_compare);
 
-struct pywrite {
-	TAILQ_ENTRY(pywrite) next;
-
-	u_char *buf;
-	size_t size;
-};
-
 struct pystate {
 	PyObject *state;
 
-	struct pyextend *pye;
+	struct pymodule *module;
 
 	int fd;
 
@@ -130,12 +151,28 @@ struct pystate {
 	
 	int wantwrite;
 
-	TAILQ_HEAD(pywbufs, pywrite) writebuffers;
+	/* Reusable receive buffer, grows up to PYEXTEND_MAX_READ_SIZE */
+	PyObject *readbuf;
+
+	/* Data that could not be written yet; flushed with writev */
+	struct evbuffer *writebuf;
 
 	struct command *cmd;
 	void *con;
+
+	/* Capsule that lets Python refer to us outside of callbacks */
+	PyObject *handle;
+};
+
+/* A timer scheduled from Python */
+struct pytimer {
+	struct event ev;
+	PyObject *callback;
 };
 
+#define PYEXTEND_HANDLE		"honeyd.connection"
+#define PYEXTEND_HANDLE_CLOSED	"honeyd.connection.closed"
+
 static PyObject *pyextend_readselector(PyObject *, PyObject *);
 static PyObject *pyextend_writeselector(PyObject *, PyObject *);
 static PyObject *pyextend_log(PyObject *, PyObject *);
@@ -144,10 +181,16 @@ static PyObject *pyextend_uptime(PyObject *, PyObject *);
 static PyObject *pyextend_interfaces(PyObject *, PyObject *);
 static PyObject *pyextend_stats_network(PyObject *, PyObject *);
 static PyObject *pyextend_status_connections(PyObject *, PyObject *);
+static PyObject *pyextend_snapshot(PyObject *, PyObject *);
+static void pyextend_events_metrics(struct evbuffer *);
+static PyObject *pyextend_query_connections(PyObject *, PyObject *,
+    PyObject *);
 static PyObject *pyextend_config(PyObject *, PyObject *);
 static PyObject *pyextend_config_ips(PyObject *, PyObject *);
 static PyObject *pyextend_delete_template(PyObject *, PyObject *);
 static PyObject *pyextend_delete_connection(PyObject *, PyObject *);
+static PyObject *pyextend_connection(PyObject *, PyObject *);
+static PyObject *pyextend_call_later(PyObject *, PyObject *);
 
 static PyMethodDef HoneydMethods[] = {
     {"read_selector", pyextend_readselector, METH_VARARGS,
@@ -166,30 +209,44 @@ static PyMethodDef HoneydMethods[] = {
      "Returns a dictionary with network statistics."},
     {"status_connections", pyextend_status_connections, METH_VARARGS,
      "Returns a list of active UDP or TCP connections."},
+    {"query_connections", (PyCFunction)(void(*)(void))pyextend_query_connections,
+     METH_VARARGS | METH_KEYWORDS,
+     "Returns one page of the UDP or TCP connections that match a filter."},
     {"config", pyextend_config, METH_VARARGS,
      "Returns an associative array with config information."},
+    {"snapshot", pyextend_snapshot, METH_NOARGS,
+     "Returns counters, rates, templates and connections in one dictionary."},
     {"config_ips", pyextend_config_ips, METH_VARARGS,
      "Returns an array with bound IP addresses."},
     {"delete_template", pyextend_delete_template, METH_VARARGS,
      "Deletes the specified template."},
     {"delete_connection", pyextend_delete_connection, METH_VARARGS,
      "Deletes the specified connection."},
+    {"connection", pyextend_connection, METH_VARARGS,
+     "Returns a handle for the current connection."},
+    {"call_later", pyextend_call_later, METH_VARARGS,
+     "Calls a function after the specified number of seconds."},
     {NULL, NULL, 0, NULL}
 };
 
 static struct pystate *current_state;
 
+static int pyextend_worker_dispatch(struct tuple *, struct pyextend *,
+    const char *, int);
+static int pyextend_worker_log(struct tuple *, const char *);
+static void pyextend_workers_exit(void);
+
 struct pyextend_count {
 	int offset;
 	PyObject *pArgs;
 };
 
-static int
-pyextend_populate_connections(struct tuple *hdr, void *arg)
+static PyObject *
+pyextend_connection_dict(struct tuple *hdr)
 {
-	PyObject *pArgs = arg, *pValue;
 	struct addr src, dst;
-	
+	PyObject *pValue;
+
 	addr_pack(&src, ADDR_TYPE_IP, IP_ADDR_BITS, &hdr->ip_src, IP_ADDR_LEN);
 	addr_pack(&dst, ADDR_TYPE_IP, IP_ADDR_BITS, &hdr->ip_dst, IP_ADDR_LEN);
 
@@ -206,30 +263,48 @@ pyextend_populate_connections(struct tuple *hdr, void *arg)
 		exit(EXIT_FAILURE);
 	}
 
-	/* pValue reference stolen here */
+	return (pValue);
+}
+
+static int
+pyextend_populate_connections(struct tuple *hdr, void *arg)
+{
+	PyObject *pArgs = arg, *pValue;
+
+	pValue = pyextend_connection_dict(hdr);
 	PyList_Append(pArgs, pValue);
+	Py_DECREF(pValue);
 
 	return (0);
 }
 
+static struct conlru *
+pyextend_conlru(const char *proto)
+{
+	extern struct conlru tcplru;
+	extern struct conlru udplru;
+
+	/* Check that we are asking for either UDP or TCP */
+	if (!strcmp(proto, "udp"))
+		return (&udplru);
+	else if (!strcmp(proto, "tcp"))
+		return (&tcplru);
+
+	PyErr_Format(PyExc_ValueError, "unknown protocol \"%s\"", proto);
+	return (NULL);
+}
+
 static PyObject*
 pyextend_status_connections(PyObject *self, PyObject *args)
 {
 	PyObject *pArgs;
 	char *string;
-	extern struct conlru tcplru;
-	extern struct conlru udplru;
 	struct conlru *head;
 
 	if (!PyArg_ParseTuple(args, "s", &string))
 		return NULL;
 
-	/* Check that we are asking for either UDP or TCP */
-	if (!strcmp(string, "udp"))
-		head = &udplru;
-	else if (!strcmp(string, "tcp"))
-		head = &tcplru;
-	else
+	if ((head = pyextend_conlru(string)) == NULL)
 		return NULL;
 
 	pArgs = PyList_New(0);
@@ -240,6 +315,214 @@ pyextend_status_connections(PyObject *self, PyObject *args)
 	return (pArgs);
 }
 
+/*
+ * Filtered and paginated view of the connection table.  Only the
+ * connections on the requested page are converted to Python objects.
+ */
+
+#define PYEXTEND_SORT_NONE	0
+#define PYEXTEND_SORT_SRC	1
+#define PYEXTEND_SORT_DST	2
+#define PYEXTEND_SORT_SPORT	3
+#define PYEXTEND_SORT_DPORT	4
+#define PYEXTEND_SORT_RECEIVED	5
+#define PYEXTEND_SORT_SENT	6
+
+struct pyextend_query {
+	struct addr src;	/* ADDR_TYPE_NONE matches everything */
+	struct addr dst;
+	int port;		/* either source or destination port */
+
+	Py_ssize_t offset;
+	Py_ssize_t limit;
+	Py_ssize_t total;	/* number of matching connections */
+
+	/* Matches are only collected if we have to sort them */
+	struct tuple **matches;
+	size_t nmatches;
+	size_t size;
+
+	PyObject *pList;
+};
+
+static int pyextend_sort_key;
+static int pyextend_sort_desc;
+
+static int
+pyextend_prefix_match(struct addr *net, ip_addr_t ip)
+{
+	struct addr mask;
+	ip_addr_t bits;
+
+	if (net->addr_type == ADDR_TYPE_NONE)
+		return (1);
+
+	addr_btom(net->addr_bits, &mask.addr_ip, IP_ADDR_LEN);
+	bits = mask.addr_ip;
+	return ((ip & bits) == (net->addr_ip & bits));
+}
+
+static int
+pyextend_query_cb(struct tuple *hdr, void *arg)
+{
+	struct pyextend_query *query = arg;
+	struct tuple **matches;
+	PyObject *pValue;
+
+	if (!pyextend_prefix_match(&query->src, hdr->ip_src) ||
+	    !pyextend_prefix_match(&query->dst, hdr->ip_dst))
+		return (0);
+	if (query->port && hdr->sport != query->port &&
+	    hdr->dport != query->port)
+		return (0);
+
+	if (pyextend_sort_key != PYEXTEND_SORT_NONE) {
+		if (query->nmatches == query->size) {
+			query->size = query->size ? query->size * 2 : 1024;
+			matches = realloc(query->matches,
+			    query->size * sizeof(struct tuple *));
+			if (matches == NULL) {
+				syslog(LOG_ERR, "%s: realloc", __func__);
+				exit(EXIT_FAILURE);
+			}
+			query->matches = matches;
+		}
+		query->matches[query->nmatches++] = hdr;
+	} else if (query->total >= query->offset &&
+	    query->total - query->offset < query->limit) {
+		pValue = pyextend_connection_dict(hdr);
+		PyList_Append(query->pList, pValue);
+		Py_DECREF(pValue);
+	}
+
+	query->total++;
+	return (0);
+}
+
+#define PYEXTEND_CMP(a, b)	((a) < (b) ? -1 : (a) > (b))
+
+static int
+pyextend_query_compare(const void *pa, const void *pb)
+{
+	const struct tuple *a = *(struct tuple * const *)pa;
+	const struct tuple *b = *(struct tuple * const *)pb;
+	int res = 0;
+
+	switch (pyextend_sort_key) {
+	case PYEXTEND_SORT_SRC:
+		res = PYEXTEND_CMP(ntohl(a->ip_src), ntohl(b->ip_src));
+		break;
+	case PYEXTEND_SORT_DST:
+		res = PYEXTEND_CMP(ntohl(a->ip_dst), ntohl(b->ip_dst));
+		break;
+	case PYEXTEND_SORT_SPORT:
+		res = PYEXTEND_CMP(a->sport, b->sport);
+		break;
+	case PYEXTEND_SORT_DPORT:
+		res = PYEXTEND_CMP(a->dport, b->dport);
+		break;
+	case PYEXTEND_SORT_RECEIVED:
+		res = PYEXTEND_CMP(a->received, b->received);
+		break;
+	case PYEXTEND_SORT_SENT:
+		res = PYEXTEND_CMP(a->sent, b->sent);
+		break;
+	}
+
+	return (pyextend_sort_desc ? -res : res);
+}
+
+static int
+pyextend_parse_prefix(const char *str, struct addr *addr)
+{
+	if (str == NULL || !strlen(str)) {
+		addr->addr_type = ADDR_TYPE_NONE;
+		return (0);
+	}
+
+	if (addr_pton(str, addr) == -1 || addr->addr_type != ADDR_TYPE_IP) {
+		PyErr_Format(PyExc_ValueError, "bad address \"%s\"", str);
+		return (-1);
+	}
+
+	return (0);
+}
+
+static PyObject*
+pyextend_query_connections(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	static char *kwlist[] = { "proto", "offset", "limit", "src", "dst",
+				  "port", "sort", NULL };
+	static const char *sort_keys[] = { "", "src", "dst", "sport", "dport",
+					   "received", "sent", NULL };
+	struct pyextend_query query;
+	const char *proto, *src = NULL, *dst = NULL, *sort = NULL;
+	struct conlru *head;
+	PyObject *pValue;
+	size_t i;
+
+	memset(&query, 0, sizeof(query));
+	query.limit = 50;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|nnzziz:query_connections",
+		kwlist, &proto, &query.offset, &query.limit, &src, &dst,
+		&query.port, &sort))
+		return (NULL);
+
+	if ((head = pyextend_conlru(proto)) == NULL)
+		return (NULL);
+	if (query.offset < 0 || query.limit < 0) {
+		PyErr_SetString(PyExc_ValueError, "negative offset or limit");
+		return (NULL);
+	}
+	if (pyextend_parse_prefix(src, &query.src) == -1 ||
+	    pyextend_parse_prefix(dst, &query.dst) == -1)
+		return (NULL);
+
+	/* A leading "-" sorts in descending order */
+	pyextend_sort_key = PYEXTEND_SORT_NONE;
+	pyextend_sort_desc = 0;
+	if (sort != NULL) {
+		if (*sort == '-') {
+			pyextend_sort_desc = 1;
+			sort++;
+		}
+		for (i = 0; sort_keys[i] != NULL; i++)
+			if (!strcmp(sort, sort_keys[i]))
+				break;
+		if (sort_keys[i] == NULL) {
+			PyErr_Format(PyExc_ValueError,
+			    "unknown sort key \"%s\"", sort);
+			return (NULL);
+		}
+		pyextend_sort_key = i;
+	}
+
+	if ((query.pList = PyList_New(0)) == NULL)
+		return (NULL);
+
+	tuple_iterate(head, pyextend_query_cb, &query);
+
+	if (pyextend_sort_key != PYEXTEND_SORT_NONE) {
+		qsort(query.matches, query.nmatches, sizeof(struct tuple *),
+		    pyextend_query_compare);
+
+		for (i = query.offset;
+		     i < query.nmatches &&
+		     i - query.offset < (size_t)query.limit;
+		     i++) {
+			pValue = pyextend_connection_dict(query.matches[i]);
+			PyList_Append(query.pList, pValue);
+			Py_DECREF(pValue);
+		}
+		free(query.matches);
+	}
+
+	return (Py_BuildValue("{s:n,s:N}",
+		    "total", query.total,
+		    "connections", query.pList));
+}
+
 /*
  * Returns 1 if the template name corresponds to an IP address
  */
@@ -470,6 +753,95 @@ pyextend_uptime(PyObject *self, PyObject *args)
 	return (Py_BuildValue("i", tv.tv_sec));
 }
 
+static int
+pyextend_count_templates(struct template *tmpl, void *arg)
+{
+	int *num = arg;
+
+	num[0]++;
+	if (pyextend_is_ipaddress(tmpl))
+		num[1]++;
+
+	return (0);
+}
+
+static int
+pyextend_count_tuple(struct tuple *hdr, void *arg)
+{
+	int *num = arg;
+
+	(*num)++;
+
+	return (0);
+}
+
+/*
+ * Returns the state that the administrative interface displays as a
+ * single dictionary, so that machine readable views need only one call.
+ */
+
+static PyObject*
+pyextend_snapshot(PyObject *self, PyObject *args)
+{
+	extern struct conlru tcplru;
+	extern struct conlru udplru;
+	extern struct stats_network stats_network;
+	extern int honeyd_nconnects;
+	extern int honeyd_nchildren;
+	PyObject *pValue, *pConfig, *pInterfaces, *pIps, *pUptime;
+	int templates[2] = { 0, 0 };
+	int ntcp = 0, nudp = 0;
+	struct timeval tv;
+
+	template_iterate(pyextend_count_templates, templates);
+	tuple_iterate(&tcplru, pyextend_count_tuple, &ntcp);
+	tuple_iterate(&udplru, pyextend_count_tuple, &nudp);
+
+	pConfig = pyextend_config(self, NULL);
+	pInterfaces = pyextend_interfaces(self, NULL);
+	pIps = pyextend_config_ips(self, NULL);
+	pUptime = pyextend_uptime(self, NULL);
+
+	gettimeofday(&tv, NULL);
+
+	pValue = Py_BuildValue("{s:d,s:N,s:N,"
+	    "s:{s:i,s:i},"
+	    "s:{s:{s:d,s:d,s:d},s:{s:d,s:d,s:d}},"
+	    "s:{s:i,s:i},"
+	    "s:{s:i,s:i},"
+	    "s:N,s:N}",
+	    "time", tv.tv_sec + tv.tv_usec / 1000000.0,
+	    "uptime", pUptime,
+	    "config", pConfig,
+	    "counters",
+	    "connects", honeyd_nconnects,
+	    "children", honeyd_nchildren,
+	    "network",
+	    "input_bytes",
+	    "minute", (double)count_get_minute(stats_network.input_bytes)/60.0,
+	    "hour", (double)count_get_hour(stats_network.input_bytes)/3600.0,
+	    "day", (double)count_get_day(stats_network.input_bytes)/86400.0,
+	    "output_bytes",
+	    "minute", (double)count_get_minute(stats_network.output_bytes)/60.0,
+	    "hour", (double)count_get_hour(stats_network.output_bytes)/3600.0,
+	    "day", (double)count_get_day(stats_network.output_bytes)/86400.0,
+	    "templates",
+	    "total", templates[0],
+	    "addresses", templates[1],
+	    "connections",
+	    "tcp", ntcp,
+	    "udp", nudp,
+	    "interfaces", pInterfaces,
+	    "config_ips", pIps);
+	if (pValue == NULL) {
+		PyErr_Print();
+		syslog(LOG_ERR, "%s: failed to build argument list", __func__);
+		exit(EXIT_FAILURE);
+	}
+
+	return (pValue);
+}
+
 static PyObject*
 pyextend_delete_template(PyObject *self, PyObject *args)
 {
@@ -544,21 +916,49 @@ pyextend_delete_connection(PyObject *self, PyObject *args)
 	return (Py_BuildValue("i", result));
 }
 
+/*
+ * Returns the connection that a Python call refers to.  That is either
+ * the connection of the callback that we are in or the one identified
+ * by an explicit handle from honeyd.connection().
+ */
+
+static struct pystate *
+pyextend_getstate(PyObject *pHandle)
+{
+	if (pHandle == NULL || pHandle == Py_None) {
+		if (current_state == NULL)
+			PyErr_SetString(PyExc_RuntimeError,
+			    "not called for a connection");
+		return (current_state);
+	}
+
+	/* Fails for handles of connections that have ended */
+	return (PyCapsule_GetPointer(pHandle, PYEXTEND_HANDLE));
+}
+
 static PyObject*
 pyextend_log(PyObject *self, PyObject *args)
 {
 	extern FILE *honeyd_servicefp;
+	PyObject *pHandle = NULL;
+	struct pystate *state;
 	struct tuple *hdr;
 	char *string;
 
-	if (current_state == NULL)
-		return (Py_BuildValue("i", -1));
-	
-	hdr = current_state->con;
-	
-	if(!PyArg_ParseTuple(args, "s:read_selector", &string))
+	if(!PyArg_ParseTuple(args, "s|O:log", &string, &pHandle))
 		return (NULL);
 
+	if ((state = pyextend_getstate(pHandle)) == NULL) {
+		PyErr_Clear();
+		return (Py_BuildValue("i", -1));
+	}
+
+	hdr = state->con;
+
+	/* Worker processes leave the logging to the main process */
+	if (pyextend_worker_log(hdr, string) != -1)
+		return (Py_BuildValue("i", 0));
+
 	honeyd_log_service(honeyd_servicefp,
 	    hdr->type == SOCK_STREAM ? IP_PROTO_TCP : IP_PROTO_UDP,
 	    hdr, string);
@@ -579,149 +979,440 @@ pyextend_raw_log(PyObject *self, PyObject *args)
 	return Py_BuildValue("i", 0);;
 }
 
-static PyObject*
-pyextend_selector(PyObject *args, struct event *ev, const char *name)
+static void
+pyextend_selector(int on, struct event *ev, const char *name)
 {
-	int on = 0;
-
-	if(!PyArg_ParseTuple(args, "i:read_selector", &on))
-		return (NULL);
 	DFPRINTF(1, (stderr, "%s: called selector with %d\n", name, on));
 
 	if (on)
 		event_add(ev, NULL);
 	else
 		event_del(ev);
-
-	return Py_BuildValue("i", 0);;
 }
 
 static PyObject*
 pyextend_readselector(PyObject *self, PyObject *args)
 {
-	if (current_state == NULL)
+	PyObject *pHandle = NULL;
+	struct pystate *state;
+	int on = 0;
+
+	if(!PyArg_ParseTuple(args, "i|O:read_selector", &on, &pHandle))
+		return (NULL);
+
+	if ((state = pyextend_getstate(pHandle)) == NULL)
 		return (NULL);
 
-	return (pyextend_selector(args, &current_state->pread, __func__));
+	pyextend_selector(on, &state->pread, __func__);
+
+	return Py_BuildValue("i", 0);
 }
 
 static PyObject*
 pyextend_writeselector(PyObject *self, PyObject *args)
 {
-	struct pystate *state = current_state;
+	PyObject *pHandle = NULL;
+	struct pystate *state;
+	int on = 0;
 
-	PyObject *pValue;
-	if (state == NULL)
+	if(!PyArg_ParseTuple(args, "i|O:write_selector", &on, &pHandle))
 		return (NULL);
 
-	pValue = pyextend_selector(args, &state->pwrite, __func__);
-	if (pValue == NULL)
+	if ((state = pyextend_getstate(pHandle)) == NULL)
 		return (NULL);
 
+	pyextend_selector(on, &state->pwrite, __func__);
+
 	/* 
 	 * We need to keep track of this, so that in case we have buffered
 	 * data to write, we know if we should schedule the python script.
 	 */
 	state->wantwrite = event_pending(&state->pwrite, EV_WRITE, NULL);
 
-	return (pValue);
+	return Py_BuildValue("i", 0);
 }
 
-static void
-pyextend_cbread(int fd, short what, void *arg)
+static PyObject*
+pyextend_connection(PyObject *self, PyObject *args)
 {
-	static char buf[4096];
-	PyObject *pArgs, *pValue;
-	struct pystate *state = arg;
-	struct pyextend *pye = state->pye;
-	int n;
+	struct pystate *state;
 
-	n = read(fd, buf, sizeof(buf));
+	if (!PyArg_ParseTuple(args, ":connection"))
+		return (NULL);
 
-	if (n <= 0)
-		goto error;
+	if ((state = pyextend_getstate(NULL)) == NULL)
+		return (NULL);
 
-	pArgs = Py_BuildValue("(O,s#)", state->state, buf, n);
-	if (pArgs == NULL) {
-		fprintf(stderr, "Failed to build value\n");
-		goto error;
+	if (state->handle == NULL) {
+		state->handle = PyCapsule_New(state, PYEXTEND_HANDLE, NULL);
+		if (state->handle == NULL)
+			return (NULL);
 	}
 
-	current_state = state;
-	pValue = PyObject_CallObject(pye->pFuncReadData, pArgs);
-	current_state = NULL;
-
-	Py_DECREF(pArgs);
-
-	if (pValue == NULL) {
-		PyErr_Print();
-		goto error;
-	}
-	Py_DECREF(pValue);
+	Py_INCREF(state->handle);
+	return (state->handle);
+}
 
-	return;
+/*
+ * Latency histograms for the calls into Python, one per callback type.
+ * The bucket bounds are in seconds.
+ */
 
- error:
-	pyextend_connection_end(state);
-	return;
-}
+#define PYEXTEND_CALL_INIT	0
+#define PYEXTEND_CALL_READ	1
+#define PYEXTEND_CALL_WRITE	2
+#define PYEXTEND_CALL_END	3
+#define PYEXTEND_CALL_TIMER	4
+#define PYEXTEND_CALL_REQUEST	5
+#define PYEXTEND_CALL_MAX	6
+
+static const double pyextend_bounds[] = {
+	0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+	0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0
+};
+#define PYEXTEND_NBUCKETS	(sizeof(pyextend_bounds) / sizeof(double))
+
+static struct pylatency {
+	const char *name;
+	uint64_t buckets[PYEXTEND_NBUCKETS];
+	uint64_t count;
+	double sum;
+} pyextend_latency[PYEXTEND_CALL_MAX] = {
+	{ "init" }, { "readdata" }, { "writedata" }, { "end" },
+	{ "timer" }, { "request" }
+};
 
-static int
-pyextend_addbuffer(struct pystate *state, u_char *buf, size_t size)
+static PyObject *
+pyextend_call(int which, PyObject *pFunc, PyObject *pArgs)
 {
-	struct pywrite *write;
-
-	if ((write = malloc(sizeof(struct pywrite))) == NULL)
-		return (-1);
+	struct pylatency *lat = &pyextend_latency[which];
+	struct timeval start, end;
+	PyObject *pValue;
+	double elapsed;
+	size_t i;
 
-	if ((write->buf = malloc(size)) == NULL) {
-		free(write);
-		return (-1);
-	}
+	gettimeofday(&start, NULL);
+	pValue = PyObject_CallObject(pFunc, pArgs);
+	gettimeofday(&end, NULL);
 
-	memcpy(write->buf, buf, size);
-	write->size = size;
+	timersub(&end, &start, &end);
+	elapsed = end.tv_sec + end.tv_usec / 1000000.0;
 
-	TAILQ_INSERT_TAIL(&state->writebuffers, write, next);
+	for (i = 0; i < PYEXTEND_NBUCKETS; i++)
+		if (elapsed <= pyextend_bounds[i])
+			lat->buckets[i]++;
+	lat->count++;
+	lat->sum += elapsed;
 
-	return (0);
+	return (pValue);
 }
 
-static void
-pyextend_cbwrite(int fd, short what, void *arg)
-{
-	PyObject *pArgs, *pValue;
+/*
+ * Appends the Python latency histograms to the metrics in buf.  With
+ * --python-workers, only calls made in the main process are counted.
+ */
+
+void
+pyextend_metrics(struct evbuffer *buf)
+{
+	struct pylatency *lat;
+	size_t i;
+	int which;
+
+	pyextend_events_metrics(buf);
+
+	metrics_header(buf, "honeyd_python_callback_seconds", "histogram",
+	    "Time spent in Python callbacks.");
+	for (which = 0; which < PYEXTEND_CALL_MAX; which++) {
+		lat = &pyextend_latency[which];
+		for (i = 0; i < PYEXTEND_NBUCKETS; i++)
+			evbuffer_add_printf(buf,
+			    "honeyd_python_callback_seconds_bucket"
+			    "{callback=\"%s\",le=\"%g\"} %llu\n",
+			    lat->name, pyextend_bounds[i],
+			    (unsigned long long)lat->buckets[i]);
+		evbuffer_add_printf(buf,
+		    "honeyd_python_callback_seconds_bucket"
+		    "{callback=\"%s\",le=\"+Inf\"} %llu\n"
+		    "honeyd_python_callback_seconds_sum"
+		    "{callback=\"%s\"} %.6f\n"
+		    "honeyd_python_callback_seconds_count"
+		    "{callback=\"%s\"} %llu\n",
+		    lat->name, (unsigned long long)lat->count,
+		    lat->name, lat->sum,
+		    lat->name, (unsigned long long)lat->count);
+	}
+}
+
+static void
+pyextend_cbtimer(int fd, short what, void *arg)
+{
+	struct pytimer *timer = arg;
+	PyObject *pValue;
+
+	pValue = pyextend_call(PYEXTEND_CALL_TIMER, timer->callback, NULL);
+	if (pValue == NULL)
+		PyErr_Print();
+	Py_XDECREF(pValue);
+
+	Py_DECREF(timer->callback);
+	free(timer);
+}
+
+static PyObject*
+pyextend_call_later(PyObject *self, PyObject *args)
+{
+	PyObject *pFunc;
+	struct pytimer *timer;
+	struct timeval tv;
+	double delay;
+
+	if (!PyArg_ParseTuple(args, "dO:call_later", &delay, &pFunc))
+		return (NULL);
+
+	if (!PyCallable_Check(pFunc)) {
+		PyErr_SetString(PyExc_TypeError, "callback is not callable");
+		return (NULL);
+	}
+
+	if ((timer = calloc(1, sizeof(struct pytimer))) == NULL)
+		return (PyErr_NoMemory());
+
+	if (delay < 0)
+		delay = 0;
+	tv.tv_sec = (long)delay;
+	tv.tv_usec = (long)((delay - tv.tv_sec) * 1000000);
+
+	Py_INCREF(pFunc);
+	timer->callback = pFunc;
+	evtimer_assign(&timer->ev, libevent_base, pyextend_cbtimer, timer);
+	evtimer_add(&timer->ev, &tv);
+
+	Py_RETURN_NONE;
+}
+
+/*
+ * Returns the receive buffer of a connection.  The buffer is a bytearray
+ * so that memoryviews handed to Python keep it alive.  If a script held
+ * on to a view from a previous read, we can not overwrite the data and
+ * start over with a fresh buffer instead.
+ */
+
+static PyObject *
+pyextend_readbuf(struct pystate *state)
+{
+	PyObject *buf = state->readbuf;
+
+	if (buf != NULL && Py_REFCNT(buf) == 1)
+		return (buf);
+
+	Py_XDECREF(buf);
+	state->readbuf = PyByteArray_FromStringAndSize(NULL,
+	    state->module->readsize);
+	return (state->readbuf);
+}
+
+static void
+pyextend_cbread(int fd, short what, void *arg)
+{
+	PyObject *pArgs, *pValue, *pView = NULL, *pData;
 	struct pystate *state = arg;
-	struct pyextend *pye = state->pye;
-	struct pywrite *writebuf;
-	char *buf;
+	struct pymodule *module = state->module;
+	PyObject *buf;
 	Py_ssize_t size;
+	int n;
+
+	if ((buf = pyextend_readbuf(state)) == NULL) {
+		PyErr_Print();
+		goto error;
+	}
+	size = PyByteArray_GET_SIZE(buf);
+
+	n = read(fd, PyByteArray_AS_STRING(buf), size);
+
+	if (n <= 0)
+		goto error;
+
+	if (module->delivery == PYEXTEND_DELIVER_MEMORYVIEW) {
+		/*
+		 * Zero-copy: the view shares memory with our buffer, so
+		 * the script only gets to read it.
+		 */
+		if ((pView = PyMemoryView_FromObject(buf)) == NULL)
+			goto pyerror;
+		pData = PySequence_GetSlice(pView, 0, n);
+		Py_DECREF(pView);
+		if (pData == NULL)
+			goto pyerror;
+		pView = pData;
+		pData = PyObject_CallMethod(pView, "toreadonly", NULL);
+		Py_DECREF(pView);
+		if (pData == NULL)
+			goto pyerror;
+		pArgs = PyTuple_Pack(2, state->state, pData);
+		Py_DECREF(pData);
+	} else {
+		pArgs = Py_BuildValue("(O,s#)", state->state,
+		    PyByteArray_AS_STRING(buf), (Py_ssize_t)n);
+	}
+	if (pArgs == NULL) {
+		fprintf(stderr, "Failed to build value\n");
+		goto pyerror;
+	}
+
+	current_state = state;
+	pValue = pyextend_call(PYEXTEND_CALL_READ, module->pFuncReadData,
+	    pArgs);
+	current_state = NULL;
+
+	Py_DECREF(pArgs);
+
+	if (pValue == NULL)
+		goto pyerror;
+	Py_DECREF(pValue);
+
+	/*
+	 * The sender filled the whole buffer, so there is probably more
+	 * to come.  Read bigger chunks next time unless a script kept a
+	 * view of the buffer.
+	 */
+	if (n == size && size < PYEXTEND_MAX_READ_SIZE &&
+	    state->readbuf != NULL && Py_REFCNT(state->readbuf) == 1) {
+		if (PyByteArray_Resize(state->readbuf,
+			MIN(size * 2, PYEXTEND_MAX_READ_SIZE)) == -1)
+			PyErr_Clear();
+	}
+
+	return;
+
+ pyerror:
+	PyErr_Print();
+ error:
+	pyextend_connection_end(state);
+	return;
+}
+
+/* Drops the reference that the write queue held on a bytes object */
+
+static void
+pyextend_unref(const void *data, size_t len, void *arg)
+{
+	PyObject *pValue = arg;
+
+	Py_DECREF(pValue);
+}
+
+/*
+ * Appends a single chunk to the write queue.  Large bytes objects are
+ * referenced instead of copied; everything else is copied into the
+ * buffer chains that libevent manages for us.
+ */
+
+static int
+pyextend_queue_chunk(struct evbuffer *buf, PyObject *pValue)
+{
+	Py_buffer view;
+	int res;
+
+	if (PyBytes_Check(pValue)) {
+		Py_ssize_t size = PyBytes_GET_SIZE(pValue);
+
+		if (size < PYEXTEND_COPY_THRESHOLD)
+			return (evbuffer_add(buf,
+				    PyBytes_AS_STRING(pValue), size));
+
+		Py_INCREF(pValue);
+		res = evbuffer_add_reference(buf, PyBytes_AS_STRING(pValue),
+		    size, pyextend_unref, pValue);
+		if (res == -1)
+			Py_DECREF(pValue);
+		return (res);
+	}
+
+	/* bytearray, memoryview and friends may change after we return */
+	if (PyUnicode_Check(pValue) ||
+	    PyObject_GetBuffer(pValue, &view, PyBUF_SIMPLE) == -1) {
+		PyErr_Clear();
+		PyErr_Format(PyExc_TypeError,
+		    "honeyd_writedata must return bytes, not %.100s",
+		    Py_TYPE(pValue)->tp_name);
+		return (-1);
+	}
+	res = evbuffer_add(buf, view.buf, view.len);
+	PyBuffer_Release(&view);
+
+	return (res);
+}
+
+/*
+ * Queues the result of honeyd_writedata.  Scripts may return a single
+ * bytes-like object or an iterable of them; all chunks end up in one
+ * vectored write.
+ */
+
+static int
+pyextend_queue(struct pystate *state, PyObject *pValue)
+{
+	PyObject *pIter, *pItem;
+	int res = 0;
+
+	if (PyBytes_Check(pValue) || PyObject_CheckBuffer(pValue) ||
+	    PyUnicode_Check(pValue))
+		return (pyextend_queue_chunk(state->writebuf, pValue));
+
+	if ((pIter = PyObject_GetIter(pValue)) == NULL)
+		return (-1);
+
+	while ((pItem = PyIter_Next(pIter)) != NULL) {
+		res = pyextend_queue_chunk(state->writebuf, pItem);
+		Py_DECREF(pItem);
+		if (res == -1)
+			break;
+	}
+	Py_DECREF(pIter);
+
+	if (PyErr_Occurred())
+		res = -1;
+
+	return (res);
+}
+
+/* Writes as much of the queue as the socket takes; -1 on error */
+
+static int
+pyextend_flush(struct pystate *state, int fd)
+{
+	int res;
+
+	if (evbuffer_get_length(state->writebuf) == 0)
+		return (0);
+
+	res = evbuffer_write(state->writebuf, fd);
+	if (res == -1 && (errno == EAGAIN || errno == EINTR))
+		return (0);
+
+	return (res <= 0 ? -1 : 0);
+}
+
+static void
+pyextend_cbwrite(int fd, short what, void *arg)
+{
+	PyObject *pArgs, *pValue;
+	struct pystate *state = arg;
+	struct pymodule *module = state->module;
 	int res;
 
 	/* If we still have buffered data from before, we are going
 	 * to send it now and reschedule us if necessary.
 	 */
-	if ((writebuf = TAILQ_FIRST(&state->writebuffers)) != NULL) {
-		res = write(fd, writebuf->buf, writebuf->size);
-		if (res <= 0)
+	if (evbuffer_get_length(state->writebuf)) {
+		if (pyextend_flush(state, fd) == -1)
 			goto error;
-		if (res < writebuf->size) {
-			writebuf->size -= res;
-			memmove(writebuf->buf, writebuf->buf + res,
-			    writebuf->size);
+		if (state->wantwrite || evbuffer_get_length(state->writebuf))
 			event_add(&state->pwrite, NULL);
-		} else {
-			TAILQ_REMOVE(&state->writebuffers, writebuf, next);
-			free(writebuf->buf);
-			free(writebuf);
-			if (state->wantwrite ||
-			    TAILQ_FIRST(&state->writebuffers) != NULL)
-				event_add(&state->pwrite, NULL);
-		}
 
 		return;
 	}
-	
 
 	pArgs = Py_BuildValue("(O)", state->state);
 	if (pArgs == NULL) {
@@ -730,7 +1421,8 @@ pyextend_cbwrite(int fd, short what, void *arg)
 	}
 
 	current_state = state;
-	pValue = PyObject_CallObject(pye->pFuncWriteData, pArgs);
+	pValue = pyextend_call(PYEXTEND_CALL_WRITE, module->pFuncWriteData,
+	    pArgs);
 	current_state = NULL;
 
 	Py_DECREF(pArgs);
@@ -749,27 +1441,19 @@ pyextend_cbwrite(int fd, short what, void *arg)
 		goto error;
 	}
 
-	res = PyBytes_AsStringAndSize(pValue, &buf, &size);
+	res = pyextend_queue(state, pValue);
+	Py_DECREF(pValue);
 
 	if (res == -1) {
-		Py_DECREF(pValue);
+		PyErr_Print();
 		goto error;
 	}
 
-	/* XXX - What to do about left over data */
-	res = write(fd, buf, size);
-
-	if (res <= 0) {
-		Py_DECREF(pValue);
+	if (pyextend_flush(state, fd) == -1)
 		goto error;
-	}
 
-	if (res != size) {
-		pyextend_addbuffer(state, buf + res, size - res);
+	if (evbuffer_get_length(state->writebuf))
 		event_add(&state->pwrite, NULL);
-	}
-
-	Py_DECREF(pValue);
 		
 	return;
 
@@ -821,6 +1505,10 @@ pyextend_init(void)
 	pModule = PyModule_Create(&honeyd_module);
 	PyModule_AddIntConstant(pModule, "EVENT_ON", 1);
 	PyModule_AddIntConstant(pModule, "EVENT_OFF", 0);
+	PyModule_AddIntConstant(pModule, "DELIVER_STRING",
+	    PYEXTEND_DELIVER_STRING);
+	PyModule_AddIntConstant(pModule, "DELIVER_MEMORYVIEW",
+	    PYEXTEND_DELIVER_MEMORYVIEW);
 	PyModule_AddStringConstant(pModule, "version", VERSION);
 
 	/* Add the honeyd module to sys.modules so it can be imported */
@@ -833,55 +1521,89 @@ pyextend_init(void)
 void
 pyextend_exit(void)
 {
+	pyextend_workers_exit();
 	Py_Finalize();
 }
 
-void
-pyextend_run(struct evbuffer *output, char *command)
+/*
+ * Code run from the control interface is compiled once and cached by
+ * the SHA-1 of its text.  The least recently used entries are evicted.
+ */
+
+struct pycode {
+	SPLAY_ENTRY(pycode) node;
+	TAILQ_ENTRY(pycode) next;
+
+	u_char digest[SHA1_DIGESTSIZE];
+	PyObject *compiled_code;
+};
+
+SPLAY_HEAD(pycodetree, pycode) pycodes = SPLAY_INITIALIZER(&pycodes);
+TAILQ_HEAD(pycodeq, pycode) pycodes_lru = TAILQ_HEAD_INITIALIZER(pycodes_lru);
+static int pycodes_num;
+
+static int
+pycode_compare(struct pycode *a, struct pycode *b)
 {
-	PyObject *res = NULL, *compiled_code;
-	char *data;
-	Py_ssize_t datlen;
+	return (memcmp(a->digest, b->digest, sizeof(a->digest)));
+}
 
-	const char *preamble = "import StringIO\n"
-	    "import sys\n"
-	    "myout = StringIO.StringIO()\n"
-	    "myerr = StringIO.StringIO()\n"
-	    "saveout = sys.stdout\n"
-	    "saveerr = sys.stderr\n"
-	    "try:\n"
-	    "  sys.stdout = myout\n"
-	    "  sys.stderr = myerr\n"
-	    "  try:\n"
-	    "    %s\n"
-	    "  except:\n"
-	    "    import traceback\n"
-	    "    traceback.print_exc()\n"
-	    "finally:\n"
-	    "  sys.stdout = saveerr\n"
-	    "  sys.stderr = saveerr\n"
-	    "output = \"%%s%%s\" %% (myout.getvalue(), myerr.getvalue())";
-
-	char *code = NULL;
-
-	if (asprintf(&code, preamble, command) == -1)
-	{
-		syslog(LOG_ERR, "%s: asprintf", __func__);
+SPLAY_PROTOTYPE(pycodetree, pycode, node, pycode_compare);
+SPLAY_GENERATE(pycodetree, pycode, node, pycode_compare);
+
+static PyObject *
+pyextend_compile(const char *command)
+{
+	struct pycode *code, tmp;
+	SHA1_CTX ctx;
+
+	SHA1Init(&ctx);
+	SHA1Update(&ctx, (const u_char *)command, strlen(command));
+	SHA1Final(tmp.digest, &ctx);
+
+	if ((code = SPLAY_FIND(pycodetree, &pycodes, &tmp)) != NULL) {
+		TAILQ_REMOVE(&pycodes_lru, code, next);
+		TAILQ_INSERT_HEAD(&pycodes_lru, code, next);
+		return (code->compiled_code);
+	}
+
+	if ((code = calloc(1, sizeof(struct pycode))) == NULL) {
+		syslog(LOG_ERR, "%s: calloc", __func__);
 		exit(EXIT_FAILURE);
 	}
 
-	compiled_code = Py_CompileStringFlags(code, "<filter>",
-	    Py_file_input, 0);
+	code->compiled_code = Py_CompileString(command, "<honeydctl>",
+	    Py_file_input);
+	if (code->compiled_code == NULL) {
+		free(code);
+		return (NULL);
+	}
+	memcpy(code->digest, tmp.digest, sizeof(code->digest));
 
-	free(code);
-	
-	if (compiled_code == NULL) {
-		const char *err = "Compilation of Python code failed.\n";
-		evbuffer_add(output, err, strlen(err));
-		PyErr_Print();
-		return;
+	SPLAY_INSERT(pycodetree, &pycodes, code);
+	TAILQ_INSERT_HEAD(&pycodes_lru, code, next);
+
+	if (++pycodes_num > PYEXTEND_MAX_CODE) {
+		struct pycode *old = TAILQ_LAST(&pycodes_lru, pycodeq);
+
+		SPLAY_REMOVE(pycodetree, &pycodes, old);
+		TAILQ_REMOVE(&pycodes_lru, old, next);
+		Py_DECREF(old->compiled_code);
+		free(old);
+		pycodes_num--;
 	}
 
+	return (code->compiled_code);
+}
+
+void
+pyextend_run(struct evbuffer *output, char *command)
+{
+	PyObject *res = NULL, *compiled_code;
+	PyObject *pIO, *pOutput, *saveout, *saveerr;
+	const char *data;
+	Py_ssize_t datlen;
+
 	if (pyextend_dict_local == NULL) {
 		pyextend_dict_local = PyDict_New();
 		assert(pyextend_dict_local != NULL);
@@ -910,21 +1632,54 @@ pyextend_run(struct evbuffer *output, char *command)
 		}
 	}
 
-	res = PyEval_EvalCode(compiled_code,
-	    pyextend_dict_global, pyextend_dict_local);
-	Py_DECREF(compiled_code);
+	/* Both stdout and stderr go to the control interface */
+	if ((pIO = PyImport_ImportModule("io")) == NULL) {
+		PyErr_Print();
+		return;
+	}
+	pOutput = PyObject_CallMethod(pIO, "StringIO", NULL);
+	Py_DECREF(pIO);
+	if (pOutput == NULL) {
+		PyErr_Print();
+		return;
+	}
+
+	saveout = PySys_GetObject("stdout"); /* Borrowed */
+	saveerr = PySys_GetObject("stderr"); /* Borrowed */
+	Py_XINCREF(saveout);
+	Py_XINCREF(saveerr);
+	PySys_SetObject("stdout", pOutput);
+	PySys_SetObject("stderr", pOutput);
+
+	if ((compiled_code = pyextend_compile(command)) == NULL) {
+		const char *err = "Compilation of Python code failed.\n";
+		evbuffer_add(output, err, strlen(err));
+		PyErr_Print();
+	} else {
+		res = PyEval_EvalCode(compiled_code,
+		    pyextend_dict_global, pyextend_dict_local);
+		if (res == NULL)
+			PyErr_Print();
+		Py_XDECREF(res);
+	}
+
+	PySys_SetObject("stdout", saveout);
+	PySys_SetObject("stderr", saveerr);
+	Py_XDECREF(saveout);
+	Py_XDECREF(saveerr);
 
+	res = PyObject_CallMethod(pOutput, "getvalue", NULL);
+	Py_DECREF(pOutput);
 	if (res == NULL) {
 		PyErr_Print();
 		return;
 	}
-	Py_DECREF(res);
-
-	res = PyDict_GetItemString(pyextend_dict_local, "output");
-	assert(res != NULL);
 
-	if (PyBytes_AsStringAndSize(res, &data, &datlen) == 0)
+	if ((data = PyUnicode_AsUTF8AndSize(res, &datlen)) != NULL)
 		evbuffer_add(output, data, datlen);
+	else
+		PyErr_Print();
+	Py_DECREF(res);
 }
 
 #define CHECK_FUNC(f, x) do { \
@@ -936,53 +1691,200 @@ pyextend_run(struct evbuffer *output, char *command)
 	} \
 } while (0)
 
-void *
-pyextend_load_module(const char *name)
+/*
+ * Modules may tune how Honeyd talks to them by defining optional
+ * integer attributes.  Returns -1 if the attribute has a bad type.
+ */
+
+static int
+pyextend_module_option(PyObject *pDict, const char *name, long *value)
 {
-	PyObject *pName, *pModule, *pDict, *pFunc;
-	struct pyextend *pye, tmp;
+	PyObject *pValue;
 
-	char line[1024];
-	char *script, *p;
-	
-	if (strlcpy(line, name, sizeof(line)) >= sizeof(line))
-		return (NULL);
-	p = line;
+	pValue = PyDict_GetItemString(pDict, name); /* Borrowed */
+	if (pValue == NULL)
+		return (0);
 
-	script = strsep(&p, " ");
+	*value = PyLong_AsLong(pValue);
+	if (*value == -1 && PyErr_Occurred()) {
+		PyErr_Clear();
+		warnx("%s: \"%s\" needs to be an integer", __func__, name);
+		return (-1);
+	}
 
-	tmp.name = script;
-	if ((pye = SPLAY_FIND(pyetree, &pyextends, &tmp)) != NULL)
-		return (pye);
+	return (0);
+}
 
-	pName = PyUnicode_FromString(script);
-	pModule = PyImport_Import(pName);
-	Py_DECREF(pName);
+/*
+ * Wraps an asyncio handle() coroutine function.  Returns a dictionary
+ * with the classic callbacks or NULL on error.
+ */
 
-	if (pModule == NULL) {
+static PyObject *
+pyextend_async_service(PyObject *pFunc)
+{
+	PyObject *pModule, *pService;
+
+	if ((pModule = PyImport_ImportModule("honeyd_asyncio")) == NULL) {
 		PyErr_Print();
-		warn("%s: could not load python module: %s",
-		    __func__, script);
 		return (NULL);
 	}
 
+	pService = PyObject_CallMethod(pModule, "service", "(O)", pFunc);
+	Py_DECREF(pModule);
+
+	if (pService == NULL || !PyDict_Check(pService)) {
+		if (pService == NULL)
+			PyErr_Print();
+		warnx("%s: could not create asyncio service", __func__);
+		Py_XDECREF(pService);
+		return (NULL);
+	}
+
+	return (pService);
+}
+
+/*
+ * Creates a new version of a script from an imported module.  Steals
+ * the reference to the module.
+ */
+
+static struct pymodule *
+pyextend_module_new(PyObject *pModule)
+{
+	PyObject *pDict, *pFunc, *pService = NULL, *pFile;
+	struct pymodule *module;
+	long delivery = PYEXTEND_DELIVER_STRING;
+	long readsize = PYEXTEND_READ_SIZE;
+	struct stat sb;
+
 	pDict = PyModule_GetDict(pModule); /* Borrowed */
 
+	if (pyextend_module_option(pDict, "honeyd_delivery", &delivery) == -1 ||
+	    pyextend_module_option(pDict, "honeyd_readsize", &readsize) == -1)
+		goto error;
+
+	/*
+	 * Modules without the classic callbacks may provide an asyncio
+	 * handle() coroutine instead.  The callbacks then come from a
+	 * service object that drives the coroutine.
+	 */
+	pFunc = PyDict_GetItemString(pDict, "handle"); /* Borrowed */
+	if (PyDict_GetItemString(pDict, "honeyd_init") == NULL &&
+	    pFunc != NULL && PyCallable_Check(pFunc)) {
+		if ((pService = pyextend_async_service(pFunc)) == NULL)
+			goto error;
+		pDict = pService;
+	}
+
 	CHECK_FUNC(pFunc, "honeyd_init");
 	CHECK_FUNC(pFunc, "honeyd_readdata");
 	CHECK_FUNC(pFunc, "honeyd_writedata");
 	CHECK_FUNC(pFunc, "honeyd_end");
 
-	if ((pye = calloc(1, sizeof(struct pyextend))) == NULL)
-	{
-		syslog(LOG_ERR, "calloc");
+	if (delivery != PYEXTEND_DELIVER_STRING &&
+	    delivery != PYEXTEND_DELIVER_MEMORYVIEW) {
+		warnx("%s: unknown delivery mode %ld", __func__, delivery);
+		goto error;
+	}
+	if (readsize <= 0 || readsize > PYEXTEND_MAX_READ_SIZE) {
+		warnx("%s: read size %ld out of range", __func__, readsize);
+		goto error;
+	}
+
+	if ((module = calloc(1, sizeof(struct pymodule))) == NULL)
+	{
+		syslog(LOG_ERR, "calloc");
+		exit(EXIT_FAILURE);
+	}
+
+	/* A reload replaces the dictionary entries, so we keep our own */
+	module->pFuncInit = PyDict_GetItemString(pDict, "honeyd_init");
+	module->pFuncReadData = PyDict_GetItemString(pDict, "honeyd_readdata");
+	module->pFuncWriteData = PyDict_GetItemString(pDict, "honeyd_writedata");
+	module->pFuncEnd = PyDict_GetItemString(pDict, "honeyd_end");
+	Py_INCREF(module->pFuncInit);
+	Py_INCREF(module->pFuncReadData);
+	Py_INCREF(module->pFuncWriteData);
+	Py_INCREF(module->pFuncEnd);
+
+	module->refcnt = 1;
+	module->pModule = pModule;
+	module->pService = pService;
+	module->delivery = delivery;
+	module->readsize = readsize;
+
+	if ((pFile = PyModule_GetFilenameObject(pModule)) != NULL) {
+		if (stat(PyUnicode_AsUTF8(pFile), &sb) != -1)
+			module->mtime = sb.st_mtime;
+		Py_DECREF(pFile);
+	}
+	PyErr_Clear();
+
+	return (module);
+
+ error:
+	Py_XDECREF(pService);
+	Py_DECREF(pModule);
+	return (NULL);
+}
+
+static void
+pyextend_module_unref(struct pymodule *module)
+{
+	if (--module->refcnt > 0)
+		return;
+
+	Py_DECREF(module->pFuncInit);
+	Py_DECREF(module->pFuncReadData);
+	Py_DECREF(module->pFuncWriteData);
+	Py_DECREF(module->pFuncEnd);
+	Py_XDECREF(module->pService);
+	Py_DECREF(module->pModule);
+	free(module);
+}
+
+void *
+pyextend_load_module(const char *name)
+{
+	PyObject *pName, *pModule;
+	struct pymodule *module;
+	struct pyextend *pye, tmp;
+
+	char line[1024];
+	char *script, *p;
+	
+	if (strlcpy(line, name, sizeof(line)) >= sizeof(line))
+		return (NULL);
+	p = line;
+
+	script = strsep(&p, " ");
+
+	tmp.name = script;
+	if ((pye = SPLAY_FIND(pyetree, &pyextends, &tmp)) != NULL)
+		return (pye);
+
+	pName = PyUnicode_FromString(script);
+	pModule = PyImport_Import(pName);
+	Py_DECREF(pName);
+
+	if (pModule == NULL) {
+		PyErr_Print();
+		warn("%s: could not load python module: %s",
+		    __func__, script);
+		return (NULL);
+	}
+
+	if ((module = pyextend_module_new(pModule)) == NULL)
+		return (NULL);
+
+	if ((pye = calloc(1, sizeof(struct pyextend))) == NULL)
+	{
+		syslog(LOG_ERR, "calloc");
 		exit(EXIT_FAILURE);
 	}
 
-	CHECK_FUNC(pye->pFuncInit, "honeyd_init");
-	CHECK_FUNC(pye->pFuncReadData, "honeyd_readdata");
-	CHECK_FUNC(pye->pFuncWriteData, "honeyd_writedata");
-	CHECK_FUNC(pye->pFuncEnd, "honeyd_end");
+	pye->module = module;
 
 	if ((pye->name = strdup(script)) == NULL)
 	{
@@ -993,14 +1895,132 @@ pyextend_load_module(const char *name)
 	SPLAY_INSERT(pyetree, &pyextends, pye);
 	  
 	return (pye);
+}
 
- error:
-	Py_DECREF(pModule);
-	return (NULL);
+/*
+ * Imports a fresh copy of a module from its source file.  The old
+ * module object is left alone, so that connections that still use it
+ * are not affected.
+ */
+
+static PyObject *
+pyextend_reimport(PyObject *pOld, PyObject *pFile)
+{
+	PyObject *pName, *pUtil, *pSpec = NULL, *pNew = NULL, *pValue;
+	PyObject *pLoader, *pModules = PyImport_GetModuleDict(); /* Borrowed */
+
+	if ((pName = PyModule_GetNameObject(pOld)) == NULL)
+		return (NULL);
+
+	if ((pUtil = PyImport_ImportModule("importlib.util")) == NULL)
+		goto out;
+
+	pSpec = PyObject_CallMethod(pUtil, "spec_from_file_location", "(OO)",
+	    pName, pFile);
+	if (pSpec == NULL || pSpec == Py_None)
+		goto out;
+
+	if ((pNew = PyObject_CallMethod(pUtil, "module_from_spec", "(O)",
+		 pSpec)) == NULL)
+		goto out;
+
+	/* Like a regular import, the module needs to be in sys.modules */
+	PyDict_SetItem(pModules, pName, pNew);
+
+	if ((pLoader = PyObject_GetAttrString(pSpec, "loader")) == NULL)
+		pValue = NULL;
+	else
+		pValue = PyObject_CallMethod(pLoader, "exec_module", "(O)",
+		    pNew);
+	Py_XDECREF(pLoader);
+	if (pValue == NULL) {
+		PyDict_SetItem(pModules, pName, pOld);
+		Py_CLEAR(pNew);
+		goto out;
+	}
+	Py_DECREF(pValue);
+
+ out:
+	Py_XDECREF(pSpec);
+	Py_XDECREF(pUtil);
+	Py_DECREF(pName);
+	return (pNew);
+}
+
+static int pyextend_generation;
+
+/*
+ * Loads new versions of all scripts whose source files have changed.
+ * New connections use the new version, while existing connections
+ * finish with the version they were started with.  Returns the number
+ * of reloaded scripts.
+ */
+
+int
+pyextend_reload(void)
+{
+	struct pyextend *pye;
+	struct pymodule *module;
+	PyObject *pFile, *pModule;
+	struct stat sb;
+	int reloaded = 0;
+
+	SPLAY_FOREACH(pye, pyetree, &pyextends) {
+		if ((pFile = PyModule_GetFilenameObject(pye->module->pModule)) == NULL) {
+			PyErr_Clear();
+			continue;
+		}
+
+		if (stat(PyUnicode_AsUTF8(pFile), &sb) == -1 ||
+		    sb.st_mtime == pye->module->mtime ||
+		    sb.st_mtime == pye->failed_mtime) {
+			Py_DECREF(pFile);
+			continue;
+		}
+
+		/* On failure, the old version is still in sys.modules */
+		pModule = pyextend_reimport(pye->module->pModule, pFile);
+		Py_DECREF(pFile);
+
+		/*
+		 * A rejected module is released by pyextend_module_new,
+		 * except for its entry in sys.modules, which goes back
+		 * to the old version.
+		 */
+		module = NULL;
+		if (pModule != NULL &&
+		    (module = pyextend_module_new(pModule)) == NULL) {
+			if (PyErr_Occurred())
+				PyErr_Print();
+			PyDict_SetItemString(PyImport_GetModuleDict(),
+			    PyModule_GetName(pye->module->pModule),
+			    pye->module->pModule);
+		}
+
+		if (module == NULL) {
+			if (PyErr_Occurred())
+				PyErr_Print();
+			pye->failed_mtime = sb.st_mtime;
+			syslog(LOG_WARNING, "%s: could not reload %s, "
+			    "keeping the old version", __func__, pye->name);
+			continue;
+		}
+
+		pyextend_module_unref(pye->module);
+		pye->module = module;
+		reloaded++;
+
+		syslog(LOG_NOTICE, "Reloaded Python module %s", pye->name);
+	}
+
+	if (reloaded)
+		pyextend_generation++;
+
+	return (reloaded);
 }
 
 static struct pystate *
-pyextend_newstate(struct command *cmd, void *con, struct pyextend *pye)
+pyextend_newstate(struct command *cmd, void *con, struct pymodule *module)
 {
 	struct pystate *state;
 
@@ -1011,9 +2031,14 @@ pyextend_newstate(struct command *cmd, void *con, struct pyextend *pye)
 	state->fd = -1;
 	state->cmd = cmd;
 	state->con = con;
-	state->pye = pye;
+	state->module = module;
+	module->refcnt++;
 
-	TAILQ_INIT(&state->writebuffers);
+	if ((state->writebuf = evbuffer_new()) == NULL) {
+		pyextend_module_unref(module);
+		free(state);
+		return (NULL);
+	}
 
 	return (state);
 }
@@ -1021,12 +2046,14 @@ pyextend_newstate(struct command *cmd, void *con, struct pyextend *pye)
 static void
 pyextend_freestate(struct pystate *state)
 {
-	struct pywrite *writes;
-
-	while ((writes = TAILQ_FIRST(&state->writebuffers)) != NULL) {
-		TAILQ_REMOVE(&state->writebuffers, writes, next);
-		free(writes->buf);
-		free(writes);
+	/* Releases the Python objects that are still queued */
+	evbuffer_free(state->writebuf);
+	Py_XDECREF(state->readbuf);
+
+	/* Python may hold on to the handle; make sure it is not used */
+	if (state->handle != NULL) {
+		PyCapsule_SetName(state->handle, PYEXTEND_HANDLE_CLOSED);
+		Py_DECREF(state->handle);
 	}
 
 	/* Cleanup our state */
@@ -1035,27 +2062,28 @@ pyextend_freestate(struct pystate *state)
 
 	if (state->fd != -1)
 		close(state->fd);
+
+	/* In worker processes, con is our own copy of the tuple */
+	if (state->cmd == NULL)
+		free(state->con);
+
+	/* An old version goes away with its last connection */
+	pyextend_module_unref(state->module);
 	free(state);
 }
 
-int
-pyextend_connection_start(struct tuple *hdr, struct command *cmd,
-    void *con, void *pye_generic)
+/*
+ * Calls honeyd_init for a connection whose descriptor has been set up
+ * already.  Used both in the main process and in worker processes.
+ */
+
+static int
+pyextend_state_start(struct pystate *state, struct tuple *hdr,
+    const char *os_name)
 {
-	struct pyextend *pye = pye_generic;
-	struct pystate *state;
+	struct pymodule *module = state->module;
 	PyObject *pArgs, *pValue;
 	struct addr src, dst;
-	struct ip_hdr ip;
-	char *os_name = NULL;
-
-	if ((state = pyextend_newstate(cmd, con, pye)) == NULL)
-		return (-1);
-
-	if ((state->fd = cmd_python(hdr, cmd, con)) == -1) {
-		free(state);
-		return (-1);
-	}
 
 	/* Set up state with event callbacks */
 	event_assign(&state->pread, libevent_base, state->fd, EV_READ, pyextend_cbread, state);
@@ -1064,10 +2092,6 @@ pyextend_connection_start(struct tuple *hdr, struct command *cmd,
 	addr_pack(&src, ADDR_TYPE_IP, IP_ADDR_BITS, &hdr->ip_src,IP_ADDR_LEN);
 	addr_pack(&dst, ADDR_TYPE_IP, IP_ADDR_BITS, &hdr->ip_dst,IP_ADDR_LEN);
 
-	/* Determine the remote operating system */
-	ip.ip_src = hdr->ip_src;
-	os_name = honeyd_osfp_name(&ip);
-
 	pArgs = PyTuple_New(1);
 	pValue = Py_BuildValue("{sssssisiss}",
 	    "HONEYD_IP_SRC", addr_ntoa(&src),
@@ -1078,7 +2102,7 @@ pyextend_connection_start(struct tuple *hdr, struct command *cmd,
 	if (pValue == NULL) {
 		fprintf(stderr, "Failed to build value\n");
 		Py_DECREF(pArgs);
-		goto error;
+		return (-1);
 	}
 
 	/* Set up the current state for Python */
@@ -1087,7 +2111,7 @@ pyextend_connection_start(struct tuple *hdr, struct command *cmd,
 	/* pValue reference stolen here: */
 	PyTuple_SetItem(pArgs, 0, pValue);
 
-	pValue = PyObject_CallObject(pye->pFuncInit, pArgs);
+	pValue = pyextend_call(PYEXTEND_CALL_INIT, module->pFuncInit, pArgs);
 	Py_DECREF(pArgs);
 
 	/* Take away the current state */
@@ -1095,11 +2119,46 @@ pyextend_connection_start(struct tuple *hdr, struct command *cmd,
 
 	if (pValue == NULL) {
 		PyErr_Print();
-		goto error;
+		return (-1);
 	}
 
 	state->state = pValue;
 
+	return (0);
+}
+
+int
+pyextend_connection_start(struct tuple *hdr, struct command *cmd,
+    void *con, void *pye_generic)
+{
+	struct pyextend *pye = pye_generic;
+	struct pystate *state;
+	struct ip_hdr ip;
+	char *os_name = NULL;
+	int fd;
+
+	if ((fd = cmd_python(hdr, cmd, con)) == -1)
+		return (-1);
+
+	/* Determine the remote operating system */
+	ip.ip_src = hdr->ip_src;
+	os_name = honeyd_osfp_name(&ip);
+
+	/* Let a worker process run the Python callbacks if we can */
+	if (pyextend_worker_dispatch(hdr, pye, os_name, fd) != -1) {
+		close(fd);
+		return (0);
+	}
+
+	if ((state = pyextend_newstate(cmd, con, pye->module)) == NULL) {
+		close(fd);
+		return (-1);
+	}
+	state->fd = fd;
+
+	if (pyextend_state_start(state, hdr, os_name) == -1)
+		goto error;
+
 	/* 
 	 * Registers state with command structure so that we can do
 	 * proper cleanup if things go wrong.
@@ -1116,125 +2175,1195 @@ void
 pyextend_connection_end(struct pystate *state)
 {
 	struct command *cmd = state->cmd;
-	struct pyextend *pye = state->pye;
-	PyObject *pArgs;
+	struct pymodule *module = state->module;
+	PyObject *pArgs, *pValue;
 
 	pArgs = PyTuple_New(1);
 
 	/* state->state reference stolen here: */
 	PyTuple_SetItem(pArgs, 0, state->state);
 
-	PyObject_CallObject(pye->pFuncEnd, pArgs);
+	pValue = pyextend_call(PYEXTEND_CALL_END, module->pFuncEnd, pArgs);
+	if (pValue == NULL)
+		PyErr_Print();
+	Py_XDECREF(pValue);
 	Py_DECREF(pArgs);
 
 	pyextend_freestate(state);
 
-	cmd->state = NULL;
+	/* Connections in worker processes have no command structure */
+	if (cmd != NULL)
+		cmd->state = NULL;
 
 	return;
 }
 
 /*
- * We register our own web server so that we can get some stats reporting
- * via a web browser.
+ * Worker processes.  With --python-workers, Honeyd forks a pool of
+ * processes that run the callbacks of internal Python services.  Each
+ * new connection is handed to one of the workers together with our end
+ * of its socket pair.  The worker runs honeyd_init and friends from its
+ * own event loop and sends service log lines back to us.  Workers do
+ * not share any state, so a slow script only delays the connections
+ * that have been assigned to the same worker.
  */
 
-static PyObject *pWebServer;	/* web server instance */
-static PyObject *pFuncRequest;	/* handle request function */
+struct pyworker {
+	pid_t pid;
+	int fd;			/* -1 once the worker is gone */
+	struct event ev_read;
+};
 
-static int pyserver_fd = -1;
-static struct event ev_accept;
+/* Describes a new connection to a worker */
+struct pyworker_conn {
+	char name[256];		/* name of the Python module */
+	char os_name[128];
+	ip_addr_t ip_src;
+	ip_addr_t ip_dst;
+	uint16_t sport;
+	uint16_t dport;
+	int type;
+	int generation;		/* changes when scripts are reloaded */
+};
 
-void pyextend_request_free(struct pyextend_request *);
+/* A service log line sent back by a worker */
+struct pyworker_log {
+	ip_addr_t ip_src;
+	ip_addr_t ip_dst;
+	uint16_t sport;
+	uint16_t dport;
+	int type;
+	char line[1024];
+};
 
-static void
-pyextend_evb_readcb(struct bufferevent *bev, void *parameter)
+static struct pyworker pyworkers[PYEXTEND_MAX_WORKERS];
+static int pyworkers_num;
+static int pyworkers_next;
+static int pyworker_fd = -1;		/* only set in worker processes */
+
+/* Unlike send_fd(), a failure here must not take down Honeyd */
+
+static int
+pyextend_worker_send(int sock, int fd, void *data, size_t len)
 {
-	struct pyextend_request *req = parameter;
-	PyObject *pArgs, *pValue;
-	char *client_address = addr_ntoa(&req->src);
-	char *buf;
-	Py_ssize_t size;
-	int res;
+#if defined(HAVE_SENDMSG) && defined(HAVE_CONTROL_IN_MSGHDR)
+	char tmp[CMSG_SPACE(sizeof(int))];
+	struct cmsghdr *cmsg;
+	struct msghdr msg;
+	struct iovec vec;
+
+	memset(&msg, 0, sizeof(msg));
+	msg.msg_control = tmp;
+	msg.msg_controllen = sizeof(tmp);
+	cmsg = CMSG_FIRSTHDR(&msg);
+	cmsg->cmsg_len = CMSG_LEN(sizeof(int));
+	cmsg->cmsg_level = SOL_SOCKET;
+	cmsg->cmsg_type = SCM_RIGHTS;
+	memcpy(CMSG_DATA(cmsg), &fd, sizeof(fd));
+
+	vec.iov_base = data;
+	vec.iov_len = len;
+	msg.msg_iov = &vec;
+	msg.msg_iovlen = 1;
+
+	return (sendmsg(sock, &msg, 0) == len ? 0 : -1);
+#else
+	return (-1);
+#endif
+}
 
-	/* Check if we have received the complete request */
-	if (evbuffer_find(bev->input, "\r\n\r\n", 4) == NULL) {
-		/* 
-		 * If we did not receive the complete request and we have
-		 * waited for too long already, then we drop the request.
-		 */
-		if (evbuffer_get_length(bev->input) > PYEXTEND_MAX_REQUEST_SIZE) {
-			syslog(LOG_NOTICE,
-			    "Dropping request from %s with size %d",
-			    client_address, evbuffer_get_length(bev->input));
-			pyextend_request_free(req);
-		}
-		return;
-	}
+static int
+pyextend_worker_dispatch(struct tuple *hdr, struct pyextend *pye,
+    const char *os_name, int fd)
+{
+	struct pyworker_conn msg;
+	int i;
 
-	pArgs = Py_BuildValue("(O,s#,s#)", pWebServer,
-	    EVBUFFER_DATA(bev->input), evbuffer_get_length(bev->input),
-	    client_address, strlen(client_address));
-	if (pArgs == NULL)
-		goto error;
+	if (pyworkers_num == 0)
+		return (-1);
 
-	pValue = PyObject_CallObject(pFuncRequest, pArgs);
-	Py_DECREF(pArgs);
+	memset(&msg, 0, sizeof(msg));
+	strlcpy(msg.name, pye->name, sizeof(msg.name));
+	if (os_name != NULL)
+		strlcpy(msg.os_name, os_name, sizeof(msg.os_name));
+	msg.ip_src = hdr->ip_src;
+	msg.ip_dst = hdr->ip_dst;
+	msg.sport = hdr->sport;
+	msg.dport = hdr->dport;
+	msg.type = hdr->type;
+	msg.generation = pyextend_generation;
+
+	/* Round robin; a busy worker with a full queue is skipped */
+	for (i = 0; i < pyworkers_num; i++) {
+		struct pyworker *worker = &pyworkers[pyworkers_next];
+
+		pyworkers_next = (pyworkers_next + 1) % pyworkers_num;
+		if (worker->fd == -1)
+			continue;
+		if (pyextend_worker_send(worker->fd, fd,
+			&msg, sizeof(msg)) == 0)
+			return (0);
+	}
 
-	if (pValue == NULL)
-		goto error;
+	return (-1);
+}
 
-	res = PyBytes_AsStringAndSize(pValue, &buf, &size);
+static int
+pyextend_worker_log(struct tuple *hdr, const char *line)
+{
+	struct pyworker_log msg;
 
-	if (res == -1) {
-		Py_DECREF(pValue);
-		goto error;
-	}
+	if (pyworker_fd == -1)
+		return (-1);
 
-	/* Write the data to the network stream and be done with it */
-	bufferevent_write(req->evb, buf, size);
+	memset(&msg, 0, sizeof(msg));
+	msg.ip_src = hdr->ip_src;
+	msg.ip_dst = hdr->ip_dst;
+	msg.sport = hdr->sport;
+	msg.dport = hdr->dport;
+	msg.type = hdr->type;
+	strlcpy(msg.line, line, sizeof(msg.line));
 
-	return;
+	if (send(pyworker_fd, &msg, sizeof(msg), 0) != sizeof(msg))
+		syslog(LOG_WARNING, "%s: send: %m", __func__);
 
- error:
-	PyErr_Print();
-	pyextend_request_free(req);
+	return (0);
 }
 
-static void
-pyextend_evb_writecb(struct bufferevent *bev, void *parameter)
-{
-	/* 
-	 * At this point, we have written all of our result data, so
-	 * we just close the connection.
-	 */
-	struct pyextend_request *req = parameter;
-	pyextend_request_free(req);
-}
+/* Main process: receives log lines from a worker */
 
 static void
-pyextend_evb_errcb(struct bufferevent *bev, short what, void *parameter)
+pyextend_worker_readcb(int fd, short what, void *arg)
 {
-	struct pyextend_request *req = parameter;
-	pyextend_request_free(req);
-}
+	extern FILE *honeyd_servicefp;
+	struct pyworker *worker = arg;
+	struct pyworker_log msg;
+	struct tuple hdr;
+	ssize_t n;
 
-/* Frees a request object and closes the connection */
+	n = recv(fd, &msg, sizeof(msg), 0);
+	if (n == -1 && (errno == EAGAIN || errno == EINTR))
+		return;
+	if (n <= 0) {
+		syslog(LOG_ERR, "%s: Python worker %d is gone",
+		    __func__, worker->pid);
+		event_del(&worker->ev_read);
+		close(worker->fd);
+		worker->fd = -1;
+		return;
+	}
+	if (n != sizeof(msg))
+		return;
 
-void
-pyextend_request_free(struct pyextend_request *req)
-{
-	bufferevent_free(req->evb);
-	close(req->fd);
-	free(req);
+	msg.line[sizeof(msg.line) - 1] = '\0';
+
+	memset(&hdr, 0, sizeof(hdr));
+	hdr.ip_src = msg.ip_src;
+	hdr.ip_dst = msg.ip_dst;
+	hdr.sport = msg.sport;
+	hdr.dport = msg.dport;
+	hdr.type = msg.type;
+
+	honeyd_log_service(honeyd_servicefp,
+	    hdr.type == SOCK_STREAM ? IP_PROTO_TCP : IP_PROTO_UDP,
+	    &hdr, msg.line);
 }
 
-/* Creates a request object that can be used for streaming data */
+/* Worker process: receives a new connection from the main process */
 
-static struct pyextend_request *
-pyextend_request_new(int fd, struct addr *src)
+static void
+pyextend_worker_conncb(int fd, short what, void *arg)
 {
-	struct pyextend_request *req = NULL;
+	struct pyworker_conn msg;
+	socklen_t len = sizeof(msg);
+	struct pyextend *pye;
+	struct pystate *state;
+	struct tuple *hdr;
+	int newfd;
+
+	if ((newfd = receive_fd(fd, &msg, &len)) == -1)
+		return;
+
+	if (len != sizeof(msg))
+		goto error;
+	msg.name[sizeof(msg.name) - 1] = '\0';
+	msg.os_name[sizeof(msg.os_name) - 1] = '\0';
+
+	/* The main process has reloaded scripts; so do we */
+	if (msg.generation != pyextend_generation) {
+		pyextend_reload();
+		pyextend_generation = msg.generation;
+	}
+
+	if ((pye = pyextend_load_module(msg.name)) == NULL)
+		goto error;
+
+	if ((hdr = calloc(1, sizeof(struct tuple))) == NULL)
+		goto error;
+	hdr->ip_src = msg.ip_src;
+	hdr->ip_dst = msg.ip_dst;
+	hdr->sport = msg.sport;
+	hdr->dport = msg.dport;
+	hdr->type = msg.type;
+
+	if ((state = pyextend_newstate(NULL, hdr, pye->module)) == NULL) {
+		free(hdr);
+		goto error;
+	}
+	state->fd = newfd;
+
+	if (pyextend_state_start(state, hdr,
+		strlen(msg.os_name) ? msg.os_name : NULL) == -1)
+		pyextend_freestate(state);
+	return;
+
+ error:
+	close(newfd);
+}
+
+static void
+pyextend_worker_main(int fd)
+{
+	extern uid_t honeyd_uid;
+	extern gid_t honeyd_gid;
+	struct event ev_conn;
+	int i;
+
+	PyOS_AfterFork_Child();
+
+	/* Signals are meant for the main process */
+	signal(SIGTERM, SIG_DFL);
+	signal(SIGINT, SIG_DFL);
+	signal(SIGHUP, SIG_DFL);
+	signal(SIGUSR1, SIG_DFL);
+	signal(SIGCHLD, SIG_DFL);
+
+	/* We only talk to the main process */
+	for (i = 0; i < pyworkers_num; i++) {
+		if (pyworkers[i].fd != -1)
+			close(pyworkers[i].fd);
+	}
+	pyworkers_num = 0;
+	pyworker_fd = fd;
+
+	if (geteuid() == 0)
+		cmd_droppriv(honeyd_uid, honeyd_gid);
+
+	/* The old event base is shared with the main process */
+	if ((libevent_base = event_base_new()) == NULL) {
+		syslog(LOG_ERR, "%s: event_base_new", __func__);
+		exit(EXIT_FAILURE);
+	}
+
+	event_assign(&ev_conn, libevent_base, fd, EV_READ | EV_PERSIST,
+	    pyextend_worker_conncb, NULL);
+	event_add(&ev_conn, NULL);
+
+	event_base_dispatch(libevent_base);
+
+	exit(EXIT_SUCCESS);
+}
+
+void
+pyextend_workers_start(int num)
+{
+	extern int honeyd_nchildren;
+	int pair[2];
+	pid_t pid;
+
+	if (num > PYEXTEND_MAX_WORKERS) {
+		syslog(LOG_WARNING, "Limiting Python workers to %d",
+		    PYEXTEND_MAX_WORKERS);
+		num = PYEXTEND_MAX_WORKERS;
+	}
+
+	while (pyworkers_num < num) {
+		struct pyworker *worker = &pyworkers[pyworkers_num];
+
+		if (socketpair(AF_UNIX, SOCK_SEQPACKET, 0, pair) == -1) {
+			syslog(LOG_ERR, "%s: socketpair: %m", __func__);
+			exit(EXIT_FAILURE);
+		}
+
+		/* Do not duplicate buffered output */
+		fflush(NULL);
+
+		if ((pid = fork()) == -1) {
+			syslog(LOG_ERR, "%s: fork: %m", __func__);
+			exit(EXIT_FAILURE);
+		}
+
+		if (pid == 0) {
+			close(pair[0]);
+			pyextend_worker_main(pair[1]);
+			/* NOT REACHED */
+		}
+
+		close(pair[1]);
+		if (fcntl(pair[0], F_SETFD, FD_CLOEXEC) == -1)
+			warn("fcntl(F_SETFD)");
+		if (fcntl(pair[0], F_SETFL, O_NONBLOCK) == -1)
+			warn("fcntl(F_SETFL)");
+
+		worker->pid = pid;
+		worker->fd = pair[0];
+		event_assign(&worker->ev_read, libevent_base, worker->fd,
+		    EV_READ | EV_PERSIST, pyextend_worker_readcb, worker);
+		event_add(&worker->ev_read, NULL);
+
+		pyworkers_num++;
+		honeyd_nchildren++;
+	}
+
+	syslog(LOG_NOTICE, "Started %d Python worker processes",
+	    pyworkers_num);
+}
+
+static void
+pyextend_workers_exit(void)
+{
+	int i;
+
+	for (i = 0; i < pyworkers_num; i++) {
+		if (pyworkers[i].fd == -1)
+			continue;
+		kill(pyworkers[i].pid, SIGTERM);
+	}
+}
+
+/*
+ * We register our own web server so that we can get some stats reporting
+ * via a web browser.
+ */
+
+static PyObject *pWebServer;	/* web server instance */
+static PyObject *pFuncRequest;	/* handle request function */
+
+static int pyserver_fd = -1;
+static struct event ev_accept;
+
+void pyextend_request_free(struct pyextend_request *);
+
+/* Splits off the next line of a header block */
+
+static char *
+pyextend_getline(char **p)
+{
+	char *line;
+	size_t len;
+
+	if ((line = strsep(p, "\n")) == NULL)
+		return (NULL);
+	len = strlen(line);
+	if (len && line[len - 1] == '\r')
+		line[len - 1] = '\0';
+
+	return (line);
+}
+
+static PyObject *
+pyextend_latin1(const char *str)
+{
+	/* Like http.client, we do not trust the encoding of headers */
+	return (PyUnicode_DecodeLatin1(str, strlen(str), NULL));
+}
+
+/*
+ * Parses the request line and headers of a request.  Creates the
+ * dictionary that is passed to Python and determines how the body is
+ * framed.  Returns -1 for malformed requests.
+ */
+
+static int
+pyextend_parse_headers(struct pyextend_request *req, const char *buf,
+    size_t len)
+{
+	PyObject *pRequest = NULL, *pHeaders = NULL, *pHeader;
+	char *data, *p, *line, *method, *uri, *version, *name, *value, *ep;
+	long length = 0;
+	int chunked = 0;
+
+	if ((data = malloc(len + 1)) == NULL)
+		return (-1);
+	memcpy(data, buf, len);
+	data[len] = '\0';
+	p = data;
+
+	/* Request line: METHOD SP URI SP VERSION */
+	line = pyextend_getline(&p);
+	method = strsep(&line, " ");
+	uri = strsep(&line, " ");
+	version = line;
+	if (!strlen(method) || uri == NULL || !strlen(uri) ||
+	    version == NULL || strncmp(version, "HTTP/", 5))
+		goto error;
+
+	if ((pHeaders = PyList_New(0)) == NULL)
+		goto pyerror;
+
+	while ((line = pyextend_getline(&p)) != NULL && strlen(line)) {
+		/* Folded header lines are obsolete; we refuse them */
+		if (*line == ' ' || *line == '\t')
+			goto error;
+
+		name = strsep(&line, ":");
+		if (line == NULL || !strlen(name))
+			goto error;
+		value = line + strspn(line, " \t");
+		ep = value + strlen(value);
+		while (ep > value && (ep[-1] == ' ' || ep[-1] == '\t'))
+			*--ep = '\0';
+
+		if (!strcasecmp(name, "Content-Length")) {
+			length = strtol(value, &ep, 10);
+			if (!strlen(value) || *ep != '\0' || length < 0 ||
+			    length > PYEXTEND_MAX_BODY_SIZE)
+				goto error;
+		} else if (!strcasecmp(name, "Transfer-Encoding")) {
+			/* chunked has to be the last coding */
+			if (ep - value >= 7 && !strcasecmp(ep - 7, "chunked"))
+				chunked = 1;
+		}
+
+		pHeader = Py_BuildValue("(NN)",
+		    pyextend_latin1(name), pyextend_latin1(value));
+		if (pHeader == NULL)
+			goto pyerror;
+		if (PyList_Append(pHeaders, pHeader) == -1) {
+			Py_DECREF(pHeader);
+			goto pyerror;
+		}
+		Py_DECREF(pHeader);
+	}
+
+	pRequest = Py_BuildValue("{s:N,s:N,s:N,s:O}",
+	    "method", pyextend_latin1(method),
+	    "path", pyextend_latin1(uri),
+	    "version", pyextend_latin1(version),
+	    "headers", pHeaders);
+	if (pRequest == NULL)
+		goto pyerror;
+	Py_DECREF(pHeaders);
+	free(data);
+
+	req->parsed = pRequest;
+
+	/* A chunked encoding overrides the content length */
+	if (chunked) {
+		req->state = PYEXTEND_PARSE_CHUNK_SIZE;
+	} else if (length) {
+		req->state = PYEXTEND_PARSE_BODY;
+		req->bodylen = length;
+	} else {
+		req->state = PYEXTEND_PARSE_DONE;
+	}
+
+	return (0);
+
+ pyerror:
+	PyErr_Print();
+ error:
+	Py_XDECREF(pHeaders);
+	free(data);
+	return (-1);
+}
+
+/*
+ * Reads a line of a chunked body.  Returns NULL if we need more data
+ * and sets *error for lines that are too long.
+ */
+
+static char *
+pyextend_parse_line(struct evbuffer *input, int *error)
+{
+	char *line;
+
+	line = evbuffer_readln(input, NULL, EVBUFFER_EOL_CRLF);
+	if (line == NULL && evbuffer_get_length(input) > PYEXTEND_MAX_LINE)
+		*error = 1;
+
+	return (line);
+}
+
+/*
+ * Incrementally parses the next request from the input buffer.  We
+ * remember how much of the header block we have searched already, so
+ * that slowly trickling requests do not get scanned over and over.
+ * Returns 1 when a complete request is available in req->parsed, 0 if
+ * we need more data and -1 if the request is malformed.
+ */
+
+static int
+pyextend_parse(struct pyextend_request *req)
+{
+	struct evbuffer *input = bufferevent_get_input(req->evb);
+	struct evbuffer_ptr ptr;
+	PyObject *pBody;
+	unsigned long size;
+	unsigned char *data;
+	char *line, *ep;
+	int error = 0;
+	size_t len;
+
+	for (;;) {
+		switch (req->state) {
+		case PYEXTEND_PARSE_HEADERS:
+			/* The terminator may straddle the data seen before */
+			len = req->scanned > 3 ? req->scanned - 3 : 0;
+			if (evbuffer_ptr_set(input, &ptr, len,
+				EVBUFFER_PTR_SET) == -1)
+				return (0);
+			ptr = evbuffer_search(input, "\r\n\r\n", 4, &ptr);
+			if (ptr.pos == -1) {
+				req->scanned = evbuffer_get_length(input);
+				if (req->scanned > PYEXTEND_MAX_REQUEST_SIZE)
+					return (-1);
+				return (0);
+			}
+
+			len = ptr.pos + 4;
+			req->scanned = 0;
+			if (len > PYEXTEND_MAX_REQUEST_SIZE ||
+			    pyextend_parse_headers(req,
+				(char *)evbuffer_pullup(input, len), len) == -1)
+				return (-1);
+			evbuffer_drain(input, len);
+			break;
+
+		case PYEXTEND_PARSE_BODY:
+			if (evbuffer_get_length(input) < req->bodylen)
+				return (0);
+			evbuffer_remove_buffer(input, req->body, req->bodylen);
+			req->state = PYEXTEND_PARSE_DONE;
+			break;
+
+		case PYEXTEND_PARSE_CHUNK_SIZE:
+			if ((line = pyextend_parse_line(input, &error)) == NULL)
+				return (error ? -1 : 0);
+			size = strtoul(line, &ep, 16);
+			if (ep == line || (*ep != '\0' && *ep != ';' &&
+				*ep != ' ' && *ep != '\t') ||
+			    size > PYEXTEND_MAX_BODY_SIZE -
+			    evbuffer_get_length(req->body)) {
+				free(line);
+				return (-1);
+			}
+			free(line);
+
+			req->bodylen = size;
+			req->state = size ? PYEXTEND_PARSE_CHUNK_DATA :
+			    PYEXTEND_PARSE_TRAILER;
+			break;
+
+		case PYEXTEND_PARSE_CHUNK_DATA:
+			/* Chunk data is followed by CRLF */
+			if (evbuffer_get_length(input) < req->bodylen + 2)
+				return (0);
+			data = evbuffer_pullup(input, req->bodylen + 2);
+			if (data[req->bodylen] != '\r' ||
+			    data[req->bodylen + 1] != '\n')
+				return (-1);
+			evbuffer_remove_buffer(input, req->body, req->bodylen);
+			evbuffer_drain(input, 2);
+			req->state = PYEXTEND_PARSE_CHUNK_SIZE;
+			break;
+
+		case PYEXTEND_PARSE_TRAILER:
+			/* Trailers are ignored up to the empty line */
+			if ((line = pyextend_parse_line(input, &error)) == NULL)
+				return (error ? -1 : 0);
+			if (!strlen(line))
+				req->state = PYEXTEND_PARSE_DONE;
+			free(line);
+			break;
+
+		case PYEXTEND_PARSE_DONE:
+			len = evbuffer_get_length(req->body);
+			pBody = PyBytes_FromStringAndSize(
+			    (char *)evbuffer_pullup(req->body, len), len);
+			evbuffer_drain(req->body, len);
+			if (pBody == NULL ||
+			    PyDict_SetItemString(req->parsed, "body", pBody) == -1) {
+				Py_XDECREF(pBody);
+				PyErr_Print();
+				return (-1);
+			}
+			Py_DECREF(pBody);
+
+			req->state = PYEXTEND_PARSE_HEADERS;
+			return (1);
+		}
+	}
+}
+
+/*
+ * Returns 1 if the parsed request is a GET or HEAD for what.
+ */
+
+static int
+pyextend_is_path(PyObject *pRequest, const char *what)
+{
+	PyObject *pMethod, *pPath;
+	const char *method, *path;
+	size_t len = strlen(what);
+
+	pMethod = PyDict_GetItemString(pRequest, "method");
+	pPath = PyDict_GetItemString(pRequest, "path");
+	if (pMethod == NULL || pPath == NULL)
+		return (0);
+	if ((method = PyUnicode_AsUTF8(pMethod)) == NULL ||
+	    (path = PyUnicode_AsUTF8(pPath)) == NULL) {
+		PyErr_Clear();
+		return (0);
+	}
+
+	if (strcmp(method, "GET") && strcmp(method, "HEAD"))
+		return (0);
+	return (!strncmp(path, what, len) &&
+	    (path[len] == '\0' || path[len] == '?'));
+}
+
+/*
+ * Answers a request for the metrics without calling into Python.  HTTP/1.1
+ * connections stay open unless the client asked to close them.
+ */
+
+static int
+pyextend_evb_metrics(struct pyextend_request *req, int keepalive)
+{
+	struct evbuffer *output = bufferevent_get_output(req->evb);
+	struct evbuffer *body;
+	PyObject *pValue, *pHeaders, *pHeader;
+	const char *value;
+	Py_ssize_t i;
+	int head;
+
+	pValue = PyDict_GetItemString(req->parsed, "version");
+	value = pValue != NULL ? PyUnicode_AsUTF8(pValue) : NULL;
+	if (value == NULL || strcmp(value, "HTTP/1.1"))
+		keepalive = 0;
+
+	pHeaders = PyDict_GetItemString(req->parsed, "headers");
+	for (i = 0; pHeaders != NULL && i < PyList_Size(pHeaders); i++) {
+		pHeader = PyList_GetItem(pHeaders, i);
+		if (!PyTuple_Check(pHeader) || PyTuple_Size(pHeader) != 2)
+			continue;
+		value = PyUnicode_AsUTF8(PyTuple_GetItem(pHeader, 0));
+		if (value == NULL || strcasecmp(value, "connection"))
+			continue;
+		value = PyUnicode_AsUTF8(PyTuple_GetItem(pHeader, 1));
+		if (value != NULL && !strcasecmp(value, "close"))
+			keepalive = 0;
+	}
+	PyErr_Clear();
+
+	pValue = PyDict_GetItemString(req->parsed, "method");
+	head = !strcmp(PyUnicode_AsUTF8(pValue), "HEAD");
+	Py_CLEAR(req->parsed);
+
+	if ((body = evbuffer_new()) == NULL) {
+		syslog(LOG_ERR, "%s: malloc", __func__);
+		exit(EXIT_FAILURE);
+	}
+	metrics_print(body);
+
+	evbuffer_add_printf(output,
+	    "HTTP/1.1 200 OK\r\n"
+	    "Content-Type: %s\r\n"
+	    "Content-Length: %lu\r\n"
+	    "Cache-Control: no-cache\r\n"
+	    "%s\r\n",
+	    METRICS_CONTENT_TYPE,
+	    (unsigned long)evbuffer_get_length(body),
+	    keepalive ? "" : "Connection: close\r\n");
+	if (!head)
+		evbuffer_add_buffer(output, body);
+	evbuffer_free(body);
+
+	return (keepalive);
+}
+
+/*
+ * Server-sent events.  Clients that request the event stream receive
+ * probes and the start and end of flows as they are logged.  Each event
+ * is formatted once and shared by all clients.  While a client has more
+ * than PYEXTEND_EVENTS_HIGHWAT bytes waiting in its socket buffer, events
+ * are kept in a ring; if the ring overflows, the oldest events are dropped
+ * and the client is told how many it missed.
+ */
+
+struct pyevent {
+	int refcnt;
+	size_t len;
+	char data[1];
+};
+
+static TAILQ_HEAD(pysubscribers, pyextend_request) pyextend_subscribers =
+	TAILQ_HEAD_INITIALIZER(pyextend_subscribers);
+static int pyextend_nsubscribers;
+static uint64_t pyextend_event_id;
+static uint64_t pyextend_events_dropped;	/* for all clients */
+static struct event *pyextend_ping_ev;
+
+static void
+pyevent_unref(struct pyevent *ev)
+{
+	if (--ev->refcnt == 0)
+		free(ev);
+}
+
+static void
+pyextend_events_flush(struct pyextend_request *req)
+{
+	struct evbuffer *output = bufferevent_get_output(req->evb);
+	struct pyevent *ev;
+
+	if (req->dropped &&
+	    evbuffer_get_length(output) < PYEXTEND_EVENTS_HIGHWAT) {
+		evbuffer_add_printf(output,
+		    "event: dropped\ndata: {\"dropped\":%llu}\n\n",
+		    (unsigned long long)req->dropped);
+		req->dropped = 0;
+	}
+
+	while (req->ring_len &&
+	    evbuffer_get_length(output) < PYEXTEND_EVENTS_HIGHWAT) {
+		ev = req->ring[req->ring_start];
+		evbuffer_add(output, ev->data, ev->len);
+		pyevent_unref(ev);
+
+		req->ring_start = (req->ring_start + 1) % PYEXTEND_EVENTS_RING;
+		req->ring_len--;
+	}
+}
+
+static void
+pyextend_events_push(struct pyextend_request *req, struct pyevent *ev)
+{
+	int slot;
+
+	/* Overflowing rings lose their oldest event */
+	if (req->ring_len == PYEXTEND_EVENTS_RING) {
+		pyevent_unref(req->ring[req->ring_start]);
+		req->ring_start = (req->ring_start + 1) % PYEXTEND_EVENTS_RING;
+		req->ring_len--;
+		req->dropped++;
+		pyextend_events_dropped++;
+	}
+
+	slot = (req->ring_start + req->ring_len) % PYEXTEND_EVENTS_RING;
+	ev->refcnt++;
+	req->ring[slot] = ev;
+	req->ring_len++;
+
+	pyextend_events_flush(req);
+}
+
+static void
+pyextend_events_log(int type, int proto, const struct tuple *hdr,
+    int size, int flags, void *arg)
+{
+	static const char *names[] = { "probe", "flownew", "flowend" };
+	struct pyextend_request *req;
+	struct pyevent *ev;
+	struct addr src, dst;
+	char asrc[24], adst[24];
+	struct timeval tv;
+	int sport, dport, len;
+	char buf[512];
+
+	if (TAILQ_EMPTY(&pyextend_subscribers))
+		return;
+
+	/* Report connections from the point of view of the remote side */
+	addr_pack(&src, ADDR_TYPE_IP, IP_ADDR_BITS, &hdr->ip_src, IP_ADDR_LEN);
+	addr_pack(&dst, ADDR_TYPE_IP, IP_ADDR_BITS, &hdr->ip_dst, IP_ADDR_LEN);
+	sport = hdr->sport;
+	dport = hdr->dport;
+	if (hdr->local) {
+		addr_ntop(&dst, asrc, sizeof(asrc));
+		addr_ntop(&src, adst, sizeof(adst));
+		sport = hdr->dport;
+		dport = hdr->sport;
+	} else {
+		addr_ntop(&src, asrc, sizeof(asrc));
+		addr_ntop(&dst, adst, sizeof(adst));
+	}
+
+	gettimeofday(&tv, NULL);
+	len = snprintf(buf, sizeof(buf), "id: %llu\nevent: %s\n"
+	    "data: {\"time\":%ld.%06ld,\"proto\":%d,"
+	    "\"src\":\"%s\",\"sport\":%d,\"dst\":\"%s\",\"dport\":%d,"
+	    "\"size\":%d,\"flags\":%d,\"received\":%u,\"sent\":%u}\n\n",
+	    (unsigned long long)++pyextend_event_id, names[type],
+	    (long)tv.tv_sec, (long)tv.tv_usec, proto,
+	    asrc, sport, adst, dport,
+	    size, flags, hdr->received, hdr->sent);
+	if (len < 0 || len >= sizeof(buf))
+		return;
+
+	if ((ev = malloc(sizeof(struct pyevent) + len)) == NULL) {
+		syslog(LOG_ERR, "%s: malloc", __func__);
+		exit(EXIT_FAILURE);
+	}
+	ev->refcnt = 1;
+	ev->len = len;
+	memcpy(ev->data, buf, len);
+
+	TAILQ_FOREACH(req, &pyextend_subscribers, next)
+		pyextend_events_push(req, ev);
+	pyevent_unref(ev);
+}
+
+/* Comments keep proxies from closing idle event streams */
+
+static void
+pyextend_events_ping(int fd, short what, void *arg)
+{
+	struct pyextend_request *req;
+	struct evbuffer *output;
+
+	TAILQ_FOREACH(req, &pyextend_subscribers, next) {
+		output = bufferevent_get_output(req->evb);
+		if (evbuffer_get_length(output) < PYEXTEND_EVENTS_HIGHWAT)
+			evbuffer_add_printf(output, ": ping\n\n");
+	}
+}
+
+static void
+pyextend_events_metrics(struct evbuffer *buf)
+{
+	metrics_header(buf, "honeyd_events_clients", "gauge",
+	    "Clients of the server-sent event stream.");
+	evbuffer_add_printf(buf, "honeyd_events_clients %d\n",
+	    pyextend_nsubscribers);
+	metrics_header(buf, "honeyd_events_dropped_total", "counter",
+	    "Events dropped because clients were too slow.");
+	evbuffer_add_printf(buf, "honeyd_events_dropped_total %llu\n",
+	    (unsigned long long)pyextend_events_dropped);
+}
+
+/*
+ * Turns the connection into an event stream.  The response has no
+ * length, so the connection is not used for other requests.
+ */
+
+static int
+pyextend_evb_events(struct pyextend_request *req)
+{
+	const char *unavailable = "HTTP/1.1 503 Service Unavailable\r\n"
+	    "Connection: close\r\n"
+	    "Content-Length: 0\r\n\r\n";
+	const char *header = "HTTP/1.1 200 OK\r\n"
+	    "Content-Type: text/event-stream\r\n"
+	    "Cache-Control: no-cache\r\n"
+	    "Connection: close\r\n\r\n";
+	PyObject *pMethod;
+	struct timeval tv;
+
+	pMethod = PyDict_GetItemString(req->parsed, "method");
+	if (!strcmp(PyUnicode_AsUTF8(pMethod), "HEAD")) {
+		Py_CLEAR(req->parsed);
+		bufferevent_write(req->evb, header, strlen(header));
+		return (0);
+	}
+	Py_CLEAR(req->parsed);
+
+	if (pyextend_nsubscribers >= PYEXTEND_EVENTS_MAX_CLIENTS) {
+		bufferevent_write(req->evb, unavailable, strlen(unavailable));
+		return (0);
+	}
+
+	req->ring = calloc(PYEXTEND_EVENTS_RING, sizeof(struct pyevent *));
+	if (req->ring == NULL) {
+		syslog(LOG_ERR, "%s: calloc", __func__);
+		exit(EXIT_FAILURE);
+	}
+	bufferevent_write(req->evb, header, strlen(header));
+
+	if (TAILQ_EMPTY(&pyextend_subscribers)) {
+		honeyd_log_listen(pyextend_events_log, NULL);
+
+		if (pyextend_ping_ev == NULL)
+			pyextend_ping_ev = event_new(libevent_base, -1,
+			    EV_PERSIST, pyextend_events_ping, NULL);
+		timerclear(&tv);
+		tv.tv_sec = PYEXTEND_EVENTS_PING;
+		evtimer_add(pyextend_ping_ev, &tv);
+	}
+	TAILQ_INSERT_TAIL(&pyextend_subscribers, req, next);
+	pyextend_nsubscribers++;
+
+	/* Clients may be idle, but need to read what we send them */
+	timerclear(&tv);
+	tv.tv_sec = PYEXTEND_KEEPALIVE_TIMEOUT;
+	bufferevent_set_timeouts(req->evb, NULL, &tv);
+
+	return (1);
+}
+
+static void
+pyextend_events_unsubscribe(struct pyextend_request *req)
+{
+	if (req->ring == NULL)
+		return;
+
+	TAILQ_REMOVE(&pyextend_subscribers, req, next);
+	pyextend_nsubscribers--;
+	if (TAILQ_EMPTY(&pyextend_subscribers)) {
+		honeyd_log_listen(NULL, NULL);
+		evtimer_del(pyextend_ping_ev);
+	}
+
+	while (req->ring_len) {
+		pyevent_unref(req->ring[req->ring_start]);
+		req->ring_start = (req->ring_start + 1) % PYEXTEND_EVENTS_RING;
+		req->ring_len--;
+	}
+	free(req->ring);
+	req->ring = NULL;
+}
+
+/*
+ * Writes chunks of a streamed response until the output buffer is
+ * full.  Returns 1 if there are more chunks, 0 once the response is
+ * complete and -1 if the iterator failed.  The response has been cut
+ * short then, so the connection is closed.
+ */
+
+static int
+pyextend_evb_stream(struct pyextend_request *req)
+{
+	struct evbuffer *output = bufferevent_get_output(req->evb);
+	PyObject *pChunk;
+	char *buf;
+	Py_ssize_t size;
+
+	while (evbuffer_get_length(output) < PYEXTEND_STREAM_HIGHWAT) {
+		if ((pChunk = PyIter_Next(req->stream)) == NULL) {
+			Py_CLEAR(req->stream);
+			if (PyErr_Occurred())
+				goto error;
+			return (0);
+		}
+
+		if (PyBytes_AsStringAndSize(pChunk, &buf, &size) == -1) {
+			Py_DECREF(pChunk);
+			Py_CLEAR(req->stream);
+			goto error;
+		}
+		evbuffer_add(output, buf, size);
+		Py_DECREF(pChunk);
+	}
+
+	return (1);
+
+ error:
+	PyErr_Print();
+	req->closing = 1;
+	bufferevent_disable(req->evb, EV_READ);
+	return (-1);
+}
+
+/*
+ * Hands one parsed request to the web server and queues the response.
+ * Python returns the response, or a tuple of the response, whether the
+ * connection may be kept open and optionally what follows the response:
+ * a (fd, length) pair for a file or an iterator of bytes that is read
+ * whenever the client has taken what we sent before.  Returns 1 if the
+ * connection may be kept open, 0 if it should be closed after the
+ * response and -1 on error.
+ */
+
+static int
+pyextend_evb_request(struct pyextend_request *req)
+{
+	PyObject *pArgs, *pValue, *pData, *pFile = Py_None;
+	char *client_address = addr_ntoa(&req->src);
+	char *buf;
+	Py_ssize_t size;
+	long long length;
+	int keepalive, fd;
+
+	/* The last request on a connection is told to close it */
+	keepalive = ++req->nrequests < PYEXTEND_MAX_KEEPALIVE;
+
+	if (pyextend_is_path(req->parsed, PYEXTEND_METRICS_PATH))
+		return (pyextend_evb_metrics(req, keepalive));
+	if (pyextend_is_path(req->parsed, PYEXTEND_EVENTS_PATH))
+		return (pyextend_evb_events(req));
+
+	pArgs = Py_BuildValue("(O,O,s#,O)", pWebServer, req->parsed,
+	    client_address, (Py_ssize_t)strlen(client_address),
+	    keepalive ? Py_True : Py_False);
+	Py_CLEAR(req->parsed);
+	if (pArgs == NULL)
+		return (-1);
+
+	pValue = pyextend_call(PYEXTEND_CALL_REQUEST, pFuncRequest, pArgs);
+	Py_DECREF(pArgs);
+
+	if (pValue == NULL)
+		return (-1);
+
+	/* Either the response alone or (response, keep-alive) */
+	if (PyTuple_Check(pValue)) {
+		if (!PyArg_ParseTuple(pValue, "Sp|O", &pData, &keepalive,
+			&pFile)) {
+			Py_DECREF(pValue);
+			return (-1);
+		}
+	} else {
+		pData = pValue;
+		keepalive = 0;
+	}
+
+	if (PyBytes_AsStringAndSize(pData, &buf, &size) == -1) {
+		Py_DECREF(pValue);
+		return (-1);
+	}
+
+	bufferevent_write(req->evb, buf, size);
+
+	/* Pages that are generated while they are sent */
+	if (pFile != Py_None && !PyTuple_Check(pFile)) {
+		req->stream = PyObject_GetIter(pFile);
+		Py_DECREF(pValue);
+		if (req->stream == NULL)
+			return (-1);
+		if (pyextend_evb_stream(req) == -1)
+			return (0);
+		return (keepalive);
+	}
+
+	/* Large files go from the file system to the network directly */
+	if (pFile != Py_None) {
+		if (!PyArg_ParseTuple(pFile, "iL", &fd, &length)) {
+			Py_DECREF(pValue);
+			return (-1);
+		}
+
+		/* The descriptor is ours now and closed by libevent */
+		if (evbuffer_add_file(bufferevent_get_output(req->evb), fd,
+			0, length) == -1) {
+			syslog(LOG_WARNING, "%s: evbuffer_add_file failed",
+			    __func__);
+			close(fd);
+			keepalive = 0;
+		}
+	}
+	Py_DECREF(pValue);
+
+	return (keepalive);
+}
+
+static void
+pyextend_evb_readcb(struct bufferevent *bev, void *parameter)
+{
+	struct pyextend_request *req = parameter;
+	const char *bad_request = "HTTP/1.1 400 Bad Request\r\n"
+	    "Connection: close\r\n"
+	    "Content-Length: 0\r\n\r\n";
+	int res;
+
+	/* Pipelined requests are answered in order */
+	while (!req->closing && req->stream == NULL) {
+		/* Event streams do not take further requests */
+		if (req->ring != NULL) {
+			evbuffer_drain(bufferevent_get_input(bev),
+			    evbuffer_get_length(bufferevent_get_input(bev)));
+			return;
+		}
+
+		if ((res = pyextend_parse(req)) == 0)
+			return;
+
+		if (res == -1) {
+			syslog(LOG_NOTICE, "Dropping bad request from %s",
+			    addr_ntoa(&req->src));
+			bufferevent_write(bev, bad_request,
+			    strlen(bad_request));
+			req->closing = 1;
+			bufferevent_disable(bev, EV_READ);
+			return;
+		}
+
+		if ((res = pyextend_evb_request(req)) == -1)
+			goto error;
+		if (res == 0) {
+			req->closing = 1;
+			bufferevent_disable(bev, EV_READ);
+		}
+	}
+
+	return;
+
+ error:
+	PyErr_Print();
+	pyextend_request_free(req);
+}
+
+static void
+pyextend_evb_writecb(struct bufferevent *bev, void *parameter)
+{
+	/* 
+	 * At this point, we have written all of our result data.  Unless
+	 * the client wants to send more requests, we close the connection.
+	 */
+	struct pyextend_request *req = parameter;
+
+	/* Wait until the last chunk of a streamed response is written */
+	if (req->stream != NULL && pyextend_evb_stream(req) == 1)
+		return;
+	if (evbuffer_get_length(bufferevent_get_output(bev)))
+		return;
+
+	if (req->closing)
+		pyextend_request_free(req);
+	else if (req->ring != NULL)
+		pyextend_events_flush(req);
+	else if (evbuffer_get_length(bufferevent_get_input(bev)))
+		pyextend_evb_readcb(bev, req);	/* waited for the stream */
+}
+
+static void
+pyextend_evb_errcb(struct bufferevent *bev, short what, void *parameter)
+{
+	struct pyextend_request *req = parameter;
+
+	/* A client that is done sending still gets its responses */
+	if ((what & BEV_EVENT_EOF) && req->ring == NULL &&
+	    evbuffer_get_length(bufferevent_get_output(bev))) {
+		req->closing = 1;
+		return;
+	}
+
+	pyextend_request_free(req);
+}
+
+/* Frees a request object and closes the connection */
+
+void
+pyextend_request_free(struct pyextend_request *req)
+{
+	PyObject *pRequest = req->parsed;
+
+	pyextend_events_unsubscribe(req);
+	Py_XDECREF(pRequest);
+	Py_CLEAR(req->stream);
+	evbuffer_free(req->body);
+	bufferevent_free(req->evb);
+	close(req->fd);
+	free(req);
+}
+
+/* Creates a request object that can be used for streaming data */
+
+static struct pyextend_request *
+pyextend_request_new(int fd, struct addr *src)
+{
+	struct pyextend_request *req = NULL;
+	struct timeval tv;
 
 	if ((req = calloc(1, sizeof(struct pyextend_request))) == NULL)
 		return (NULL);
@@ -1242,13 +3371,24 @@ pyextend_request_new(int fd, struct addr *src)
 	req->fd = fd;
 	req->src = *src;
 
+	if ((req->body = evbuffer_new()) == NULL) {
+		free(req);
+		return (NULL);
+	}
+
 	if ((req->evb = bufferevent_socket_new(libevent_base, fd, 0)) == NULL) {
+		evbuffer_free(req->body);
 		free(req);
 		return (NULL);
 	}
 	bufferevent_setcb(req->evb, pyextend_evb_readcb, pyextend_evb_writecb,
 	    pyextend_evb_errcb, req);
 
+	/* Idle keep-alive connections and stalled clients time out */
+	tv.tv_sec = PYEXTEND_KEEPALIVE_TIMEOUT;
+	tv.tv_usec = 0;
+	bufferevent_set_timeouts(req->evb, &tv, &tv);
+
 	/* Highest priority to UI requests */
 	bufferevent_priority_set(req->evb, 0);
 
@@ -40,8 +40,38 @@ struct evbuffer;
 
 void pyextend_init(void);
 void pyextend_exit(void);
+void pyextend_workers_start(int);
 
 #define PYEXTEND_MAX_REQUEST_SIZE	16384
+#define PYEXTEND_MAX_BODY_SIZE		1048576
+#define PYEXTEND_MAX_LINE		1024	/* chunk size and trailer lines */
+#define PYEXTEND_MAX_KEEPALIVE		100	/* requests per connection */
+#define PYEXTEND_KEEPALIVE_TIMEOUT	15	/* idle seconds */
+
+/* Served by Honeyd itself in the Prometheus text format */
+#define PYEXTEND_METRICS_PATH		"/metrics"
+
+/* Server-sent events with new flows and probes */
+#define PYEXTEND_EVENTS_PATH		"/events"
+#define PYEXTEND_EVENTS_RING		256	/* queued events per client */
+#define PYEXTEND_EVENTS_HIGHWAT		16384	/* bytes in the socket buffer */
+#define PYEXTEND_EVENTS_MAX_CLIENTS	16
+#define PYEXTEND_EVENTS_PING		15	/* seconds between comments */
+
+/* Streamed responses are pulled from Python up to this many bytes */
+#define PYEXTEND_STREAM_HIGHWAT		65536
+
+/* How received data is handed to honeyd_readdata */
+#define PYEXTEND_DELIVER_STRING		0
+#define PYEXTEND_DELIVER_MEMORYVIEW	1
+
+#define PYEXTEND_READ_SIZE		4096	/* default receive buffer */
+#define PYEXTEND_MAX_READ_SIZE		262144	/* receive buffer growth cap */
+#define PYEXTEND_COPY_THRESHOLD		512	/* smaller writes are copied */
+
+#define PYEXTEND_MAX_WORKERS		64
+
+#define PYEXTEND_MAX_CODE		128	/* cached honeydctl snippets */
 
 void pyextend_webserver_init(char *address, int port, char *root_dir);
 void pyextend_webserver_exit(void);
@@ -53,13 +83,41 @@ int pyextend_connection_start(struct tuple *, struct command *, void *arg,
 struct pystate;
 void pyextend_connection_end(struct pystate *);
 void *pyextend_load_module(const char *);
+int pyextend_reload(void);
 void pyextend_run(struct evbuffer *output, char *command);
+void pyextend_metrics(struct evbuffer *);
 
 struct evbuffer;
 struct pyextend_request {
+	TAILQ_ENTRY(pyextend_request) next;
+
 	int fd;
 	struct addr src;
 	struct bufferevent *evb;
+
+	int nrequests;		/* served on this connection */
+	int closing;		/* close once the response is written */
+
+	/* Parser state for the current request */
+	int state;
+	size_t scanned;		/* header bytes searched already */
+	size_t bodylen;		/* remaining body or chunk length */
+	struct evbuffer *body;	/* decoded body */
+	void *parsed;		/* dictionary passed to Python */
+	void *stream;		/* iterator of the rest of the response */
+
+	/* Events that wait for a slow client, NULL unless subscribed */
+	struct pyevent **ring;
+	int ring_start;
+	int ring_len;
+	uint64_t dropped;	/* not reported to the client yet */
 };
 
+#define PYEXTEND_PARSE_HEADERS		0
+#define PYEXTEND_PARSE_BODY		1
+#define PYEXTEND_PARSE_CHUNK_SIZE	2
+#define PYEXTEND_PARSE_CHUNK_DATA	3
+#define PYEXTEND_PARSE_TRAILER		4
+#define PYEXTEND_PARSE_DONE		5
+
 #endif /* _PYEXTEND_ */
@@ -16,39 +16,25 @@
 #  Description : Simple broadcast script that does a WPAD nbns query
 # ============================================================================
 
-import sys
-import struct
 import random
+import sys
 
-returnString = ""
-
-# Transaction ID (random)
-returnString += struct.pack('>H', random.randint(0, 65535))
-
-# Flags (name query)
-returnString += struct.pack('>H', 0x0110)
-
-# Questions (1)
-returnString += struct.pack('>H', 1)
-
-# Answer RRs (0)
-returnString += struct.pack('>H', 0)
+sys.path.append("/usr/share/honeyd/scripts/lib/")
+from codec import HEADER, QUESTION, EncodeName, EncodeNetbiosName
 
-# Authority RRs (0)
-returnString += struct.pack('>H', 0)
+# Query for WPAD<00> (Workstation/Redirector)
+name = EncodeName(EncodeNetbiosName(b"WPAD", 0x00))
 
-# Additional RRs (0)
-returnString += struct.pack('>H', 0)
+returnString = bytearray(HEADER.size + len(name) + QUESTION.size)
 
-# Query for WPAD<00> (Workstation/Redirector)
-returnString += struct.pack('>33s', " FHFAEBEECACACACACACACACACACACAAAA")
-returnString += struct.pack('>B', 0)
+# Transaction ID (random), flags (name query), questions (1),
+# answer RRs (0), authority RRs (0) and additional RRs (0)
+HEADER.pack_into(returnString, 0, random.randint(0, 65535), 0x0110, 1, 0, 0, 0)
 
-# Type (NB)
-returnString += struct.pack('>H', 0x0020)
+returnString[HEADER.size:HEADER.size + len(name)] = name
 
-#Class (IN)
-returnString += struct.pack('>H', 1)
+# Type (NB) and class (IN)
+QUESTION.pack_into(returnString, HEADER.size + len(name), 0x0020, 1)
 
-sys.stdout.write(returnString)
+sys.stdout.buffer.write(returnString)
 sys.exit(0)
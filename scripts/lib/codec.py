@@ -0,0 +1,169 @@
+#Packet codecs shared by the responder scripts.
+#
+#	Packets are decoded in a single pass over a memoryview with
+#	precompiled structs, and responses are assembled in a bytearray
+#	with pack_into.  All names and payloads are bytes.
+
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+#DNS and NBNS header: ID, flags and the four section counts
+HEADER = struct.Struct("!HHHHHH")
+#Type and class that follow the name of a question
+QUESTION = struct.Struct("!HH")
+#Type, class, TTL and data length that follow the name of a record
+RECORD = struct.Struct("!HHIH")
+#Transaction ID at the start of a DNS or NBNS packet
+TRANSACTION_ID = struct.Struct("!H")
+
+#NetBIOS session service header: type and length in one word
+SESSION = struct.Struct("!I")
+#SMB header: protocol, command, NT status, flags, flags2, PID high,
+#	signature, reserved, tree ID, PID, user ID and multiplex ID
+SMB_HEADER = struct.Struct("<4sBIBHH8sHHHHH")
+#TDS header: type, status, length, channel, packet number and window
+TDS_HEADER = struct.Struct("!BBHHBB")
+#TDS pre-login option: token, offset and length
+TDS_OPTION = struct.Struct("!BHH")
+
+#Names that are longer than this are not valid
+MAX_LABELS = 128
+
+#Number of encoded names that are kept around
+NAME_CACHE = 4096
+
+#Characters of first level encoded NetBIOS names
+FIRST_LEVEL = bytes(range(0x41, 0x51))
+
+#Translation tables from a byte to the high and low half of its first
+#	level encoding, and back from an encoded character to its half
+ENCODE_HIGH = bytes(0x41 + (c >> 4) for c in range(256))
+ENCODE_LOW = bytes(0x41 + (c & 0xf) for c in range(256))
+DECODE_HIGH = bytes(((c - 0x41) & 0xf) << 4 for c in range(256))
+DECODE_LOW = bytes((c - 0x41) & 0xf for c in range(256))
+
+Header = namedtuple("Header", "id flags qdcount ancount nscount arcount")
+#name is the decoded name with dots, wire the name as in the packet
+Question = namedtuple("Question", "name wire qtype qclass")
+
+class DecodeError(ValueError):
+	pass
+
+#Returns the decoded name at offset and the offset after it
+def DecodeName(view, offset):
+	labels = []
+	end = None
+	try:
+		for _ in range(MAX_LABELS):
+			length = view[offset]
+			if length == 0:
+				offset += 1
+				break
+			if length >= 0xc0:
+				#Compression pointer, the name continues elsewhere
+				if end is None:
+					end = offset + 2
+				offset = (length & 0x3f) << 8 | view[offset + 1]
+				continue
+			offset += 1
+			if offset + length > len(view):
+				raise DecodeError("truncated name")
+			labels.append(bytes(view[offset:offset + length]))
+			offset += length
+		else:
+			raise DecodeError("name too long")
+	except IndexError:
+		raise DecodeError("truncated name")
+	return b".".join(labels), end if end is not None else offset
+
+#Decodes the header and the questions of a DNS or NBNS packet
+#	returns the Header and a list of Questions
+def DecodeQuery(data):
+	view = memoryview(data)
+	try:
+		header = Header._make(HEADER.unpack_from(view))
+		offset = HEADER.size
+		questions = []
+		for _ in range(header.qdcount):
+			start = offset
+			name, offset = DecodeName(view, offset)
+			qtype, qclass = QUESTION.unpack_from(view, offset)
+			questions.append(Question(name, bytes(view[start:offset]),
+				qtype, qclass))
+			offset += QUESTION.size
+	except struct.error:
+		raise DecodeError("truncated packet")
+	return header, questions
+
+#Returns the wire format of a name with dots
+@lru_cache(maxsize=NAME_CACHE)
+def EncodeName(name):
+	wire = bytearray()
+	for label in name.split(b"."):
+		if label:
+			wire.append(len(label))
+			wire += label
+	wire.append(0)
+	return bytes(wire)
+
+#Returns a resource record for a name in wire format
+def Record(wire, rtype, rclass, ttl, rdata):
+	record = bytearray(len(wire) + RECORD.size + len(rdata))
+	record[:len(wire)] = wire
+	RECORD.pack_into(record, len(wire), rtype, rclass, ttl, len(rdata))
+	record[len(wire) + RECORD.size:] = rdata
+	return record
+
+#Returns a message with a header and the given answer records
+def Message(transaction_id, flags, answers):
+	message = bytearray(HEADER.size + sum(map(len, answers)))
+	HEADER.pack_into(message, 0, transaction_id, flags,
+		0, len(answers), 0, 0)
+	offset = HEADER.size
+	for answer in answers:
+		message[offset:offset + len(answer)] = answer
+		offset += len(answer)
+	return message
+
+#Returns a copy of a prepared message with the ID of a query
+def Reply(message, transaction_id):
+	reply = bytearray(message)
+	TRANSACTION_ID.pack_into(reply, 0, transaction_id)
+	return reply
+
+#Returns the first level encoding of a 16 byte NetBIOS name
+#	The name is padded with spaces, or with zeros for the wildcard "*"
+@lru_cache(maxsize=NAME_CACHE)
+def EncodeNetbiosName(name, suffix=0x20):
+	pad = b"\0" if name == b"*" else b" "
+	name = name.upper()[:15].ljust(15, pad) + bytes((suffix,))
+	encoded = bytearray(32)
+	encoded[0::2] = name.translate(ENCODE_HIGH)
+	encoded[1::2] = name.translate(ENCODE_LOW)
+	return bytes(encoded)
+
+#Decodes a first level encoded NetBIOS name
+#	returns all 16 bytes, including padding and suffix
+def DecodeNetbiosName(encoded):
+	encoded = bytes(encoded[:len(encoded) & ~1])
+	if encoded.translate(None, FIRST_LEVEL):
+		raise DecodeError("invalid NetBIOS name")
+	high = int.from_bytes(encoded[0::2].translate(DECODE_HIGH), "big")
+	low = int.from_bytes(encoded[1::2].translate(DECODE_LOW), "big")
+	return (high | low).to_bytes(len(encoded) // 2, "big")
+
+#Reads exactly size bytes from a binary stream
+#	returns None at the end of the stream
+def ReadExactly(stream, size):
+	data = stream.read(size)
+	if data is None or len(data) < size:
+		return None
+	return data
+
+#Returns a NetBIOS session message with the given payload
+def SessionMessage(payload):
+	message = bytearray(SESSION.size + len(payload))
+	SESSION.pack_into(message, 0, len(payload))
+	message[SESSION.size:] = payload
+	return message
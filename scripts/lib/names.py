@@ -2,80 +2,156 @@ import sqlite3
 import os
 import sys
 
+#How long to wait for another process that holds the database lock
+BUSY_TIMEOUT = 5.0
+
+#Hands out the names in the names db to honeypot IP addresses.
+#	Keeps one connection to the database open and remembers the names
+#	that have been allocated, as an allocation never changes.
+class NameService:
+	def __init__(self, names_path):
+		self.names_path = names_path
+		self.conn = None
+		self.pid = None
+		self.names = {}
+
+	#Returns the connection to the names db, opening it if necessary
+	def Connection(self):
+		#A connection must not be shared with a forked child
+		if self.conn is not None and self.pid == os.getpid():
+			return self.conn
+		self.conn = InitializeDB(self.names_path)
+		self.pid = os.getpid()
+		#Readers do not block the writer and vice versa
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		#We manage transactions ourselves
+		self.conn.isolation_level = None
+		return self.conn
+
+	def Close(self):
+		if self.conn is not None and self.pid == os.getpid():
+			self.conn.close()
+		self.conn = None
+
+	#Returns the name that our IP address is allocated to
+	#	returns empty string if not present
+	def GetAllocatedName(self, our_IP):
+		name = self.names.get(our_IP)
+		if name is not None:
+			return name
+		cursor = self.Connection().execute(
+			"SELECT name FROM allocs WHERE IP=?", [our_IP])
+		row = cursor.fetchone()
+		if row is None:
+			return b""
+		name = row[0].encode('ascii','ignore')
+		self.names[our_IP] = name
+		return name
+
+	#Picks the next name from the names db and allocates it to our IP
+	#	returns the chosen name on success, empty string on failure
+	def AddNameAllocation(self, our_IP):
+		name = self.GetAllocatedName(our_IP)
+		if name:
+			return name
+
+		#Claim an unused name in a single statement, so no lock has to
+		#	be held across queries.  If some other script instance got
+		#	us a name in the meantime, the IP is not unique anymore.
+		try:
+			self.Connection().execute("UPDATE allocs SET IP=? WHERE name="
+				"(SELECT name FROM allocs WHERE IP IS NULL LIMIT 1)",
+				[our_IP])
+		except sqlite3.IntegrityError:
+			pass
+
+		name = self.GetAllocatedName(our_IP)
+		if not name:
+			sys.stderr.write("Unable to assign hostname to honeypot. No unused hostnames configured.\n")
+		return name
+
+	#Allocates names to a list of IP addresses in one transaction
+	#	returns a dictionary of IP address to name for all addresses
+	#	that have a name
+	def PreallocateNames(self, IPs):
+		conn = self.Connection()
+		IPs = list(dict.fromkeys(IPs))
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			allocated = {}
+			for IP, name in conn.execute(
+				"SELECT IP, name FROM allocs WHERE IP IS NOT NULL"):
+				allocated[IP] = name
+			missing = [IP for IP in IPs if IP not in allocated]
+			if missing:
+				cursor = conn.execute("SELECT name FROM allocs "
+					"WHERE IP IS NULL LIMIT ?", [len(missing)])
+				unused = [row[0] for row in cursor]
+				conn.executemany("UPDATE allocs SET IP=? WHERE name=?",
+					zip(missing, unused))
+				allocated.update(zip(missing, unused))
+			conn.execute("COMMIT")
+		except BaseException:
+			conn.execute("ROLLBACK")
+			raise
+
+		names = {}
+		for IP in IPs:
+			if IP in allocated:
+				names[IP] = allocated[IP].encode('ascii','ignore')
+		self.names.update(names)
+		if len(names) < len(IPs):
+			sys.stderr.write("Unable to assign hostnames to %d honeypots. Not enough unused hostnames configured.\n" % (len(IPs) - len(names)))
+		return names
+
+	#Add a list of new names to the names db
+	#	returns the number of names that were not present yet
+	def AddNames(self, names):
+		conn = self.Connection()
+		before = conn.total_changes
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			conn.executemany("INSERT OR IGNORE INTO allocs(name) VALUES (?)",
+				((name,) for name in names))
+			conn.execute("COMMIT")
+		except BaseException:
+			conn.execute("ROLLBACK")
+			raise
+		return conn.total_changes - before
+
+#One service per names db, shared by all callers in this process
+services = {}
+
+def GetNameService(names_path):
+	service = services.get(names_path)
+	if service is None:
+		service = services[names_path] = NameService(names_path)
+	return service
+
 #Returns the name that our IP address is allocated to
 #	returns empty string if not present
 def GetAllocatedName(names_path, our_IP):
-	conn = InitializeDB(names_path)
-	cursor = conn.cursor()
-	cursor.execute("SELECT * FROM allocs WHERE IP=?", [our_IP])
-	row = cursor.fetchone()
-	if(row is None):
-		return ""
-	conn.close()
-	return row[1].encode('ascii','ignore')
+	return GetNameService(names_path).GetAllocatedName(our_IP)
 
 #Picks the next name from the names db and allocates it to ourself
 #	by adding an entry in the names_alloc file
 #	returns the chosen name on success, empty string on failure
 def AddNameAllocation(names_path, our_IP):
-	conn = InitializeDB(names_path)
-	cursor = conn.cursor()
+	return GetNameService(names_path).AddNameAllocation(our_IP)
 
-	#Check if we've already got a name for this IP
-	name = GetAllocatedName(names_path, our_IP)
-	if(name != ""):
-		return name
-	
-	# Get an exclusive lock on the database
-	conn.isolation_level = 'EXCLUSIVE'
-	conn.execute('BEGIN EXCLUSIVE')
-
-    # Some other script instance could have already got us a hostname. Check again now that we have exclusive lock.
-	cursor.execute("SELECT * FROM allocs WHERE IP=?", [our_IP])
-	row = cursor.fetchone()
-	if(row is not None):
-		conn.close()
-		return row[1].encode('ascii','ignore')
-		
-	#Get an unused name
-	cursor.execute("SELECT * FROM allocs WHERE IP is NULL")
-	row = cursor.fetchone()
-	if row is None:
-		conn.close()
-		sys.stderr.write("Unable to assign hostname to honeypot. No unused hostnames configured.\n")
-		return ""
-	name = row[1]
-	cursor.execute("UPDATE allocs SET IP=? WHERE name=?", [our_IP, name])
-	conn.commit()
-	conn.close()
-	return name.encode('ascii','ignore')
+#Allocates names to all of the given IP addresses at once
+def PreallocateNames(names_path, IPs):
+	return GetNameService(names_path).PreallocateNames(IPs)
 
 #Add a list of new names to the names db
 def AddNames(names_path, names):
-	conn = InitializeDB(names_path)
-	cursor = conn.cursor()
-	for name in names:
-		try:
-			cursor.execute("INSERT INTO allocs(name) VALUES (?)", [name])
-		except sqlite3.IntegrityError:
-			pass
-	conn.commit()
-	conn.close()
+	return GetNameService(names_path).AddNames(names)
 
 def InitializeDB(names_path):
-	if not os.path.exists(os.path.dirname(names_path)):
-		os.makedirs(os.path.dirname(names_path))
-	conn = sqlite3.connect(names_path)
-	cursor = conn.cursor()
-	cursor.execute("select tbl_name from sqlite_master")
-	list_tables = cursor.fetchone()
-	if list_tables is None:
-		cursor.execute("CREATE TABLE allocs (IP text UNIQUE, name text PRIMARY KEY)")
-		conn.commit()
-		return conn
-	list_tables = list_tables[0]
-	if("allocs" not in list_tables):
-		cursor.execute("CREATE TABLE allocs (IP text UNIQUE, name text PRIMARY KEY)")
+	directory = os.path.dirname(names_path)
+	if directory and not os.path.exists(directory):
+		os.makedirs(directory)
+	conn = sqlite3.connect(names_path, timeout=BUSY_TIMEOUT)
+	conn.execute("CREATE TABLE IF NOT EXISTS allocs (IP text UNIQUE, name text PRIMARY KEY)")
 	conn.commit()
 	return conn
-
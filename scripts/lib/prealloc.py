@@ -0,0 +1,92 @@
+#Assigns names to the honeypots before they see their first query.
+#
+#	prealloc.py [--names PATH] [--wordlist FILE] [--dump FILE]
+#		[--honeyd URL] [IP ...]
+#
+#Names are imported from the word lists first, one name per line.  The
+#	IP addresses come from the command line, from files that honeyd -t
+#	wrote, and from the /api/config_ips view of a running honeyd.  All
+#	of them get their names in a single transaction.  The allocations
+#	are printed as "IP name" lines.
+
+import argparse
+import json
+import os
+import sys
+import urllib.request
+
+sys.path.append("/usr/share/honeyd/scripts/lib/")
+from names import NameService
+
+
+#Returns the names in a word list, skipping empty lines and comments
+def ReadWordlist(path):
+	names = []
+	with open(path) as fd:
+		for line in fd:
+			line = line.strip()
+			if line and not line.startswith("#"):
+				names.append(line)
+	return names
+
+#Returns the IP addresses in a file written by template_dump_ips
+#	Every line is "IP, ethernet address, interface"
+def ReadDump(path):
+	IPs = []
+	with open(path) as fd:
+		for line in fd:
+			IP = line.split(",", 1)[0].strip()
+			if IP:
+				IPs.append(IP)
+	return IPs
+
+#Returns the bound IP addresses of a running honeyd from its webserver
+def QueryHoneyd(url):
+	url = url.rstrip("/") + "/api/config_ips"
+	with urllib.request.urlopen(url) as response:
+		ips = json.load(response)
+	return [ip["address"] if isinstance(ip, dict) else ip for ip in ips]
+
+def main(argv=None):
+	home = os.path.expanduser("~")
+	parser = argparse.ArgumentParser(
+		description="Assign names to honeypot IP addresses in bulk.")
+	parser.add_argument("--names", default=home + "/.config/honeyd/names",
+		help="the names database (default: %(default)s)")
+	parser.add_argument("--wordlist", action="append", default=[],
+		help="import the names in this file, one per line")
+	parser.add_argument("--dump", action="append", default=[],
+		help="allocate names for the IP addresses in this honeyd -t file")
+	parser.add_argument("--honeyd", action="append", default=[],
+		metavar="URL",
+		help="allocate names for the IP addresses bound by the honeyd "
+		"whose webserver runs at URL, e.g. http://127.0.0.1/")
+	parser.add_argument("ips", nargs="*", metavar="IP",
+		help="allocate names for these IP addresses")
+	args = parser.parse_args(argv)
+
+	service = NameService(args.names)
+
+	for path in args.wordlist:
+		added = service.AddNames(ReadWordlist(path))
+		sys.stderr.write(f"{path}: added {added} names\n")
+
+	IPs = list(args.ips)
+	for path in args.dump:
+		IPs.extend(ReadDump(path))
+	for url in args.honeyd:
+		IPs.extend(QueryHoneyd(url))
+
+	status = 0
+	if IPs:
+		names = service.PreallocateNames(IPs)
+		for IP, name in names.items():
+			sys.stdout.write(f"{IP} {name.decode('ascii')}\n")
+		#Not enough unused names
+		if len(names) < len(set(IPs)):
+			status = 1
+	service.Close()
+	return status
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,14 +1,14 @@
-import struct
+import codec
 
-# From RFC1035, meant to be & with m_flags
-BITMASK_QR = 1 << 7
-BITMASK_OPCODE = 0xF << 3
-BITMASK_AA = 1 << 2
-BITMASK_TC = 1 << 1
-BITMASK_RD = 1 << 0
+# From RFC1035, meant to be & with the 16 bit flags
+BITMASK_QR = 1 << 15
+BITMASK_OPCODE = 0xF << 11
+BITMASK_AA = 1 << 10
+BITMASK_TC = 1 << 9
+BITMASK_RD = 1 << 8
 
-BITMASK_RA = 1 << 15
-BITMASK_RCODE = 0x7 << 12
+BITMASK_RA = 1 << 7
+BITMASK_RCODE = 0xF
 
 QR_QUERY = 0
 QR_RESPONSE = 1
@@ -46,7 +46,7 @@ class DNSHeader:
 
 	@property
 	def opcode(self):
-		return int(self._flags & BITMASK_OPCODE)
+		return int((self._flags & BITMASK_OPCODE) >> 11)
 
 	@property
 	def aa(self):
@@ -69,66 +69,43 @@ class DNSHeader:
 		return int(self._flags & BITMASK_RCODE)
 	
 
-	def readPacket(self, stream):
-		self.transactionID, self.flags, self.qdcount, self.ancount, self.nscount, self.arcount = struct.unpack('!HHHHHH', stream.read(12))
+	def readPacket(self, data):
+		header, questions = codec.DecodeQuery(data)
+		self.transactionID, self.flags, self.qdcount, self.ancount, self.nscount, self.arcount = header
 
 		# Extract the question section
-		for i in range(0,self.qdcount):
+		for entry in questions:
 			question = DNSQuestion()
-			
-			labelLength = 1
-		
-			local = 0
-			while (labelLength != 0):
-				labelLength = ord(stream.read(1))
-				if (labelLength > 0):
-					if (local > 0):
-						question.qname += "."
-					question.qname += stream.read(labelLength)
-				local += 1
-			
-			question.qtype = stream.read(2)
-			question.qclass = stream.read(2)
+			question.qname = entry.name
+			question.qtype = entry.qtype
+			question.qclass = entry.qclass
 			self.questions.append(question)
 
-	def writePacket(self, stream):
+	def writePacket(self):
 		self.qdcount = len(self.questions)
 		self.ancount = len(self.answers)
-		stream.write(struct.pack('!HHHHHH', self.transactionID, self.flags, self.qdcount, self.ancount, self.nscount, self.arcount))
-		for answer in self.answers:
-			stream.write(answer.packedString())
+		return bytes(codec.Message(self.transactionID, self.flags,
+			[answer.packedString() for answer in self.answers]))
 		
 
 class DNSQuestion:
 	def __init__(self):
-		self.qname = ""
-		self.qtype = ""
-		self.qclass = ""
+		self.qname = b""
+		self.qtype = 0
+		self.qclass = 0
 
 class DNSResourceRecord:
-	def __init(self):
-		self.name = ""
+	def __init__(self):
+		self.name = b""
 		self.type = 0
 		self.dataclass = 0
 		self.ttl = 0
-		self.rdlength = 0
-		self.rdata = ""
-
-	def packedString(self):
-		returnString = ""
-
-		locals = self.name.split(".")
-		for local in locals:
-			returnString += struct.pack('!B', len(local))
-			returnString += struct.pack('!' + str(len(local)) + 's', local)
-		returnString += struct.pack('!B', 0)
+		self.rdata = b""
 
-		returnString += struct.pack('!H', self.type)
-		returnString += struct.pack('!H', self.dataclass)
-		returnString += struct.pack('!I', self.ttl)
-		returnString += struct.pack('!H', self.rdlength)
-		returnString += struct.pack('!' + str(self.rdlength) + 's', self.rdata)
-
-		return returnString
-		
+	@property
+	def rdlength(self):
+		return len(self.rdata)
 
+	def packedString(self):
+		return codec.Record(codec.EncodeName(self.name), self.type,
+			self.dataclass, self.ttl, self.rdata)
@@ -1,35 +1,63 @@
+# Multicast DNS responder for the honeypots.
+#
+# As an external command, Honeyd starts this script for every query.
+# The name of the names database is read from the file in the second
+# argument.
+#
+# The script can also stay resident in Honeyd and answer all queries
+# without forking:
+#
+#	add template udp port 5353 internal "scripts.linux.mdns.mdns"
+#
+# In that mode the names database is $HONEYD_HOME/names and the name
+# of every honeypot is allocated only once.
+
 import os
-import sys
 import socket
-
+import sys
+from collections import deque
+from functools import lru_cache
 
 sys.path.append("/usr/share/honeyd/scripts/lib/")
+import codec
 from names import AddNameAllocation
 
+# dns.py lives next to us, which is not on the path inside of Honeyd
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import dns
 
-
-# TODO read in name from config file
-honeypotIp = os.getenv("HONEYD_TEMPLATE_NAME")
-
-honeyd_home = ""
-if("HONEYD_HOME" in os.environ):
-	honeyd_home = os.getenv("HONEYD_HOME")
-
-fd = open(sys.argv[2])
-names_file = fd.readline().split(" ", 1)[1].rstrip("\n")
-names_path = honeyd_home + names_file
-
-our_name = AddNameAllocation(names_path, honeypotIp).upper()
-if(our_name == ""):
-	sys.stderr.write("Unable to get mdns name")
-	sys.exit(0)
-hostname = our_name + ".LOCAL"
-
-
-def reply(requestPacket):
+try:
+	import honeyd
+except ImportError:
+	# Started as an external command
+	honeyd = None
+else:
+	# Datagrams are binary, so Honeyd must not decode them
+	honeyd_delivery = honeyd.DELIVER_MEMORYVIEW
+
+# Host names of the honeypots in resident mode, by IP address
+allocated_hostnames = {}
+
+
+# Returns the mdns host name of the honeypot with the given IP, or an
+# empty string if no name could be allocated
+def AllocatedHostname(names_path, honeypotIp):
+	hostname = allocated_hostnames.get(honeypotIp)
+	if hostname is None:
+		our_name = AddNameAllocation(names_path, honeypotIp)
+		if not our_name:
+			return b""
+		hostname = our_name.upper() + b".LOCAL"
+		allocated_hostnames[honeypotIp] = hostname
+	return hostname
+
+
+# Returns our answer, which only differs in the transaction ID between
+# queries
+@lru_cache(maxsize=codec.NAME_CACHE)
+def answer(hostname, honeypotIp):
 	replyPacket = dns.DNSHeader()
-	replyPacket.transactionID = requestPacket.transactionID
+	replyPacket.transactionID = 0
 	replyPacket.flags = int("8400", 16)
 	
 	rr = dns.DNSResourceRecord()
@@ -37,31 +65,96 @@ def reply(requestPacket):
 	rr.type = 1
 	rr.dataclass = int("8001", 16)
 	rr.ttl = 120
-	rr.rdlength = 4
 	rr.rdata = socket.inet_aton(honeypotIp)
 
 	replyPacket.answers.append(rr)
 
-	replyPacket.writePacket(sys.stdout)
-
-
-packet = dns.DNSHeader()
-packet.readPacket(sys.stdin)
-
-# Only interested if this is a query
-if (packet.qr != dns.QR_QUERY):
-	sys.exit()
-
-# Only interested if there are questions
-if (packet.qdcount == 0):
-	sys.exit()
-
-
-#pprint(vars(packet), sys.stderr)
-for question in packet.questions:
-	#pprint(vars(question), sys.stderr)
-	
-	if (question.qname.upper() == hostname):
-		
-		reply(packet)
-
+	return replyPacket.writePacket()
+
+
+def reply(requestPacket, hostname, honeypotIp):
+	return codec.Reply(answer(hostname, honeypotIp),
+	    requestPacket.transactionID)
+
+
+# Returns the reply to an mdns packet, or None if the packet does not
+# ask for our host name
+def respond(data, hostname, honeypotIp):
+	packet = dns.DNSHeader()
+	try:
+		packet.readPacket(data)
+	except codec.DecodeError:
+		return None
+
+	# Only interested if this is a query
+	if (packet.qr != dns.QR_QUERY):
+		return None
+
+	# Only interested if there are questions
+	if (packet.qdcount == 0):
+		return None
+
+	for question in packet.questions:
+		if (question.qname.upper() == hostname):
+			return reply(packet, hostname, honeypotIp)
+
+	return None
+
+
+# Callbacks for the resident mode.  Honeyd calls honeyd_init for every
+# new flow and honeyd_readdata for every datagram on it.
+
+def honeyd_init(meta):
+	honeyd_home = os.getenv("HONEYD_HOME", "")
+	state = {
+		"ip": meta["HONEYD_IP_DST"],
+		"hostname": AllocatedHostname(honeyd_home + "names",
+		    meta["HONEYD_IP_DST"]),
+		"replies": deque(),
+	}
+	honeyd.read_selector(honeyd.EVENT_ON)
+	return state
+
+def honeyd_readdata(state, data):
+	honeyd.read_selector(honeyd.EVENT_ON)
+	if state["hostname"]:
+		packet = respond(data, state["hostname"], state["ip"])
+		if packet is not None:
+			state["replies"].append(packet)
+			honeyd.write_selector(honeyd.EVENT_ON)
+	return 0
+
+def honeyd_writedata(state):
+	# One reply per call, every write is a datagram of its own
+	replies = state["replies"]
+	if not replies:
+		return b""
+	packet = replies.popleft()
+	if replies:
+		honeyd.write_selector(honeyd.EVENT_ON)
+	return packet
+
+def honeyd_end(state):
+	return 0
+
+
+if __name__ == "__main__":
+	# TODO read in name from config file
+	honeypotIp = os.getenv("HONEYD_TEMPLATE_NAME")
+
+	honeyd_home = ""
+	if("HONEYD_HOME" in os.environ):
+		honeyd_home = os.getenv("HONEYD_HOME")
+
+	fd = open(sys.argv[2])
+	names_file = fd.readline().split(" ", 1)[1].rstrip("\n")
+	names_path = honeyd_home + names_file
+
+	hostname = AllocatedHostname(names_path, honeypotIp)
+	if not hostname:
+		sys.stderr.write("Unable to get mdns name")
+		sys.exit(0)
+
+	packet = respond(os.read(sys.stdin.fileno(), 65535), hostname, honeypotIp)
+	if packet is not None:
+		sys.stdout.buffer.write(packet)
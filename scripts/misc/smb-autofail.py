@@ -1,277 +1,198 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 import sys
 
-native_os = ""
-primary_domain = ""
+sys.path.append("/usr/share/honeyd/scripts/lib/")
+from codec import SESSION, SMB_HEADER, ReadExactly, SessionMessage
+
+native_os = b""
+primary_domain = b""
 time_zone = 0
-lan_manager = ""
+lan_manager = b""
+
+SMB_PROTOCOL = b"\xffSMB"
+
+#Flags 1 and Flags 2 of our responses
+FLAGS1 = 0x88
+FLAGS2 = 0x41c8
 
 def GetRequest():
-    #Get netBIOS Session Service header
-    sys.stdin.read(4)
-    #Server component must be "0xffSMB"
-    server_component = sys.stdin.read(4)
-    if(server_component != "\xffSMB"):
+    #Get netBIOS Session Service header, the request follows it
+    session = ReadExactly(sys.stdin.buffer, SESSION.size)
+    if session is None:
+        return False
+    length = SESSION.unpack(session)[0] & 0xffffff
+    request = ReadExactly(sys.stdin.buffer, length)
+    if request is None or length < SMB_HEADER.size:
         return False
-    
+    view = memoryview(request)
+
     ### SMB Header ###
-    smb_command = sys.stdin.read(1)     #SMB command
-    _nt_status = sys.stdin.read(4)      #NT status (unused)
-    _flags1 = sys.stdin.read(1)         #Flags 1 (unused)
-    _flags2 = sys.stdin.read(2)         #Flags 2 (unused)
-    _pid_high = sys.stdin.read(2)       #PID high (unused)
-    _signature = sys.stdin.read(8)      #Signature (unused)
-    _reserved = sys.stdin.read(2)       #Reserved (unused)
-    _tree_id = sys.stdin.read(2)        #Tree ID (unused)
-    pid = sys.stdin.read(2)             #pid
-    _uid = sys.stdin.read(2)            #User id (unused)
-    mid = sys.stdin.read(2)             #Multiplex id
+    (server_component, smb_command, _nt_status, _flags1, _flags2,
+     _pid_high, _signature, _reserved, _tree_id, pid, _uid,
+     mid) = SMB_HEADER.unpack_from(view)
+
+    #Server component must be "0xffSMB"
+    if(server_component != SMB_PROTOCOL):
+        return False
+
+    body = view[SMB_HEADER.size:]
 
     ### Supported Request Types ###
 
     #Negotiate Protocol Request
-    if(smb_command == "\x72"):
-        return HandleNegotiateProtocolRequest(pid, mid)
+    if(smb_command == 0x72):
+        return HandleNegotiateProtocolRequest(body, pid, mid)
 
     #Session Setup AndX Request (authenticate)
-    if(smb_command == "\x73"):
+    if(smb_command == 0x73):
         return HandleSessionSetupRequest(pid, mid)
 
     #Tree Connect AndX Request
-    if(smb_command == "\x75"):
+    if(smb_command == 0x75):
         return HandleTreeConnectRequest(pid, mid)
 
     #Tree Disconnect AndX Request
-    if(smb_command == "\x71"):
+    if(smb_command == 0x71):
         return HandleDisconnectRequest(pid, mid)
 
-    SendError("\x72", "\x00\x00\x00\x00", pid, mid)
+    SendError(0x72, 0, pid, mid)
     return True
 
-#pid = the Process ID that needs to be parroted back
-#mid = the Message ID that needs to be parroted back
-def HandleNegotiateProtocolRequest(pid, mid):
+#Returns an SMB header for a response
+def Header(smb_command, status, pid, mid, flags2=FLAGS2):
+    return SMB_HEADER.pack(SMB_PROTOCOL, smb_command, status, FLAGS1,
+        flags2, 0, bytes(8), 0, 0, pid, 0, mid)
+
+#Writes a response with a NetBios Session Service header
+def SendResponse(response):
+    sys.stdout.buffer.write(SessionMessage(response))
+    sys.stdout.flush()
+
+#Returns the bytes of the byte count field after the parameter words
+def ReadBytes(body):
+    if not body:
+        return b""
     #Word Count
-    _word_count = sys.stdin.read(1)  # unused
+    word_count = body[0]
+    offset = 1 + word_count * 2
     #Byte Count
-    byte_count = sys.stdin.read(2)
-    #convert to integer, read in that many bytes (reverse byte order)
-    remaining_bytes = ord(byte_count[0]) + ( 256 * ord(byte_count[1]))
-    requested_dialects = sys.stdin.read(remaining_bytes)
-    dialects = requested_dialects.split("\x00")
+    byte_count = int.from_bytes(body[offset:offset + 2], "little")
+    return bytes(body[offset + 2:offset + 2 + byte_count])
+
+#pid = the Process ID that needs to be parroted back
+#mid = the Message ID that needs to be parroted back
+def HandleNegotiateProtocolRequest(body, pid, mid):
+    requested_dialects = ReadBytes(body)
+    dialects = requested_dialects.split(b"\x00")
     chosen_dialect = -1
     for i in range(0, len(dialects)-1):
         #Shave off the 1st byte, as it is the Buffer Format
-        #sys.stderr.write(dialects[i][1:] + "\n")
-        if(dialects[i][1:] == "NT LM 0.12"):
+        if(dialects[i][1:] == b"NT LM 0.12"):
             chosen_dialect = i
             break
 
     if chosen_dialect == -1:
-        SendError('\x72', "\x00\x00\x00\x00", pid, mid)
-        return
+        SendError(0x72, 0, pid, mid)
+        return True
 
     ### SMB Header ###
-    response = "\xffSMB" 
-    response += "\x72"              #SMB command
-    response += "\x00\x00\x00\x00"  #NT status 
-    response += "\x88"              #Flags 1
-    response += "\xc8\x41"          #Flags 2
-    response += "\x00\x00"          #PID high
-    response += "\x00\x00\x00\x00\x00\x00\x00\x00" #Signature
-    response += "\x00\x00"          #Reserved
-    response += "\x00\x00"          #Tree ID
-    response += pid                 #pid
-    response += "\x00\x00"          #User id
-    response += mid                 #Multiplex id
+    response = bytearray(Header(0x72, 0, pid, mid))
 
     ### Response ###
     #SMB Message Parameters
-    response += "\x11" #34 byte header (value x2)
-    response += chr(chosen_dialect) + "\x00"
-    response += "\x08" #most security off
-    response += "\x32\x00"
-    response += "\x01\x00"
-    response += "\x04\x41\x00\x00"
-    response += "\x00\x00\x01\x00"
-    response += "\x00\x00\x00\x00"
-    response += "\xf9\xf3\x01\x00" #capabilties (no extra security)
-    response += "\xa9\xbb\x01\x95\x73\x56\xce\x01" #TODO get system time
-    #Convert integer length to hex string in reverse byte order
-    response += chr(time_zone % 256) + chr(time_zone / 256) #Server time zone
-    response += "\x00"
+    response += b"\x11" #34 byte header (value x2)
+    response += chosen_dialect.to_bytes(2, "little")
+    response += b"\x08" #most security off
+    response += b"\x32\x00"
+    response += b"\x01\x00"
+    response += b"\x04\x41\x00\x00"
+    response += b"\x00\x00\x01\x00"
+    response += b"\x00\x00\x00\x00"
+    response += b"\xf9\xf3\x01\x00" #capabilties (no extra security)
+    response += b"\xa9\xbb\x01\x95\x73\x56\xce\x01" #TODO get system time
+    response += (time_zone & 0xffff).to_bytes(2, "little") #Server time zone
+    response += b"\x00"
 
     byte_size = len(primary_domain) + 1
-    #Convert integer length to hex string in reverse byte order
-    response += chr(byte_size % 256) + chr(byte_size/256)
-    response += primary_domain + "\x00"
-    sys.stdout.write("\x00\x00\x00" + chr(len(response)) + response)
-    sys.stdout.flush()
+    response += byte_size.to_bytes(2, "little")
+    response += primary_domain + b"\x00"
+    SendResponse(response)
     return True
 
 def HandleSessionSetupRequest(pid, mid):
-    ### Read Request Contents ###
-
-    #Word Count
-    word_count = sys.stdin.read(1)
-    remaining_bytes = ord(word_count) * 2
-    _options = sys.stdin.read(remaining_bytes)  # unused
-
-    #Byte Count
-    byte_count = sys.stdin.read(2)
-    #convert to integer, read in that many bytes (reverse byte order)
-    remaining_bytes = ord(byte_count[0]) + ( 256 * ord(byte_count[1]))
-    _rest = sys.stdin.read(remaining_bytes)  # unused
-
     ### Create SMB Header ###
-    response = "\xffSMB"   
-    response += "\x73"      #SMB command
-    response += "\x00\x00\x00\x00" #NT status SUCCESS
-    response += "\x88"      #Flags 1
-    response += "\xc8\x41"  #Flags 2
-    response += "\x00\x00"  #PID high
-    response += "\x00\x00\x00\x00\x00\x00\x00\x00" #Signature 
-    response += "\x00\x00"  #Reserved
-    response += "\x00\x00"  #Tree ID
-    response += pid         #pid
-    response += "\x00\x00"  #User id
-    response += mid         #Multiplex id
+    response = bytearray(Header(0x73, 0, pid, mid)) #NT status SUCCESS
 
     ### Create Response ###
 
     #SMB Message Parameters
-    response += "\x03" #6 byte start (value x2)
-    response += "\xff" #no further commands
-    response += "\x00" #reserved
-    response += "\xc7\x00" #AndXOffset
-    response += "\x00\x00" #Action: not logged in as GUEST
+    response += b"\x03" #6 byte start (value x2)
+    response += b"\xff" #no further commands
+    response += b"\x00" #reserved
+    response += b"\xc7\x00" #AndXOffset
+    response += b"\x00\x00" #Action: not logged in as GUEST
 
     byte_size = len(native_os) + len(lan_manager) + len(primary_domain) + 3
-    #Convert integer length to hex string in reverse byte order
-    server_info = chr(byte_size % 256) + chr(byte_size/256)
-    server_info += native_os + "\x00" #Native OS
-    server_info += lan_manager + "\x00" #Native LAN manager
-    server_info += primary_domain + "\x00" #Primary Domain
-    response += server_info
-
-    #Prepend packet with NetBios Session Service header
-    sys.stdout.write("\x00\x00\x00" + chr(len(response)) + response)
-    sys.stdout.flush()
+    response += byte_size.to_bytes(2, "little")
+    response += native_os + b"\x00" #Native OS
+    response += lan_manager + b"\x00" #Native LAN manager
+    response += primary_domain + b"\x00" #Primary Domain
+
+    SendResponse(response)
     return True
 
 def HandleTreeConnectRequest(pid, mid):
-    #Word Count
-    word_count = sys.stdin.read(1)
-    remaining_bytes = ord(word_count) * 2
-    _options = sys.stdin.read(remaining_bytes)  # unused
-
-    #Byte Count
-    byte_count = sys.stdin.read(2)
-    #convert to integer, read in that many bytes (reverse byte order)
-    remaining_bytes = ord(byte_count[0]) + ( 256 * ord(byte_count[1]))
-    _rest = sys.stdin.read(remaining_bytes)  # unused
-
     ### Create SMB Header ###
-    response = "\xffSMB"    
-    response += "\x75"      #SMB command
-    response += "\x22\x00\x00\xc0" #NT status 
-    response += "\x88"      #Flags 1
-    response += "\xc8\x41"  #Flags 2
-    response += "\x00\x00"  #PID high
-    response += "\x00\x00\x00\x00\x00\x00\x00\x00" #Signature 
-    response += "\x00\x00"  #Reserved
-    response += "\x00\x00"  #Tree ID
-    response += pid         #pid
-    response += "\x00\x00"  #User id
-    response += mid         #Multiplex id
+    response = Header(0x75, 0xc0000022, pid, mid)
 
     ### Create Response ###
 
-    response += "\x00\x00\x00"
+    response += b"\x00\x00\x00"
 
-    #Prepend packet with NetBios Session Service header
-    sys.stdout.write("\x00\x00\x00" + chr(len(response)) + response)
-    sys.stdout.flush()
+    SendResponse(response)
     return True
 
 def HandleDisconnectRequest(pid, mid):
-    #Word Count
-    word_count = sys.stdin.read(1)
-    remaining_bytes = ord(word_count) * 2
-    _options = sys.stdin.read(remaining_bytes)  # unused
-
-    #Byte Count
-    byte_count = sys.stdin.read(2)
-    #convert to integer, read in that many bytes (reverse byte order)
-    remaining_bytes = ord(byte_count[0]) + ( 256 * ord(byte_count[1]))
-    _rest = sys.stdin.read(remaining_bytes)  # unused
-
     ### Create SMB Header ###
-    response = "\xffSMB"    
-    response += "\x71"      #SMB command
-    response += "\x00\x00\x00\x00" #NT status 
-    response += "\x88"      #Flags 1
-    response += "\xc8\x01"  #Flags 2
-    response += "\x00\x00"  #PID high
-    response += "\x00\x00\x00\x00\x00\x00\x00\x00" #Signature 
-    response += "\x00\x00"  #Reserved
-    response += "\x00\x00"  #Tree ID
-    response += pid         #pid
-    response += "\x00\x00"  #User id
-    response += mid         #Multiplex id
+    response = Header(0x71, 0, pid, mid, flags2=0x01c8)
 
     ### Create Response ###
 
-    response += "\x00\x00\x00"
+    response += b"\x00\x00\x00"
 
-    #Prepend packet with NetBios Session Service header
-    sys.stdout.write("\x00\x00\x00" + chr(len(response)) + response)
-    sys.stdout.flush()
+    SendResponse(response)
     return True
-   
 
-#error_code = 1 byte SMB Command
-#status = 4 byte NT status code
+
+#error_code = SMB Command
+#status = NT status code
 #pid = the Process ID that needs to be parroted back
 #mid = the Message ID that needs to be parroted back
 def SendError(error_code, status, pid, mid):
     ### SMB Header ###
-    error_message = "\xffSMB"
-    error_message += error_code
-    error_message += status
-    error_message += "\x88"
-    error_message += "\xc8\x41"
-    error_message += "\x00\x00"
-    error_message += "\x00\x00\x00\x00\x00\x00\x00\x00"
-    error_message += "\x00\x00\x00\x00"
-    error_message += "\x00\x00"
-    error_message += pid
-    error_message += "\x00\x00"
-    error_message += mid
+    error_message = Header(error_code, status, pid, mid)
 
     ### Response ###
-    error_message += "\x00\x00\x00"
+    error_message += b"\x00\x00\x00"
 
-    sys.stdout.write(error_message)
-    sys.stdout.flush()
+    SendResponse(error_message)
     return True
 
 
 #Read Arguments
 for line in open(sys.argv[2]):
     if(line.split(' ', 1)[0] == "NATIVE_OS"):
-        native_os = line.split(' ', 1)[1].rstrip()
+        native_os = line.split(' ', 1)[1].rstrip().encode("ascii", "ignore")
     if(line.split(' ', 1)[0] == "PRIMARY_DOMAIN"):
-        primary_domain = line.split(' ', 1)[1].rstrip()
+        primary_domain = line.split(' ', 1)[1].rstrip().encode("ascii", "ignore")
     if(line.split(' ', 1)[0] == "TIME_ZONE"):
         time_zone = int(line.split(' ', 1)[1].rstrip())
     if(line.split(' ', 1)[0] == "LAN_MANAGER"):
-        lan_manager = line.split(' ', 1)[1].rstrip()
+        lan_manager = line.split(' ', 1)[1].rstrip().encode("ascii", "ignore")
 
 
 #Main Loop. Keep accepting requests until one comes back bad
 keep_going = True
 while keep_going:
-    keep_going = GetRequest()    
-
+    keep_going = GetRequest()
@@ -1,6 +1,14 @@
-import sys
 import os
 import struct
+import sys
+
+sys.path.append("/usr/share/honeyd/scripts/lib/")
+from codec import TDS_HEADER, TDS_OPTION, ReadExactly
+
+# Token, length, reserved, error number, state and level of an error
+ERROR_TOKEN = struct.Struct("<BBBIBB")
+# Token, status, current command and row count of a done token
+DONE_TOKEN = struct.Struct("<BHHI")
 
 class PreLoginToken:
 	def __init__(self):
@@ -16,54 +24,52 @@ class TDSPacket:
 
 	# Returns string version of the packet
 	def writePacket(self):
-		ret = ""
-		ret += struct.pack("!B", self.type)
-		ret += struct.pack("!B", self.status)
-		ret += struct.pack("!H", self.length)
-		ret += struct.pack("!H", self.chan)
-		ret += struct.pack("!B", self.packet)
-		ret += struct.pack("!B", self.window)
+		ret = bytearray(TDS_HEADER.pack(self.type, self.status, self.length,
+			self.chan, self.packet, self.window))
 
 		for token in self.tokens:
-			ret += struct.pack("!B", token.type)
-			
 			if (token.type != 255):
-				ret += struct.pack("!H", token.position)
-				ret += struct.pack("!H", token.length)
+				ret += TDS_OPTION.pack(token.type, token.position, token.length)
+			else:
+				ret.append(token.type)
 
-		ret += struct.pack(str(len(self.payload)) + "s", self.payload)
+		ret += self.payload
 
 		return ret
 
 	# Reads in a TDS packet. Really only parses pre-login packets.
+	# Returns False at the end of the stream.
 	def readPacket(self, stream):
-		self.type = struct.unpack("!B", stream.read(1))[0]
-		
-		self.status = struct.unpack("!B", stream.read(1))[0]
-		self.length = struct.unpack("!H", stream.read(2))[0]
-		self.chan = struct.unpack("!H", stream.read(2))[0]
-		self.packet = struct.unpack("!B", stream.read(1))[0]
-		self.window = struct.unpack("!B", stream.read(1))[0]
+		header = ReadExactly(stream, TDS_HEADER.size)
+		if header is None:
+			return False
+		self.type, self.status, self.length, self.chan, self.packet, self.window = TDS_HEADER.unpack(header)
 
-		bytesRead = 8
+		body = ReadExactly(stream, max(self.length - TDS_HEADER.size, 0))
+		if body is None:
+			return False
+		view = memoryview(body)
+
+		bytesRead = 0
 		
 		if self.type == 18:
-			while bytesRead < self.length:
+			while bytesRead < len(view):
 				# Read a token
 				token = PreLoginToken()
-				token.tokenPosition = bytesRead
+				token.tokenPosition = bytesRead + TDS_HEADER.size
 
-				token.type = struct.unpack("!B", stream.read(1))[0]
-				bytesRead += 1
+				token.type = view[bytesRead]
 		
 				if (token.type == 255):
+					bytesRead += 1
 					self.tokens.append(token)
 					break
 
-				token.position = struct.unpack("!H", stream.read(2))[0]
-				bytesRead += 2
-				token.length = struct.unpack("!H", stream.read(2))[0]
-				bytesRead += 2
+				try:
+					token.type, token.position, token.length = TDS_OPTION.unpack_from(view, bytesRead)
+				except struct.error:
+					return False
+				bytesRead += TDS_OPTION.size
 			
 				if token.type == 0:
 					self.tokenOffset = token.position
@@ -71,11 +77,9 @@ class TDSPacket:
 				self.tokens.append(token)
 
 
-			self.payloadStart = bytesRead + 1
-			if bytesRead < self.length:
-				self.payload = struct.unpack(str(self.length - bytesRead) + "s", stream.read(self.length - bytesRead))[0]
-		else:
-			self.payload = struct.unpack(str(self.length - bytesRead) + "s", stream.read(self.length - bytesRead))[0]
+			self.payloadStart = bytesRead + TDS_HEADER.size + 1
+
+		self.payload = bytes(view[bytesRead:])
 
 		return True
 	
@@ -90,10 +94,10 @@ class TDSPacket:
 		ret += "Window: " + str(self.window) + "\n\n"
 
 		ret += "Payload: "
-		ret += ":".join("{:x}".format(ord(c)) for c in self.payload)
+		ret += ":".join("{:x}".format(c) for c in self.payload)
 		ret += "\n"
 
-		ret += "First byte is " + str(ord(self.payload[0])) + "\n"
+		ret += "First byte is " + str(self.payload[0]) + "\n"
 
 		for token in self.tokens:
 			ret += "Token: " + str(token.type) + "\n"
@@ -101,9 +105,9 @@ class TDSPacket:
 			ret += "Position: " + str(token.position) + "\n"
 			ret += "Length: " + str(token.length) + "\n"
 			ret += "Value: "
-			foo = str(self.payload[token.position - (self.tokenOffset):(token.position + token.length - (self.tokenOffset))])
+			foo = self.payload[token.position - (self.tokenOffset):(token.position + token.length - (self.tokenOffset))]
 			for char in foo:
-				ret += str(ord(char)) + " "
+				ret += str(char) + " "
 			ret += "\n\n"
 
 		ret += "Payload size: " + str(len(self.payload))
@@ -140,43 +144,23 @@ class LoginError:
 
 	# Returns string version of the packet
 	def writePacket(self):
-		ret = ""
-
-		ret += struct.pack('!B', self.tdstype)
-		ret += struct.pack('!B', self.status)
-		ret += struct.pack('!H', self.tlength)
+		ret = bytearray(TDS_HEADER.pack(self.tdstype, self.status,
+			self.tlength, self.channel, self.number, self.window))
 		
-		ret += struct.pack('!H', self.channel)
-		ret += struct.pack('!B', self.number)
+		ret += ERROR_TOKEN.pack(self.token, self.length, 0, self.error,
+			self.state, self.level)
 
-		ret += struct.pack('!B', self.window)
-		
-		ret += struct.pack('!B', self.token)
-		ret += struct.pack('!B', self.length)
-		ret += struct.pack('!B', 0)
-		ret += struct.pack('<I', self.error)
-		ret += struct.pack('!B', self.state)
-		ret += struct.pack('!B', self.level)
-
-		ret += struct.pack('!B', self.errorLength)
-		ret += struct.pack('!B', 0)
-		for char in self.errorMsg:
-			ret += struct.pack("<H", ord(char))
+		ret += struct.pack('<H', self.errorLength)
+		ret += self.errorMsg.encode("utf-16-le")
 
 		ret += struct.pack('!B', self.serverNameLength)
-		for char in self.serverName:
-			ret += struct.pack("<H", ord(char))
+		ret += self.serverName.encode("utf-16-le")
 
 		ret += struct.pack('!B', self.processNameLength)
-		ret += struct.pack('<H', self.lineNumber)
-
-		ret += struct.pack('!B', 0)
-		ret += struct.pack('!B', 0)
+		ret += struct.pack('<I', self.lineNumber)
 
-		ret += struct.pack('!B', self.doneToken)
-		ret += struct.pack('<H', self.statusFlags)
-		ret += struct.pack('!H', self.op)
-		ret += struct.pack('!I', self.rows)
+		ret += DONE_TOKEN.pack(self.doneToken, self.statusFlags, self.op,
+			self.rows)
 		
 		ret += struct.pack('!I', 0)
 
@@ -184,26 +168,29 @@ class LoginError:
 
 while True:
 	tds = TDSPacket()
-	tds.readPacket(sys.stdin)
+	if not tds.readPacket(sys.stdin.buffer):
+		break
 	# Type 18 is the pre-login handshake packet
 	if tds.type == 18:
 		# Modify the packet
 		tds.type = 4
+		payload = bytearray(tds.payload)
 		for token in tds.tokens:
 			# Force encryption off
 			if (token.type == 1):
-				tds.payload = tds.payload[:token.position - tds.tokenOffset] + chr(2) + tds.payload[token.position - tds.tokenOffset + 1:]
+				payload[token.position - tds.tokenOffset] = 2
 			# Zero the thread ID
 			if (token.type == 3):
-				tds.payload = tds.payload[:token.position - tds.tokenOffset] + chr(0) + chr(0) + chr(0) + chr(0) + tds.payload[token.position - tds.tokenOffset + 4:]
+				start = token.position - tds.tokenOffset
+				payload[start:start + 4] = bytes(4)
+		tds.payload = payload
 
-		sys.stdout.write(tds.writePacket())
+		sys.stdout.buffer.write(tds.writePacket())
 		sys.stdout.flush()
 	# Types 16 and 23 are login attempts
 	elif (tds.type == 16 or tds.type == 23):
 		answer = LoginError()
-		sys.stdout.write(answer.writePacket())
+		sys.stdout.buffer.write(answer.writePacket())
 		sys.stdout.flush()
 		os.system('createNovaScriptAlert.py "' + os.getenv("HONEYD_IP_SRC") + '" "' + os.getenv("HONEYD_INTERFACE") + '" "mssql" "Mssql database login attempt"') 
 		sys.exit(0)
-
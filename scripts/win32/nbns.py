@@ -1,159 +1,199 @@
-import sys
-import binascii
-import socket
+# NetBIOS name service responder for the honeypots.
+#
+# As an external command, Honeyd starts this script for every query.
+# The name of the names database is read from the file in the second
+# argument.
+#
+# The script can also stay resident in Honeyd and answer all queries
+# without forking:
+#
+#	add template udp port 137 internal "scripts.win32.nbns"
+#
+# In that mode the names database is $HONEYD_HOME/names and the name
+# of every honeypot is allocated only once.
+
 import os
+import socket
+import sys
+from collections import deque
+from functools import lru_cache
 
 sys.path.append("/usr/share/honeyd/scripts/lib/")
+from codec import (
+	NAME_CACHE,
+	DecodeError,
+	DecodeNetbiosName,
+	DecodeQuery,
+	Message,
+	Record,
+	Reply,
+)
 from names import AddNameAllocation
 
+try:
+	import honeyd
+except ImportError:
+	# Started as an external command
+	honeyd = None
+else:
+	# Datagrams are binary, so Honeyd must not decode them
+	honeyd_delivery = honeyd.DELIVER_MEMORYVIEW
 
-#Decodes a "First Level" encoded string
-def FirstLevelDecode(encoded_str):
-	decoded = ""
-	i = 0
-	while i + 1 < len(encoded_str):
-		char1 = (ord(encoded_str[i]) - 0x41) << 4
-		char2 = ord(encoded_str[i+1]) - 0x41
-		decoded += chr(char1 + char2)
-		i += 2
-	return decoded
-
-
-our_IP = ""
-honeyd_home = ""
-if("HONEYD_HOME" in os.environ):
-	honeyd_home = os.getenv("HONEYD_HOME")
-if("HONEYD_TEMPLATE_NAME" in os.environ):
-	our_IP = os.getenv("HONEYD_TEMPLATE_NAME")
-
-#the name of the "names" file is in the file at the second parameter
-fd = open(sys.argv[2])
-names_file = fd.readline().split(" ", 1)[1].rstrip("\n")
-names_path = honeyd_home + names_file
-
-our_name = AddNameAllocation(names_path, our_IP).upper()
-if(our_name == ""):
-	sys.exit(0)
-
-#Parse the NBNS header
-
-#Read Transaction ID -> 2 bytes
-trans_ID = sys.stdin.read(2)
+#Query types that we answer
+QUERY_NB = 0x20
+QUERY_NBSTAT = 0x21
 
-#Read Flags > 2 bytes
-flags = sys.stdin.read(2)
+CLASS_IN = 1
 
-#Number of questions > 2 bytes
-questions = sys.stdin.read(2)
+#Number of recently decoded queries.  A broadcast query reaches every
+#	honeypot on the segment, so it is decoded once and then answered
+#	from here for all of them.
+QUERY_CACHE = 256
 
-#Number of answers > 2 bytes
-answers = sys.stdin.read(2)
+#Names of the honeypots in resident mode, by IP address
+allocated_names = {}
 
-#Number of Authority Resource Records -> 2 bytes
-authorities = sys.stdin.read(2)
 
-#Number of Additional Resource Records -> 2 bytes
-additionals = sys.stdin.read(2)
-
-
-#We only respond to questions. Throw anything else out
-if (int(binascii.hexlify(questions)) <= 0) or (int(binascii.hexlify(answers)) > 0):
-	sys.exit(0)
-
-
-#Parse the Question
-
-#The first byte has to be x20
-name_start = sys.stdin.read(1)
-if name_start != '\x20':
-	sys.exit(0)
-
-#Netbios name
-#	First level encoded
-i = 'a'
-name = ""
-while i != '\x00':
-	i = sys.stdin.read(1)
-	name += i
-
-original_name = name
-name = FirstLevelDecode(name)
-name = name.strip("\0")
-name = name.strip()
-
-#Type
-query_type = sys.stdin.read(2)
-
-#class
-query_class = sys.stdin.read(2)
-
-
-#If this is a forward request
-if query_type == '\x00\x20':
-	#Only repond if it was our name they wanted
-	if(our_name != name):
+#Decodes a "First Level" encoded string
+def FirstLevelDecode(encoded_str):
+	return DecodeNetbiosName(encoded_str)
+
+
+#Returns the (upper case) name of the honeypot with the given IP,
+#	or an empty string if no name could be allocated
+def AllocatedName(names_path, our_IP):
+	name = allocated_names.get(our_IP)
+	if name is None:
+		name = AddNameAllocation(names_path, our_IP)
+		if not name:
+			return b""
+		name = name.upper()
+		allocated_names[our_IP] = name
+	return name
+
+
+#Answer to a name query for our name, with the name as it was asked
+@lru_cache(maxsize=NAME_CACHE)
+def NameAnswer(wire, our_IP):
+	#flags, type == NB, class == IN, TTL = 3 days
+	#	data: flags and our address
+	return bytes(Message(0, 0x8580, [Record(wire, QUERY_NB, CLASS_IN,
+		3 * 24 * 3600, b'\x00\x00' + socket.inet_aton(our_IP))]))
+
+#Answer to a node status query, with the name as it was asked
+@lru_cache(maxsize=NAME_CACHE)
+def StatusAnswer(wire, our_name):
+	#Number of names == 1, name (ascii) (16 bytes), name flags
+	#	and empty fields at the end (46 bytes)
+	data = b'\x01' + our_name.ljust(15) + b'\x00' + b'\x04\x00' + b'\x00' * 46
+	#flags, type == NBSTAT, class == IN, TTL == 0
+	return bytes(Message(0, 0x8400, [Record(wire, QUERY_NBSTAT, CLASS_IN,
+		0, data)]))
+
+
+#Decodes an NBNS packet
+#	returns the transaction ID, the question and the decoded name,
+#	or None if this is not a question that we answer
+@lru_cache(maxsize=QUERY_CACHE)
+def ParseQuery(packet):
+	try:
+		header, questions = DecodeQuery(packet)
+	except DecodeError:
+		return None
+
+	#We only respond to questions. Throw anything else out
+	if not questions or header.ancount > 0:
+		return None
+
+	#Netbios name
+	#	First level encoded in a label of 32 bytes
+	question = questions[0]
+	if question.wire[0] != 0x20:
+		return None
+	try:
+		name = FirstLevelDecode(question.name[:32])
+	except DecodeError:
+		return None
+	name = name.strip(b"\0")
+	name = name.strip()
+	return header.id, question, name
+
+
+#Returns the response to an NBNS packet, or None if there is nothing
+#	to answer
+def Respond(packet, our_IP, our_name):
+	query = ParseQuery(bytes(packet))
+	if query is None:
+		return None
+	transaction_id, question, name = query
+
+	#If this is a forward request
+	if question.qtype == QUERY_NB:
+		#Only repond if it was our name they wanted
+		if(our_name != name):
+			return None
+		return Reply(NameAnswer(question.wire, our_IP), transaction_id)
+
+	#If this is a reverse request
+	if question.qtype == QUERY_NBSTAT:
+		return Reply(StatusAnswer(question.wire, our_name), transaction_id)
+
+	return None
+
+
+#Callbacks for the resident mode.  Honeyd calls honeyd_init for every
+#	new flow and honeyd_readdata for every datagram on it.
+
+def honeyd_init(meta):
+	honeyd_home = os.getenv("HONEYD_HOME", "")
+	state = {
+		"ip": meta["HONEYD_IP_DST"],
+		"name": AllocatedName(honeyd_home + "names", meta["HONEYD_IP_DST"]),
+		"responses": deque(),
+	}
+	honeyd.read_selector(honeyd.EVENT_ON)
+	return state
+
+def honeyd_readdata(state, data):
+	honeyd.read_selector(honeyd.EVENT_ON)
+	if state["name"]:
+		response = Respond(data, state["ip"], state["name"])
+		if response is not None:
+			state["responses"].append(response)
+			honeyd.write_selector(honeyd.EVENT_ON)
+	return 0
+
+def honeyd_writedata(state):
+	#One response per call, every write is a datagram of its own
+	responses = state["responses"]
+	if not responses:
+		return b""
+	response = responses.popleft()
+	if responses:
+		honeyd.write_selector(honeyd.EVENT_ON)
+	return response
+
+def honeyd_end(state):
+	return 0
+
+
+if __name__ == "__main__":
+	our_IP = ""
+	honeyd_home = ""
+	if("HONEYD_HOME" in os.environ):
+		honeyd_home = os.getenv("HONEYD_HOME")
+	if("HONEYD_TEMPLATE_NAME" in os.environ):
+		our_IP = os.getenv("HONEYD_TEMPLATE_NAME")
+
+	#the name of the "names" file is in the file at the second parameter
+	fd = open(sys.argv[2])
+	names_file = fd.readline().split(" ", 1)[1].rstrip("\n")
+	names_path = honeyd_home + names_file
+
+	our_name = AllocatedName(names_path, our_IP)
+	if not our_name:
 		sys.exit(0)
-		
-	#Begin forging a response
-	reponse_packet = trans_ID
-	#flags
-	reponse_packet += '\x85\x80'
-	#number of questions
-	reponse_packet += '\x00\x00'
-	#number of answers
-	reponse_packet += '\x00\x01'
-	#authority RRs
-	reponse_packet += '\x00\x00'
-	#additional RRs
-	reponse_packet += '\x00\x00'
-	#netbios name (parroted back)
-	reponse_packet += name_start + original_name
-	#type == NB
-	reponse_packet += '\x00\x20'
-	#class == IN
-	reponse_packet += '\x00\x01'
-	#TTL = 3 days
-	reponse_packet += '\x00\x03\xf4\x80'
-	#data length = 6
-	reponse_packet += '\x00\x06'
-	#flags
-	reponse_packet += '\x00\x00'
-	#Our address
-	reponse_packet += socket.inet_aton(our_IP)
-	sys.stdout.write(reponse_packet)
-
-#If this is a reverse request
-elif query_type == '\x00\x21':
-	#Begin forging a response
-	reponse_packet = trans_ID
-	#flags
-	reponse_packet += '\x84\x00'
-	#number of questions
-	reponse_packet += '\x00\x00'
-	#number of answers
-	reponse_packet += '\x00\x01'
-	#authority RRs
-	reponse_packet += '\x00\x00'
-	#additional RRs
-	reponse_packet += '\x00\x00'	
-	#netbios name (parroted back)
-	reponse_packet += name_start + original_name
-	#Type == NBSTAT
-	reponse_packet += '\x00\x21'
-	#class == IN
-	reponse_packet += '\x00\x01'
-	#TTL == 0
-	reponse_packet += '\x00\x00\x00\x00'
-	#Data Length
-	name_len = 65
-	reponse_packet += '\x00' + chr(name_len)
-	#Number of names == 1
-	reponse_packet += '\x01'
-	#Name (ascii) (16 bytes)
-	reponse_packet += our_name + ('\x20' * (15-len(our_name))) + '\x00'
-	#name flags
-	reponse_packet += '\x04\x00'
-	#Empty fields at end (46 bytes)
-	reponse_packet += '\x00' * 46
-	sys.stdout.write(reponse_packet)
 
+	response = Respond(os.read(sys.stdin.fileno(), 65535), our_IP, our_name)
+	if response is not None:
+		sys.stdout.buffer.write(response)
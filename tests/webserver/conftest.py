@@ -0,0 +1,223 @@
+#
+# Copyright (c) 2004 Niels Provos <provos@citi.umich.edu>
+# All rights reserved.
+#
+"""Fixtures for the admin webserver benchmarks.
+
+The webserver runs inside of Honeyd and imports the honeyd module that
+pyextend.c provides.  Here it is replaced by a stub that returns the same
+structures for a configurable number of connections, templates and
+interfaces, so that the pages can be driven through
+server.handle_request() without a running Honeyd.
+"""
+
+import os
+import shutil
+import sys
+import tracemalloc
+import types
+
+import pytest
+
+WEBSERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "webserver")
+sys.path.insert(0, os.path.abspath(WEBSERVER_DIR))
+
+# Number of connections, templates and interfaces that honeyd reports
+SIZES = [10, 1000, 100000]
+
+
+class HoneydStub(types.ModuleType):
+    """Stands in for the honeyd module of pyextend.c."""
+
+    def __init__(self):
+        super().__init__("honeyd")
+        self.populate(0)
+
+    def populate(self, size):
+        self.size = size
+        self.connections = {
+            proto: [
+                {
+                    "src": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                    "dst": "192.0.2.%d" % (i % 254 + 1),
+                    "sport": 1024 + i % 60000,
+                    "dport": (22, 23, 80, 443, 445)[i % 5],
+                    "received": i * 131 % 100000,
+                    "sent": i * 17 % 100000,
+                }
+                for i in range(size)
+            ]
+            for proto in ("tcp", "udp")
+        }
+        self.templates = [
+            {
+                "address": "172.%d.%d.%d"
+                % (16 + (i >> 16 & 15), i >> 8 & 255, i & 255),
+                "personality": ("Linux 2.4.20", "Windows XP SP1", "OpenBSD 3.4")[i % 3],
+                "icmp_action": "open",
+                "tcp_action": ("reset", "block", 'internal "telnet"')[i % 3],
+                "udp_action": "reset",
+                "ethernet": "00:0c:29:%02x:%02x:%02x"
+                % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            }
+            for i in range(size)
+        ]
+        self.nics = tuple(
+            {
+                "name": "eth%d" % i,
+                "address": "192.168.%d.%d" % (i >> 8 & 255, i & 255),
+                "mtu": 1500,
+                "link": "00:50:56:%02x:%02x:%02x"
+                % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            }
+            for i in range(size)
+        )
+
+    # The functions that the webserver uses
+
+    def uptime(self):
+        return 93784
+
+    def config(self):
+        return {
+            "version": "1.6",
+            "config": "config.sample",
+            "personality": "nmap.prints",
+            "xprobe": "xprobe2.conf",
+            "assoc": "nmap.assoc",
+            "osfp": "pf.os",
+        }
+
+    def interfaces(self):
+        return self.nics
+
+    def stats_network(self):
+        return {
+            "Input Bytes": (1024.0, 2048.0, 4096.0),
+            "Output Bytes": (512.0, 1024.0, 2048.0),
+        }
+
+    def config_ips(self):
+        return self.templates
+
+    def query_connections(
+        self, proto, offset=0, limit=50, src=None, dst=None, port=0, sort=None
+    ):
+        if proto not in self.connections:
+            raise ValueError("unknown protocol %s" % proto)
+        connections = self.connections[proto]
+        if port:
+            connections = [c for c in connections if port in (c["sport"], c["dport"])]
+        if sort:
+            key = sort.lstrip("-")
+            connections = sorted(
+                connections, key=lambda c: c[key], reverse=sort.startswith("-")
+            )
+        return {
+            "total": len(connections),
+            "connections": connections[offset : offset + limit],
+        }
+
+    def delete_connection(self, *args):
+        return None
+
+    def delete_template(self, name):
+        return None
+
+    def snapshot(self):
+        """Same sections and element types as pyextend_snapshot()."""
+        return {
+            "time": 1.0,
+            "uptime": self.uptime(),
+            "config": self.config(),
+            "counters": {"connects": 2 * self.size, "children": 0},
+            "network": {
+                "input_bytes": {"minute": 1024.0, "hour": 2048.0, "day": 4096.0},
+                "output_bytes": {"minute": 512.0, "hour": 1024.0, "day": 2048.0},
+            },
+            "templates": {"total": self.size + 1, "addresses": self.size},
+            "connections": {p: len(c) for p, c in self.connections.items()},
+            "interfaces": self.interfaces(),
+            "config_ips": self.config_ips(),
+        }
+
+    def raw_log(self, message):
+        pass
+
+
+stub = HoneydStub()
+sys.modules["honeyd"] = stub
+
+
+@pytest.fixture(params=SIZES, ids=lambda size: "%d" % size)
+def honeyd(request):
+    """The honeyd stub with the parametrized number of objects."""
+    stub.populate(request.param)
+    yield stub
+    stub.populate(0)
+
+
+@pytest.fixture(scope="session")
+def root(tmp_path_factory):
+    """A copy of htdocs, so that precompiled templates stay out of
+    the source tree."""
+    root = tmp_path_factory.mktemp("webserver") / "htdocs"
+    shutil.copytree(
+        os.path.join(WEBSERVER_DIR, "htdocs"),
+        root,
+        ignore=shutil.ignore_patterns("*.tmplc"),
+    )
+    return str(root)
+
+
+@pytest.fixture
+def server(root):
+    import server
+
+    return server.make_server(root)
+
+
+def parsed_request(path, method="GET", version="HTTP/1.1"):
+    """A request as pyextend.c hands it to the webserver."""
+    return {
+        "method": method,
+        "path": path,
+        "version": version,
+        "headers": [("Host", "localhost"), ("User-Agent", "benchmark")],
+        "body": b"",
+    }
+
+
+@pytest.fixture
+def fetch(server):
+    """Runs one request like Honeyd does and returns the whole response,
+    including a streamed body."""
+    import server as module
+
+    def fetch(path, version="HTTP/1.1"):
+        result, _, follow = module.handle_request(
+            server, parsed_request(path, version=version), "127.0.0.1", True
+        )
+        if follow is not None and not isinstance(follow, tuple):
+            result += b"".join(follow)
+        return result
+
+    return fetch
+
+
+@pytest.fixture
+def allocations(benchmark):
+    """Runs a function once under tracemalloc and adds the peak and the
+    retained memory to the extra info of the benchmark."""
+
+    def allocations(func, *args):
+        tracemalloc.start()
+        try:
+            func(*args)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_bytes"] = peak
+        benchmark.extra_info["retained_bytes"] = current
+
+    return allocations
@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2004 Niels Provos <provos@citi.umich.edu>
+# All rights reserved.
+#
+"""Compile and process times of the template engine."""
+
+import os
+
+import pytest
+from htmltmpl import TemplateCompiler, TemplateManager, TemplateProcessor
+
+TEMPLATES = [
+    "index.tmpl",
+    "status_stats.tmpl",
+    "status_connections.tmpl",
+    "config_ip.tmpl",
+]
+
+
+def template_path(root, name):
+    return os.path.join(root, "templates", name)
+
+
+@pytest.mark.parametrize("name", TEMPLATES)
+def test_compile(benchmark, root, name):
+    compiler = TemplateCompiler()
+    benchmark(compiler.compile, template_path(root, name))
+
+
+@pytest.mark.parametrize("name", TEMPLATES)
+def test_compile_program(benchmark, root, name):
+    template = TemplateCompiler().compile(template_path(root, name))
+    processor = TemplateProcessor()
+    benchmark(processor.compile_program, template.tokens())
+
+
+@pytest.mark.parametrize("name", TEMPLATES)
+def test_load_precompiled(benchmark, root, name):
+    path = template_path(root, name)
+    manager = TemplateManager(cache_timeout=None)
+    manager.precompile_all([path])
+    template = benchmark(manager.prepare, path)
+    assert template.is_uptodate()
+
+
+@pytest.mark.parametrize("name", TEMPLATES)
+def test_prepare_cached(benchmark, root, name):
+    path = template_path(root, name)
+    manager = TemplateManager()
+    manager.prepare(path)
+    benchmark(manager.prepare, path)
+
+
+def render(template, variables, method, html_escape):
+    processor = TemplateProcessor(html_escape)
+    for name, value in variables.items():
+        processor.set(name, value)
+    if method == "process":
+        return processor.process(template)
+    return "".join(processor.generate(template))
+
+
+@pytest.mark.parametrize("html_escape", [0, 1], ids=["raw", "escaped"])
+@pytest.mark.parametrize("method", ["process", "generate"])
+def test_process_connections(benchmark, honeyd, root, allocations, method, html_escape):
+    template = TemplateManager().prepare(template_path(root, "status_connections.tmpl"))
+    variables = {"Connections": honeyd.connections["tcp"], "proto": "tcp"}
+    allocations(render, template, variables, method, html_escape)
+    benchmark(render, template, variables, method, html_escape)
+
+
+@pytest.mark.parametrize("html_escape", [0, 1], ids=["raw", "escaped"])
+@pytest.mark.parametrize("method", ["process", "generate"])
+def test_process_config_ips(benchmark, honeyd, root, allocations, method, html_escape):
+    template = TemplateManager().prepare(template_path(root, "config_ip.tmpl"))
+    variables = {"Ips": honeyd.templates, "title": "Bound IP addresses"}
+    allocations(render, template, variables, method, html_escape)
+    result = benchmark(render, template, variables, method, html_escape)
+    assert result.count("edit_ip=") == honeyd.size
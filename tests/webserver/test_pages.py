@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2004 Niels Provos <provos@citi.umich.edu>
+# All rights reserved.
+#
+"""End-to-end latency of the admin pages and of the tables in support.py.
+
+Run with
+
+    python -m pytest tests/webserver --benchmark-only
+
+Each benchmark runs for 10, 1000 and 100000 connections, templates and
+interfaces.  The peak and retained memory of a single run are stored in
+the extra info of the benchmark.
+"""
+
+import pytest
+import server
+import support
+
+
+@pytest.mark.parametrize("path", ["/index.py", "/config.py"])
+def test_page(benchmark, honeyd, fetch, allocations, path):
+    allocations(fetch, path)
+    response = benchmark(fetch, path)
+    assert response.startswith(b"HTTP/1.1 200")
+    assert b"Transfer-Encoding: chunked" in response
+    assert response.endswith(b"0\r\n\r\n")
+
+
+@pytest.mark.parametrize("path", ["/index.py", "/config.py"])
+def test_page_http10(benchmark, honeyd, fetch, path):
+    response = benchmark(fetch, path, "HTTP/1.0")
+    assert b"Content-Length: " in response
+
+
+@pytest.mark.parametrize("path", ["/api/", "/api/connections/tcp?limit=1000"])
+def test_api(benchmark, honeyd, fetch, allocations, path):
+    allocations(fetch, path)
+    response = benchmark(fetch, path)
+    assert response.startswith(b"HTTP/1.1 200")
+
+
+def test_interface_table(benchmark, honeyd, allocations):
+    allocations(support.interface_table)
+    table = benchmark(support.interface_table)
+    assert table.count("<td>eth") == honeyd.size
+
+
+def test_config_table(benchmark, honeyd):
+    benchmark(support.config_table)
+
+
+def test_stats_table(benchmark, honeyd, root):
+    benchmark(support.stats_table, root)
+
+
+def test_config_ips(benchmark, honeyd, root, allocations):
+    def config_ips():
+        return "".join(support.config_ips(root))
+
+    allocations(config_ips)
+    table = benchmark(config_ips)
+    assert table.count("edit_ip=") == honeyd.size
+
+
+@pytest.mark.parametrize(
+    "query",
+    [None, {"tcp_sort": "-received"}, {"tcp_port": "80", "tcp_offset": "50"}],
+    ids=["default", "sorted", "filtered"],
+)
+def test_status_connections(benchmark, honeyd, root, query):
+    benchmark(support.status_connections, root, "tcp", query)
+
+
+def test_server_test(honeyd, root, capsys):
+    server.test(root)
+    out = capsys.readouterr().out
+    assert "HTTP/1.1 200" in out
+    assert "HTTP/1.1 404" in out
@@ -73,6 +73,7 @@ char *strnsep(char **, const char *);
 
 int ui_command_help(struct evbuffer *, char *);
 int ui_command_python(struct evbuffer *, char *);
+int ui_command_reload(struct evbuffer *, char *);
 
 struct ui_command {
 	const char *cmd;
@@ -94,6 +95,12 @@ struct ui_command commands[] = {
 		"! <command >",
 		ui_command_python
 	},
+	{
+		"reload",
+		"reload\t\t reloads changed Python modules\n",
+		"reload\n",
+		ui_command_reload
+	},
 	{
 		"delete",
 		"delete\t\t removes configured templates and ports\n",
@@ -172,6 +179,23 @@ ui_command_python(struct evbuffer *buf, char *line)
 	return (0);
 }
 
+int
+ui_command_reload(struct evbuffer *buf, char *line)
+{
+#ifndef HAVE_PYTHON
+	const char *error_python = 
+	    "Error: Honeyd has been compiled without Python support.\n";
+	evbuffer_add(buf, error_python, strlen(error_python));
+#else
+	char output[128];
+
+	snprintf(output, sizeof(output), "Reloaded %d Python modules.\n",
+	    pyextend_reload());
+	evbuffer_add(buf, output, strlen(output));
+#endif
+	return (0);
+}
+
 int
 ui_command_help(struct evbuffer *buf, char *line)
 {
@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2004 Niels Provos <provos@citi.umich.edu>
+# All rights reserved.
+#
+"""Machine readable views of the Honeyd state.
+
+    /api/                      the complete snapshot
+    /api/<section>             one section of the snapshot, e.g. counters,
+                               network, templates, connections or config_ips
+    /api/connections/<proto>   connections; accepts offset, limit, src, dst,
+                               port and sort like honeyd.query_connections
+                               and returns the current page
+
+All views are taken from a single honeyd.snapshot() call.  They are
+returned as JSON, or as newline delimited JSON if the query string has
+format=ndjson or the client accepts application/x-ndjson.  In NDJSON,
+lists have one element per line and the snapshot one section per line.
+"""
+
+import json
+import sys
+import urllib.parse
+
+import honeyd
+
+JSON_TYPE = "application/json"
+NDJSON_TYPE = "application/x-ndjson"
+
+
+class NotFound(Exception):
+    pass
+
+
+def encode(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def ndjson(value, name=None):
+    """Yields the lines that represent value in NDJSON."""
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            yield encode(item)
+    elif name is None and isinstance(value, dict):
+        for key, item in value.items():
+            yield encode({"section": key, "data": item})
+    else:
+        yield encode(value)
+
+
+# Largest value of the numeric parameters of query_connections
+CONNECTION_LIMITS = {"offset": sys.maxsize, "limit": sys.maxsize, "port": 65535}
+
+
+def connections(proto, query):
+    kwargs = {}
+    for name, maximum in CONNECTION_LIMITS.items():
+        if name in query:
+            kwargs[name] = int(query[name])
+            if not 0 <= kwargs[name] <= maximum:
+                raise ValueError("%s out of range" % name)
+    for name in ("src", "dst", "sort"):
+        if name in query:
+            kwargs[name] = query[name]
+    return honeyd.query_connections(proto, **kwargs)
+
+
+def lookup(path, query):
+    """Returns the name and value of the view at path."""
+    words = [word for word in path.split("/") if word][1:]
+    if len(words) == 2 and words[0] == "connections":
+        return words[1], connections(words[1], query)["connections"]
+
+    snapshot = honeyd.snapshot()
+    if not words:
+        return None, snapshot
+    if len(words) == 1 and words[0] in snapshot:
+        return words[0], snapshot[words[0]]
+    raise NotFound("unknown view %s" % path)
+
+
+def wants_ndjson(request, query):
+    if "format" in query:
+        return query["format"] == "ndjson"
+    accept = request.headers.get("Accept", "")
+    return NDJSON_TYPE in accept and JSON_TYPE not in accept
+
+
+def handle(request):
+    """Answers a GET or HEAD request for the /api/ tree."""
+    path, _, query = request.path.partition("?")
+    query = dict(urllib.parse.parse_qsl(query))
+
+    try:
+        name, value = lookup(path, query)
+    except NotFound as e:
+        request.send_error(404, str(e))
+        return
+    except ValueError as e:
+        request.send_error(400, str(e))
+        return
+
+    request.send_response(200)
+    request.send_header("Cache-Control", "no-cache")
+    if wants_ndjson(request, query):
+        # One line per record, sent as the client reads them
+        request.send_header("Content-Type", NDJSON_TYPE)
+        request.send_stream(line + "\n" for line in ndjson(value, name))
+        request.send_page(b"")
+    else:
+        request.send_header("Content-Type", JSON_TYPE)
+        request.send_page((encode(value) + "\n").encode())
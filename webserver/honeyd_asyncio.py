@@ -0,0 +1,248 @@
+"""Runs asyncio based services inside of Honeyd.
+
+A Python module that is bound to a port with
+
+    add template tcp port 23 internal "telnet"
+
+may define a coroutine
+
+    async def handle(reader, writer, meta):
+        ...
+
+instead of the honeyd_init, honeyd_readdata, honeyd_writedata and
+honeyd_end callbacks.  The reader and writer behave like those of
+asyncio.start_server(), including writer.drain() for flow control.
+meta is the dictionary that honeyd_init receives, plus a "log" function
+that writes to the service log of this connection.
+
+All handlers share a single event loop that is stepped from Honeyd's
+own event loop.  Callbacks that become ready while Honeyd processes
+network events are run together in the next step, so the loop never
+blocks and many connections are handled in one pass.
+"""
+
+import asyncio
+import heapq
+import traceback
+
+import honeyd
+
+# Maximum amount of buffered input before we stop reading
+READ_LIMIT = 2**16
+
+# Default write buffer limits for drain()
+WRITE_HIGH = 2**16
+WRITE_LOW = 2**14
+
+
+class HoneydEventLoop(asyncio.SelectorEventLoop):
+    """An event loop that does not run by itself.  Instead it asks Honeyd
+    to call back whenever there is something to do."""
+
+    def __init__(self):
+        super().__init__()
+        self._step_pending = False
+        self._wakeups = []
+        self._wakeup_at = None
+
+    def call_soon(self, callback, *args, context=None):
+        handle = super().call_soon(callback, *args, context=context)
+        if not self._step_pending:
+            self._step_pending = True
+            honeyd.call_later(0, self._step)
+        return handle
+
+    def call_at(self, when, callback, *args, context=None):
+        handle = super().call_at(when, callback, *args, context=context)
+        heapq.heappush(self._wakeups, when)
+        self._arm()
+        return handle
+
+    def _arm(self):
+        if not self._wakeups:
+            return
+        when = self._wakeups[0]
+        if self._wakeup_at is not None and self._wakeup_at <= when:
+            return
+        self._wakeup_at = when
+        honeyd.call_later(max(0, when - self.time()), self._wakeup)
+
+    def _wakeup(self):
+        # Timers that have been replaced by earlier ones still fire
+        self._wakeup_at = None
+        now = self.time()
+        while self._wakeups and self._wakeups[0] <= now:
+            heapq.heappop(self._wakeups)
+        self._step()
+        self._arm()
+
+    def _step(self):
+        self._step_pending = False
+        if self.is_running():
+            return
+        # Runs everything that is ready right now, but does not wait
+        super().call_soon(self.stop)
+        self.run_forever()
+
+
+_loop = None
+
+
+def _get_loop():
+    global _loop
+    if _loop is None:
+        _loop = HoneydEventLoop()
+    return _loop
+
+
+class HoneydTransport(asyncio.Transport):
+    """Connects a StreamReader and StreamWriter to a Honeyd connection."""
+
+    def __init__(self, loop, meta):
+        super().__init__()
+        self._loop = loop
+        self._handle = honeyd.connection()
+        self._extra = {
+            "peername": (meta["HONEYD_IP_SRC"], meta["HONEYD_SRC_PORT"]),
+            "sockname": (meta["HONEYD_IP_DST"], meta["HONEYD_DST_PORT"]),
+            "honeyd": meta,
+        }
+        self._buffer = []
+        self._size = 0
+        self._closing = False
+        self._lost = False
+        self._reading = True
+        self._paused = False
+        self._high = WRITE_HIGH
+        self._low = WRITE_LOW
+
+        self._reader = asyncio.StreamReader(limit=READ_LIMIT, loop=loop)
+        self._protocol = asyncio.StreamReaderProtocol(self._reader, loop=loop)
+        self._protocol.connection_made(self)
+        self._writer = asyncio.StreamWriter(self, self._protocol, self._reader, loop)
+
+        honeyd.read_selector(honeyd.EVENT_ON, self._handle)
+
+    def start(self, handle, meta):
+        meta = dict(meta, log=self.log)
+        task = self._loop.create_task(handle(self._reader, self._writer, meta))
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            traceback.print_exception(task.exception())
+        self.close()
+
+    def log(self, line):
+        if not self._lost:
+            honeyd.log(line, self._handle)
+
+    # Called by Honeyd
+
+    def data_received(self, data):
+        if self._lost:
+            return
+        self._protocol.data_received(bytes(data))
+        if self._reading:
+            honeyd.read_selector(honeyd.EVENT_ON, self._handle)
+
+    def data_wanted(self):
+        if not self._buffer:
+            return None if self._closing else []
+
+        data, self._buffer, self._size = self._buffer, [], 0
+        if self._paused:
+            self._paused = False
+            self._protocol.resume_writing()
+        if self._closing:
+            # Come back once more to close the connection
+            honeyd.write_selector(honeyd.EVENT_ON, self._handle)
+        return data
+
+    def connection_lost(self):
+        self._lost = True
+        self._closing = True
+        self._buffer, self._size = [], 0
+        self._protocol.connection_lost(None)
+
+    # asyncio.Transport interface
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        honeyd.write_selector(honeyd.EVENT_ON, self._handle)
+
+    def abort(self):
+        self._buffer, self._size = [], 0
+        self.close()
+
+    def is_reading(self):
+        return self._reading and not self._lost
+
+    def pause_reading(self):
+        if self._reading and not self._lost:
+            self._reading = False
+            honeyd.read_selector(honeyd.EVENT_OFF, self._handle)
+
+    def resume_reading(self):
+        if not self._reading and not self._lost:
+            self._reading = True
+            honeyd.read_selector(honeyd.EVENT_ON, self._handle)
+
+    def write(self, data):
+        if self._closing or not data:
+            return
+        self._buffer.append(bytes(data))
+        self._size += len(data)
+        honeyd.write_selector(honeyd.EVENT_ON, self._handle)
+        if not self._paused and self._size > self._high:
+            self._paused = True
+            self._protocol.pause_writing()
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return self._size
+
+    def get_write_buffer_limits(self):
+        return (self._low, self._high)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = WRITE_HIGH if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self._high, self._low = high, low
+
+
+def service(handle):
+    """Returns the Honeyd callbacks for an asyncio handle() coroutine."""
+
+    def honeyd_init(meta):
+        transport = HoneydTransport(_get_loop(), meta)
+        transport.start(handle, meta)
+        return transport
+
+    def honeyd_readdata(transport, data):
+        transport.data_received(data)
+
+    def honeyd_writedata(transport):
+        return transport.data_wanted()
+
+    def honeyd_end(transport):
+        transport.connection_lost()
+
+    return {
+        "honeyd_init": honeyd_init,
+        "honeyd_readdata": honeyd_readdata,
+        "honeyd_writedata": honeyd_writedata,
+        "honeyd_end": honeyd_end,
+    }
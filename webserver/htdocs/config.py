@@ -1,30 +1,35 @@
 import support
-from htmltmpl import TemplateManager, TemplateProcessor
+from htmltmpl import Chunks, TemplateManager, TemplateProcessor
 
-request.send_response(200)
-request.send_header("Content-Type", "text/html")
-request.send_nocache()
-request.end_headers()
 
-# Process commands given to us
-message = support.parse_query(request.query)
+def content(request):
+    """Yields the tables of the page; each is produced when it is sent."""
+    yield "Welcome to the Honeyd Configuration Interface.<p>"
+    yield support.config_table()
+    yield "<p>"
+    yield from support.config_ips(request.root)
 
-# Compile or load already precompiled template.
-template = TemplateManager().prepare(request.root + "/templates/index.tmpl")
-tproc = TemplateProcessor(0)
 
-# Set the title.
-tproc.set("title", "Honeyd Configuration Interface")
+def handle(request):
+    request.send_response(200)
+    request.send_header("Content-Type", "text/html")
+    request.send_nocache()
+    request.end_headers()
 
-content = "Welcome to the Honeyd Configuration Interface.<p>"
-content += support.config_table()
-content += "<p>"
-content += support.config_ips(request.root)
+    # Process commands given to us
+    message = support.parse_query(request.query)
 
-if message:
-    tproc.set("message", message)
-tproc.set("content", content)
-tproc.set("uptime", support.uptime())
+    # Compile or load already precompiled template.
+    template = TemplateManager().prepare(request.root + "/templates/index.tmpl")
+    tproc = TemplateProcessor(0)
 
-# Print the processed template.
-request.wfile.write(tproc.process(template).encode('utf-8'))
+    # Set the title.
+    tproc.set("title", "Honeyd Configuration Interface")
+
+    if message:
+        tproc.set("message", message)
+    tproc.set("content", Chunks(content(request)))
+    tproc.set("uptime", support.uptime())
+
+    # Send the page while it is processed.
+    request.send_stream(tproc.generate(template))
@@ -1,49 +1,60 @@
 import support
-from htmltmpl import TemplateManager, TemplateProcessor
-
-request.send_response(200)
-request.send_header("Content-Type", "text/html")
-request.send_nocache()
-request.end_headers()
-
-# Compile or load already precompiled template.
-template = TemplateManager().prepare(request.root + "/templates/index.tmpl")
-tproc = TemplateProcessor(0)
-
-# Process commands given to us
-message = support.parse_query(request.query)
-
-# Set the title.
-tproc.set("title", "Honeyd Administration Interface")
-
-# Visitor counter (persisted in globals)
-if 'counter' not in globals():
-    counter = 0
-counter += 1
-
-greeting = (
-    "Welcome to the Honeyd Administration Interface.You are visitor %d.<p>"
-) % counter
-
-content = support.interface_table()
-content += "<p>" + support.stats_table(request.root) + "</p>\n"
-content += "<p>" + support.status_connections(request.root, "tcp") + "</p>\n"
-content += "<p>" + support.status_connections(request.root, "udp") + "</p>\n"
-
-side_content = (
-    "<div class=graphs>"
-    "<img height=155 width=484 src=/graphs/traffic_hourly.gif><br>"
-    "<img height=155 width=484 src=/graphs/traffic_daily.gif>"
-    "</div>"
-)
-
-if message:
-    tproc.set("message", message)
-
-tproc.set("greeting", greeting)
-tproc.set("content", content)
-tproc.set("side_content", side_content)
-tproc.set("uptime", support.uptime())
-
-# Print the processed template.
-request.wfile.write(tproc.process(template).encode('utf-8'))
+from htmltmpl import Chunks, TemplateManager, TemplateProcessor
+
+# Visitor counter, kept between requests
+counter = 0
+
+
+def content(request):
+    """Yields the tables of the page; each is produced when it is sent."""
+    yield support.interface_table()
+    yield "<p>" + support.stats_table(request.root) + "</p>\n"
+    for which in ("tcp", "udp"):
+        connections = support.status_connections(request.root, which, request.query)
+        yield "<p>" + connections + "</p>\n"
+
+
+def handle(request):
+    global counter
+
+    request.send_response(200)
+    request.send_header("Content-Type", "text/html")
+    request.send_nocache()
+    request.end_headers()
+
+    # Compile or load already precompiled template.
+    template = TemplateManager().prepare(request.root + "/templates/index.tmpl")
+    tproc = TemplateProcessor(0)
+
+    # Process commands given to us
+    message = support.parse_query(request.query)
+
+    # Set the title.
+    tproc.set("title", "Honeyd Administration Interface")
+
+    counter += 1
+
+    greeting = (
+        "Welcome to the Honeyd Administration Interface.You are visitor %d.<p>"
+    ) % counter
+
+    side_content = (
+        "<div class=graphs>"
+        "<img height=155 width=484 src=/graphs/traffic_hourly.gif><br>"
+        "<img height=155 width=484 src=/graphs/traffic_daily.gif>"
+        "</div>"
+        "<div class=status><h1>Live Activity</h1>"
+        "<table id=events></table></div>"
+        "<script src=/scripts/events.js></script>"
+    )
+
+    if message:
+        tproc.set("message", message)
+
+    tproc.set("greeting", greeting)
+    tproc.set("content", Chunks(content(request)))
+    tproc.set("side_content", side_content)
+    tproc.set("uptime", support.uptime())
+
+    # Send the page while it is processed.
+    request.send_stream(tproc.generate(template))
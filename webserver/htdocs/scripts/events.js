@@ -0,0 +1,29 @@
+// Shows the probes and flows that Honeyd reports at /events as they happen
+(function () {
+	var table = document.getElementById("events");
+	var names = { probe: "Probe", flownew: "New", flowend: "End" };
+	var rows = 20;
+
+	if (table == null || !window.EventSource)
+		return;
+
+	function add(text) {
+		var row = table.insertRow(0);
+		row.insertCell(0).textContent = new Date().toLocaleTimeString();
+		row.insertCell(1).textContent = text;
+		while (table.rows.length > rows)
+			table.deleteRow(table.rows.length - 1);
+	}
+
+	var source = new EventSource("/events");
+	Object.keys(names).forEach(function (name) {
+		source.addEventListener(name, function (e) {
+			var ev = JSON.parse(e.data);
+			add(names[name] + " " + ev.proto + " " +
+			    ev.src + ":" + ev.sport + " - " + ev.dst + ":" + ev.dport);
+		});
+	});
+	source.addEventListener("dropped", function (e) {
+		add(JSON.parse(e.data).dropped + " events dropped");
+	});
+})();
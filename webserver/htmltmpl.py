@@ -39,10 +39,14 @@ import os.path
 import pprint  # only for debugging
 import sys
 import copy
+import functools
 import html  # for HTML escaping of variables
-import urllib  # for URL escaping of variables
-import pickle
+import urllib.parse  # for URL escaping of variables
+import marshal
+import mmap
+import struct
 import gettext
+import time
 
 INCLUDE_DIR = "inc"
 
@@ -56,6 +60,33 @@ PARAM_ESCAPE = 2
 PARAM_GLOBAL = 3
 PARAM_GETTEXT_STRING = 1
 
+# Number of escaped values that are remembered. Table rows repeat the
+# same addresses, personalities and actions over and over.
+ESCAPE_CACHE = 4096
+
+# Only values up to this length are remembered; longer ones, like log
+# excerpts, rarely repeat and would only keep large strings alive.
+ESCAPE_CACHE_LENGTH = 256
+
+# Precompiled templates start with a header of magic string, version of
+# the file format, version of the marshal format and size of the metadata.
+PRECOMPILED_MAGIC = b"htmltmpl"
+PRECOMPILED_FORMAT = 1
+PRECOMPILED_HEADER = struct.Struct("<8sHHI")
+
+# Default number of seconds for which TemplateManager trusts a template
+# in its in-memory cache before it checks the modification times again.
+CACHE_TIMEOUT = 5
+
+# Number of pieces of output that TemplateProcessor.generate() collects
+# before it yields them as one chunk.
+STREAM_PIECES = 256
+
+# Compiled templates shared by all instances of TemplateManager in this
+# process. Keys are (absolute path, compile parameters), values are
+# [template, time of the last modification time check].
+TEMPLATE_CACHE = {}
+
 # Find a way to lock files. Currently implemented only for UNIX and windows.
 LOCKTYPE_FCNTL = 1
 LOCKTYPE_MSVCRT = 2
@@ -75,6 +106,147 @@ LOCK_EX = 1
 LOCK_SH = 2
 LOCK_UN = 3
 
+
+def magic_value(var, loop_pass, loop_total):
+    """Resolve and return value of a magic variable.
+    Raise an exception if the magic variable is not recognized.
+
+    @hidden
+    """
+    if var == "__FIRST__":
+        if loop_pass == 0:
+            return 1
+        else:
+            return 0
+    elif var == "__LAST__":
+        if loop_pass == loop_total - 1:
+            return 1
+        else:
+            return 0
+    elif var == "__INNER__":
+        # If this is neither the first nor the last pass.
+        if loop_pass != 0 and loop_pass != loop_total - 1:
+            return 1
+        else:
+            return 0
+    elif var == "__PASS__":
+        # Magic variable __PASS__ counts passes from one.
+        return loop_pass + 1
+    elif var == "__PASSTOTAL__":
+        return loop_total
+    elif var == "__ODD__":
+        # Internally pass numbers stored in loop_pass are counted from
+        # zero. But the template language presents them counted from one.
+        # Therefore we must add one to the actual loop_pass value to get
+        # the value we present to the user.
+        if (loop_pass + 1) % 2 != 0:
+            return 1
+        else:
+            return 0
+    elif var.startswith("__EVERY__"):
+        # Magic variable __EVERY__x is never true in first or last pass.
+        if loop_pass != 0 and loop_pass != loop_total - 1:
+            # Check if an integer follows the variable name.
+            try:
+                every = int(var[9:])  # nine is length of "__EVERY__"
+            except ValueError:
+                raise TemplateError("Magic variable __EVERY__x: Invalid pass number.")
+            else:
+                if not every:
+                    raise TemplateError(
+                        "Magic variable __EVERY__x: Pass number cannot be zero."
+                    )
+                elif (loop_pass + 1) % every == 0:
+                    return 1
+                else:
+                    return 0
+        else:
+            return 0
+    else:
+        raise TemplateError("Invalid magic variable '%s'." % var)
+
+
+@functools.lru_cache(maxsize=ESCAPE_CACHE)
+def _escape_html(value):
+    return html.escape(value, quote=True)
+
+
+@functools.lru_cache(maxsize=ESCAPE_CACHE)
+def _escape_url(value):
+    return urllib.parse.quote_plus(value)
+
+
+def escape_html(value):
+    """Return the string value with HTML special characters and quotes
+    replaced by entities.
+    """
+    if len(value) > ESCAPE_CACHE_LENGTH:
+        return html.escape(value, quote=True)
+    return _escape_html(value)
+
+
+def escape_url(value):
+    """Return the string value quoted for use in a URL."""
+    if len(value) > ESCAPE_CACHE_LENGTH:
+        return urllib.parse.quote_plus(value)
+    return _escape_url(value)
+
+
+def stream_block(block, out, scopes, passes, pieces):
+    """Run a compiled block like TemplateProcessor.render() does, but
+    yield the output collected in out whenever it has grown to pieces
+    strings. Nodes that can produce a lot of output have a generator
+    in their stream attribute.
+
+    @hidden
+    """
+    append = out.append
+    for node in block:
+        stream = getattr(node, "stream", None)
+        if stream is None:
+            node(append, scopes, passes)
+        else:
+            yield from stream(out, scopes, passes, pieces)
+        if len(out) >= pieces:
+            chunk = "".join(out)
+            out.clear()
+            if chunk:
+                yield chunk
+
+
+##############################################
+#              CLASS: Chunks                 #
+##############################################
+
+
+class Chunks:
+    """Value of a template variable that is produced piece by piece.
+
+    Wrap an iterable of strings in this class and pass it to
+    <em>TemplateProcessor.set()</em> like a scalar. The method
+    <em>process()</em> joins the pieces. The method <em>generate()</em>
+    yields each of them as a chunk if the variable is used outside of
+    loops, so that the value is never held in memory as a whole.
+    The iterable is consumed by the first <em>TMPL_VAR</em> that refers
+    to it.
+    """
+
+    def __init__(self, iterable):
+        """Constructor.
+
+        @header __init__(iterable)
+
+        @param iterable Strings that form the value of the variable.
+        """
+        self._iterable = iterable
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def __str__(self):
+        return "".join(map(str, self._iterable))
+
+
 ##############################################
 #          CLASS: TemplateManager            #
 ##############################################
@@ -91,13 +263,20 @@ class TemplateManager:
     """
 
     def __init__(
-        self, include=1, max_include=5, precompile=1, comments=1, gettext=0, debug=0
+        self,
+        include=1,
+        max_include=5,
+        precompile=1,
+        comments=1,
+        gettext=0,
+        debug=0,
+        cache_timeout=CACHE_TIMEOUT,
     ):
         """Constructor.
 
         @header
         __init__(include=1, max_include=5, precompile=1, comments=1,
-                 gettext=0, debug=0)
+                 gettext=0, debug=0, cache_timeout=CACHE_TIMEOUT)
 
         @param include Enable or disable included templates.
         This optional parameter can be used to enable or disable
@@ -150,6 +329,17 @@ class TemplateManager:
         This optional parameter is a flag that can be used to enable
         or disable debugging messages which are printed to the standard
         error output. The debugging messages are disabled by default.
+
+        @param cache_timeout Seconds between up-to-date checks of cached
+        templates.
+        Compiled templates are kept in memory and shared by all instances
+        of this class in the process, so that repeated calls to
+        <em>prepare()</em> neither parse the template nor load its
+        precompiled form. A cached template is returned without looking
+        at the disk for this many seconds; after that the modification
+        times of the template and all included templates are compared
+        again. Zero checks on every call and <em>None</em> disables the
+        cache. The default is CACHE_TIMEOUT.
         """
         # Save the optional parameters.
         # These values are not modified by any method.
@@ -159,6 +349,7 @@ class TemplateManager:
         self._comments = comments
         self._gettext = gettext
         self._debug = debug
+        self._cache_timeout = cache_timeout
 
         # Find what module to use to lock files.
         # File locking is necessary for the 'precompile' feature to be
@@ -186,6 +377,11 @@ class TemplateManager:
         If precompilation is disabled, then this method parses and
         compiles the template.
 
+        Unless the in-memory cache is disabled, the compiled template is
+        kept in TEMPLATE_CACHE and returned by later calls for the same
+        file and compile parameters until its modification times change.
+        They are checked at most once every <em>cache_timeout</em> seconds.
+
         @header prepare(file)
 
         @return Compiled template.
@@ -199,39 +395,25 @@ class TemplateManager:
         be placed in subdirectory <strong>'inc'</strong> of the
         directory in which the main template file is located.
         """
-        compiled = None
-        if self._precompile:
-            if self.is_precompiled(file):
-                try:
-                    precompiled = self.load_precompiled(file)
-                except PrecompiledError as template:
-                    print(
-                        "Htmltmpl: bad precompiled template '%s' removed" % template,
-                        file=sys.stderr,
-                    )
-                    compiled = self.compile(file)
-                    self.save_precompiled(compiled)
-                else:
-                    precompiled.debug(self._debug)
-                    compile_params = (
-                        self._include,
-                        self._max_include,
-                        self._comments,
-                        self._gettext,
-                    )
-                    if precompiled.is_uptodate(compile_params):
-                        self.DEB("PRECOMPILED: UPTODATE")
-                        compiled = precompiled
-                    else:
-                        self.DEB("PRECOMPILED: NOT UPTODATE")
-                        compiled = self.update(precompiled)
-            else:
-                self.DEB("PRECOMPILED: NOT PRECOMPILED")
-                compiled = self.compile(file)
-                self.save_precompiled(compiled)
-        else:
-            self.DEB("PRECOMPILATION DISABLED")
-            compiled = self.compile(file)
+        if self._cache_timeout is None:
+            return self.load(file)
+
+        key = self.cache_key(file)
+        now = time.time()
+        cached = TEMPLATE_CACHE.get(key)
+        if cached is not None:
+            template, checked = cached
+            if now - checked < self._cache_timeout:
+                self.DEB("CACHED")
+                return template
+            if template.is_uptodate(key[1]):
+                self.DEB("CACHED: UPTODATE")
+                cached[1] = now
+                return template
+            self.DEB("CACHED: NOT UPTODATE")
+
+        compiled = self.load(file)
+        TEMPLATE_CACHE[key] = [compiled, now]
         return compiled
 
     def update(self, template):
@@ -256,8 +438,40 @@ class TemplateManager:
         updated = self.compile(template.file())
         if self._precompile:
             self.save_precompiled(updated)
+        if self._cache_timeout is not None:
+            TEMPLATE_CACHE[self.cache_key(template.file())] = [updated, time.time()]
         return updated
 
+    def precompile_all(self, files):
+        """Compile, check and save a set of templates in one pass.
+
+        This method is meant to be run when the templates are installed.
+        Every template is compiled, including the templates it includes,
+        checked for unmatched or missing statements and saved in its
+        precompiled form, even if an up-to-date one exists. An error
+        in one template does not stop the pass.
+
+        @header precompile_all(files)
+
+        @return List of (file, error) pairs of the templates that failed.
+        Error is the description of the problem. The list is empty if
+        all templates were precompiled.
+
+        @param files Paths to the template files to precompile.
+        """
+        check = TemplateProcessor()
+        failed = []
+        for file in files:
+            try:
+                compiled = self.compile(file)
+                check.compile_program(compiled.tokens())
+                self.save_precompiled(compiled)
+            except TemplateError as error:
+                failed.append((file, str(error)))
+            else:
+                self.DEB("PRECOMPILED: " + file)
+        return failed
+
     ##############################################
     #              PRIVATE METHODS               #
     ##############################################
@@ -269,6 +483,50 @@ class TemplateManager:
         if self._debug:
             print(str, file=sys.stderr)
 
+    def compile_params(self):
+        """Return the parameters that a compiled template depends on.
+        @hidden
+        """
+        return (self._include, self._max_include, self._comments, self._gettext)
+
+    def cache_key(self, file):
+        """Return the key of a template in TEMPLATE_CACHE.
+        @hidden
+        """
+        return (os.path.abspath(file), self.compile_params())
+
+    def load(self, file):
+        """Load the template from its precompiled form or compile it.
+        @hidden
+        """
+        compiled = None
+        if self._precompile:
+            if self.is_precompiled(file):
+                try:
+                    precompiled = self.load_precompiled(file)
+                except PrecompiledError as template:
+                    print(
+                        "Htmltmpl: bad precompiled template '%s' removed" % template,
+                        file=sys.stderr,
+                    )
+                    compiled = self.compile(file)
+                    self.save_precompiled(compiled)
+                else:
+                    if precompiled.is_uptodate(self.compile_params()):
+                        self.DEB("PRECOMPILED: UPTODATE")
+                        compiled = precompiled
+                    else:
+                        self.DEB("PRECOMPILED: NOT UPTODATE")
+                        compiled = self.update(precompiled)
+            else:
+                self.DEB("PRECOMPILED: NOT PRECOMPILED")
+                compiled = self.compile(file)
+                self.save_precompiled(compiled)
+        else:
+            self.DEB("PRECOMPILATION DISABLED")
+            compiled = self.compile(file)
+        return compiled
+
     def lock_file(self, file, lock):
         """Provide platform independent file locking.
         @hidden
@@ -319,8 +577,13 @@ class TemplateManager:
     def load_precompiled(self, file):
         """Load precompiled template from disk.
 
+        The file is mapped into memory. Only the metadata is unmarshalled
+        until it is known that the template is up-to-date; the tokens of
+        an outdated template are not loaded at all.
+
         Remove the precompiled template file and recompile it
-        if the file contains corrupted or unpicklable data.
+        if the file contains corrupted data or data written by
+        another version of the format or of Python.
 
         @hidden
         """
@@ -332,14 +595,17 @@ class TemplateManager:
             try:
                 file = open(filename, "rb")
                 self.lock_file(file, LOCK_SH)
-                precompiled = pickle.load(file)
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                with data, memoryview(data) as view:
+                    precompiled = self.unmarshal_precompiled(view)
             except IOError as e:
                 errno, errstr = e.args
                 raise TemplateError(
                     "IO error in load precompiled "
                     "template '%s': (%d) %s" % (filename, errno, errstr)
                 )
-            except pickle.UnpicklingError:
+            except (ValueError, EOFError, TypeError, KeyError, struct.error):
+                # Bad header, bad marshal data or an empty file.
                 remove_bad = 1
                 raise PrecompiledError(filename)
             except:
@@ -355,6 +621,29 @@ class TemplateManager:
                 # X: We may lose the original exception here, raising OSError.
                 os.remove(filename)
 
+    def unmarshal_precompiled(self, view):
+        """Create a template from the contents of a precompiled file.
+        Raise ValueError if the header does not match.
+        @hidden
+        """
+        magic, format, marshal_version, length = PRECOMPILED_HEADER.unpack_from(view)
+        if (
+            magic != PRECOMPILED_MAGIC
+            or format != PRECOMPILED_FORMAT
+            or marshal_version != marshal.version
+        ):
+            raise ValueError("precompiled template of another format")
+
+        start = PRECOMPILED_HEADER.size
+        state = marshal.loads(view[start : start + length])
+        state["_tokens"] = None
+        precompiled = Template.__new__(Template)
+        precompiled.__setstate__(state)
+        precompiled.debug(self._debug)
+        if precompiled.is_uptodate(self.compile_params()):
+            precompiled._tokens = marshal.loads(view[start + length :])
+        return precompiled
+
     def save_precompiled(self, template):
         """Save compiled template to disk in precompiled form.
 
@@ -363,6 +652,11 @@ class TemplateManager:
         modification times of all included templates and version of the
         htmltmpl module which compiled the template.
 
+        The file starts with PRECOMPILED_HEADER, which holds the magic
+        string, the versions of the file format and of the marshal
+        format and the length of the metadata. The metadata and the
+        tuple of tokens follow, each serialized by marshal.
+
         The method removes a file which is saved only partially because
         of some error.
 
@@ -379,15 +673,27 @@ class TemplateManager:
         try:
             remove_bad = 0
             file = None
+            try:
+                state = template.__getstate__()
+                tokens = marshal.dumps(tuple(state.pop("_tokens")))
+                metadata = marshal.dumps(state)
+                header = PRECOMPILED_HEADER.pack(
+                    PRECOMPILED_MAGIC,
+                    PRECOMPILED_FORMAT,
+                    marshal.version,
+                    len(metadata),
+                )
+            except ValueError as error:
+                raise TemplateError(
+                    "Marshalling error while saving "
+                    "precompiled template '%s': %s" % (filename, error)
+                )
             try:
                 file = open(filename, "wb")  # may truncate existing file
                 self.lock_file(file, LOCK_EX)
-                BINARY = 1
-                READABLE = 0
-                if self._debug:
-                    pickle.dump(template, file, READABLE)
-                else:
-                    pickle.dump(template, file, BINARY)
+                file.write(header)
+                file.write(metadata)
+                file.write(tokens)
             except IOError as e:
                 errno, errstr = e.args
                 remove_bad = 1
@@ -395,12 +701,6 @@ class TemplateManager:
                     "IO error while saving precompiled "
                     "template '%s': (%d) %s" % (filename, errno, errstr)
                 )
-            except pickle.PicklingError as error:
-                remove_bad = 1
-                raise TemplateError(
-                    "Pickling error while saving "
-                    "precompiled template '%s': %s" % (filename, error)
-                )
             except:
                 remove_bad = 1
                 raise
@@ -486,6 +786,9 @@ class TemplateProcessor:
         as the 'value' parameter. This scalar will be automatically
         converted to string.
 
+        To assign a value that is produced piece by piece pass an
+        instance of <em>Chunks</em> as the 'value' parameter.
+
         To assign a value to a loop identifier pass a list of mappings as
         the 'value' parameter. The engine iterates over this list and
         assigns values from the mappings to variables in a template loop
@@ -503,7 +806,7 @@ class TemplateProcessor:
         """
         # The correctness of character case is verified only for top-level
         # variables.
-        if self.is_ordinary_var(value):
+        if self.is_ordinary_var(value) or isinstance(value, Chunks):
             # template top-level ordinary variable
             if not var.islower():
                 raise TemplateError("Invalid variable name '%s'." % var)
@@ -573,6 +876,11 @@ class TemplateProcessor:
         if part is not None and (part == 0 or part < self._current_part):
             raise TemplateError("process() - invalid part number")
 
+        # Whole templates are rendered by their compiled program. Parts
+        # and debugging output need the token interpreter below.
+        if part is None and not self._current_pos and not self._debug:
+            return self.render(template)
+
         # This flag means "jump behind the end of current statement" or
         # "skip the parameters of current statement".
         # Even parameters that actually are not present in the template
@@ -802,6 +1110,327 @@ class TemplateProcessor:
         if self._debug:
             print(str, file=sys.stderr)
 
+    def generate(self, template, pieces=STREAM_PIECES):
+        """Process a compiled template and yield the result in chunks.
+
+        This method is a generator that processes the whole template
+        like <em>process()</em> does. Instead of returning the result as
+        one string it yields it in chunks of about the given number of
+        pieces of output, so that the result can be sent while the rest
+        of the template is processed. The data of the processor must not
+        be changed before the generator is exhausted.
+
+        @header generate(template, pieces=STREAM_PIECES)
+        @return Generator of strings.
+
+        @param template A compiled template.
+
+        @param pieces Number of pieces of output in a chunk.
+        Each text between statements and each substituted variable
+        is a piece.
+        """
+        if self._current_pos or self._debug:
+            yield self.process(template)
+            return
+
+        key = (self._html_escape, self._magic_vars, self._global_vars)
+        block, boundaries = template.program(key, self.compile_program)
+
+        out = []
+        yield from stream_block(block, out, [self._vars], [], pieces)
+        chunk = "".join(out)
+        if chunk:
+            yield chunk
+        self._current_part += boundaries
+
+    def render(self, template):
+        """Process a whole template in a single pass of its program.
+        @hidden
+        """
+        key = (self._html_escape, self._magic_vars, self._global_vars)
+        block, boundaries = template.program(key, self.compile_program)
+
+        out = []
+        append = out.append
+        scopes = [self._vars]
+        passes = []
+        for node in block:
+            node(append, scopes, passes)
+
+        self._current_part += boundaries
+        return "".join(out)
+
+    def compile_program(self, tokens):
+        """Compile the tokens of a template into nested blocks of closures.
+
+        Each closure takes the append method of the output list, the
+        stack of scopes (the top-level variables followed by the current
+        row of each enclosing loop) and the stack of (pass, total) pairs
+        of the enclosing loops. Statement nesting and the lookup of each
+        variable are resolved here, so processing never rescans the
+        token list. Return the top-level block and the number of
+        boundaries.
+        @hidden
+        """
+        boundaries = [0]
+        block, _, end = self.compile_block(tokens, 0, 0, boundaries)
+        if end is not None:
+            raise TemplateError("Unmatched %s>." % end)
+        return block, boundaries[0]
+
+    def compile_block(self, tokens, i, depth, boundaries):
+        """Compile tokens from index i up to the end of the template or
+        up to a closing statement or TMPL_ELSE. Return the block, the
+        index behind the statement that ended it and the statement.
+        @hidden
+        """
+        block = []
+        text = []
+        len_tokens = len(tokens)
+        while i < len_tokens:
+            token = tokens[i]
+            if not (token.startswith("<TMPL_") or token.startswith("</TMPL_")):
+                # Adjacent text is written with a single append.
+                text.append(token)
+                i += 1
+                continue
+
+            if text:
+                block.append(self.compile_text("".join(text)))
+                text = []
+
+            var = tokens[i + PARAM_NAME]
+            escape = tokens[i + PARAM_ESCAPE]
+            globalp = tokens[i + PARAM_GLOBAL]
+            i += 1 + PARAMS_NUMBER
+
+            if token == "<TMPL_VAR":
+                if not var:
+                    raise TemplateError("No identifier in <TMPL_VAR>.")
+                block.append(self.compile_var(var, depth, escape, globalp))
+
+            elif token == "<TMPL_LOOP":
+                if not var:
+                    raise TemplateError("No identifier in <TMPL_LOOP>.")
+                body, i, end = self.compile_block(tokens, i, depth + 1, boundaries)
+                otherwise = ()
+                if end == "<TMPL_ELSE":
+                    otherwise, i, end = self.compile_block(tokens, i, depth, boundaries)
+                if end is None:
+                    raise TemplateError("Missing </TMPL_LOOP>.")
+                if end != "</TMPL_LOOP":
+                    raise TemplateError("Unmatched %s>." % end)
+                block.append(self.compile_loop(var, body, otherwise))
+
+            elif token == "<TMPL_IF" or token == "<TMPL_UNLESS":
+                if not var:
+                    raise TemplateError("No identifier in %s>." % token)
+                then, i, end = self.compile_block(tokens, i, depth, boundaries)
+                otherwise = ()
+                if end == "<TMPL_ELSE":
+                    otherwise, i, end = self.compile_block(tokens, i, depth, boundaries)
+                if end is None:
+                    raise TemplateError("Missing </TMPL_IF> or </TMPL_UNLESS>")
+                if end != "</TMPL_IF" and end != "</TMPL_UNLESS":
+                    raise TemplateError("Unmatched %s>." % end)
+                if token == "<TMPL_UNLESS":
+                    then, otherwise = otherwise, then
+                block.append(
+                    self.compile_if(
+                        self.compile_lookup(var, depth, globalp), then, otherwise
+                    )
+                )
+
+            elif token in ("</TMPL_LOOP", "</TMPL_IF", "</TMPL_UNLESS", "<TMPL_ELSE"):
+                return tuple(block), i, token
+
+            elif token == "<TMPL_BOUNDARY":
+                boundaries[0] += 1
+
+            elif token == "<TMPL_INCLUDE":
+                # TMPL_INCLUDE is left in the compiled template only
+                # when it was not replaced by the parser.
+                block.append(
+                    self.compile_text(
+                        """
+                        <br />
+                        <p>
+                        <strong>HTMLTMPL WARNING:</strong><br />
+                        Cannot include template: <strong>%s</strong>
+                        </p>
+                        <br />
+                    """
+                        % var
+                    )
+                )
+
+            elif token == "<TMPL_GETTEXT":
+                block.append(self.compile_gettext(tokens[i - PARAMS_NUMBER]))
+
+            else:
+                # Unknown processing directive.
+                raise TemplateError("Invalid statement %s>." % token)
+
+        if text:
+            block.append(self.compile_text("".join(text)))
+        return tuple(block), i, None
+
+    def compile_text(self, text):
+        """@hidden"""
+
+        def node(append, scopes, passes):
+            append(text)
+
+        return node
+
+    def compile_gettext(self, text):
+        """@hidden"""
+
+        def node(append, scopes, passes):
+            append(gettext.gettext(text))
+
+        return node
+
+    def compile_var(self, var, depth, escape, globalp):
+        """@hidden"""
+        get = self.compile_lookup(var, depth, globalp)
+        escape = self.compile_escape(escape)
+        if escape is None:
+
+            def node(append, scopes, passes):
+                append(str(get(scopes, passes)))
+
+        else:
+            # Integers such as ports and byte counts never need escaping.
+            def node(append, scopes, passes):
+                value = get(scopes, passes)
+                if value.__class__ is int:
+                    append(str(value))
+                else:
+                    append(escape(str(value)))
+
+        if not depth:
+            # Only top-level variables can be streamed.
+            def stream(out, scopes, passes, pieces):
+                value = get(scopes, passes)
+                if not isinstance(value, Chunks):
+                    node(out.append, scopes, passes)
+                    return
+                # Each piece of the value ends a chunk.
+                for piece in value:
+                    piece = str(piece)
+                    out.append(piece if escape is None else escape(piece))
+                    chunk = "".join(out)
+                    out.clear()
+                    if chunk:
+                        yield chunk
+
+            node.stream = stream
+
+        return node
+
+    def compile_loop(self, var, body, otherwise):
+        """@hidden"""
+
+        def node(append, scopes, passes):
+            rows = scopes[-1].get(var)
+            if not rows or not isinstance(rows, list):
+                for child in otherwise:
+                    child(append, scopes, passes)
+                return
+
+            total = len(rows)
+            for loop_pass, row in enumerate(rows):
+                scopes.append(row)
+                passes.append((loop_pass, total))
+                for child in body:
+                    child(append, scopes, passes)
+                scopes.pop()
+                passes.pop()
+
+        def stream(out, scopes, passes, pieces):
+            rows = scopes[-1].get(var)
+            if not rows or not isinstance(rows, list):
+                yield from stream_block(otherwise, out, scopes, passes, pieces)
+                return
+
+            total = len(rows)
+            for loop_pass, row in enumerate(rows):
+                scopes.append(row)
+                passes.append((loop_pass, total))
+                yield from stream_block(body, out, scopes, passes, pieces)
+                scopes.pop()
+                passes.pop()
+
+        node.stream = stream
+        return node
+
+    def compile_if(self, get, then, otherwise):
+        """@hidden"""
+
+        def node(append, scopes, passes):
+            for child in then if get(scopes, passes) else otherwise:
+                child(append, scopes, passes)
+
+        def stream(out, scopes, passes, pieces):
+            block = then if get(scopes, passes) else otherwise
+            yield from stream_block(block, out, scopes, passes, pieces)
+
+        node.stream = stream
+        return node
+
+    def compile_lookup(self, var, depth, global_override):
+        """Return a function that finds the value of var in a block
+        nested in depth loops. This is the compiled form of find_value().
+        @hidden
+        """
+        if self._magic_vars and var.startswith("__") and depth:
+
+            def get(scopes, passes):
+                return magic_value(var, *passes[-1])
+
+            return get
+
+        default = 0 if var[0].isupper() else ""
+        is_ordinary_var = self.is_ordinary_var
+
+        if depth and (
+            (self._global_vars and global_override != "0") or global_override == "1"
+        ):
+
+            def get(scopes, passes):
+                scope = scopes[-1]
+                if var not in scope:
+                    # Look up the innermost enclosing scope.
+                    for scope in reversed(scopes[:-1]):
+                        if var in scope and is_ordinary_var(scope[var]):
+                            return scope[var]
+                    return default
+                value = scope[var]
+                return len(value) if isinstance(value, list) else value
+
+            return get
+
+        def get(scopes, passes):
+            value = scopes[-1].get(var, default)
+            return len(value) if isinstance(value, list) else value
+
+        return get
+
+    def compile_escape(self, override):
+        """Return the escaping function for a variable or None.
+        @hidden
+        """
+        if (self._html_escape and override not in ("NONE", "0", "URL")) or override in (
+            "HTML",
+            "1",
+        ):
+            return escape_html
+        elif override == "URL":
+            return escape_url
+        else:
+            return None
+
     def find_value(self, var, loop_name, loop_pass, loop_total, global_override=None):
         """Search the self._vars data structure to find variable var
         located in currently processed pass of a loop which
@@ -874,66 +1503,12 @@ class TemplateProcessor:
         @hidden
         """
         self.DEB("MAGIC: '%s', PASS: %d, TOTAL: %d" % (var, loop_pass, loop_total))
-        if var == "__FIRST__":
-            if loop_pass == 0:
-                return 1
-            else:
-                return 0
-        elif var == "__LAST__":
-            if loop_pass == loop_total - 1:
-                return 1
-            else:
-                return 0
-        elif var == "__INNER__":
-            # If this is neither the first nor the last pass.
-            if loop_pass != 0 and loop_pass != loop_total - 1:
-                return 1
-            else:
-                return 0
-        elif var == "__PASS__":
-            # Magic variable __PASS__ counts passes from one.
-            return loop_pass + 1
-        elif var == "__PASSTOTAL__":
-            return loop_total
-        elif var == "__ODD__":
-            # Internally pass numbers stored in loop_pass are counted from
-            # zero. But the template language presents them counted from one.
-            # Therefore we must add one to the actual loop_pass value to get
-            # the value we present to the user.
-            if (loop_pass + 1) % 2 != 0:
-                return 1
-            else:
-                return 0
-        elif var.startswith("__EVERY__"):
-            # Magic variable __EVERY__x is never true in first or last pass.
-            if loop_pass != 0 and loop_pass != loop_total - 1:
-                # Check if an integer follows the variable name.
-                try:
-                    every = int(var[9:])  # nine is length of "__EVERY__"
-                except ValueError:
-                    raise TemplateError(
-                        "Magic variable __EVERY__x: Invalid pass number."
-                    )
-                else:
-                    if not every:
-                        raise TemplateError(
-                            "Magic variable __EVERY__x: Pass number cannot be zero."
-                        )
-                    elif (loop_pass + 1) % every == 0:
-                        self.DEB("MAGIC: EVERY: " + str(every))
-                        return 1
-                    else:
-                        return 0
-            else:
-                return 0
-        else:
-            raise TemplateError("Invalid magic variable '%s'." % var)
+        return magic_value(var, loop_pass, loop_total)
 
     def escape(self, str, override=""):
         """Escape a string either by HTML escaping or by URL escaping.
         @hidden
         """
-        ESCAPE_QUOTES = 1
         if (
             (
                 self._html_escape
@@ -944,9 +1519,9 @@ class TemplateProcessor:
             or override == "HTML"
             or override == "1"
         ):
-            return html.escape(str, quote=bool(ESCAPE_QUOTES))
+            return escape_html(str)
         elif override == "URL":
-            return urllib.quote_plus(str)
+            return escape_url(str)
         else:
             return str
 
@@ -1356,8 +1931,8 @@ class Template:
     """This class represents a compiled template.
 
     This class provides storage and methods for the compiled template
-    and associated metadata. It's serialized by pickle if we need to
-    save the compiled template to disk in a precompiled form.
+    and associated metadata. Its state is serialized by marshal if we
+    need to save the compiled template to disk in a precompiled form.
 
     You should never instantiate this class directly. Always use the
     <em>TemplateManager</em> or <em>TemplateCompiler</em> classes to
@@ -1378,6 +1953,7 @@ class Template:
         self._debug = debug
         self._mtime = None
         self._include_mtimes = {}
+        self._programs = {}
 
         if not file:
             self.DEB("TEMPLATE WAS COMPILED FROM A STRING")
@@ -1456,6 +2032,17 @@ class Template:
         """
         return self._tokens
 
+    def program(self, key, compile):
+        """Get the program compiled from the tokens for the processor
+        settings in key. Programs are compiled once and are not saved
+        with precompiled templates.
+        @hidden
+        """
+        program = self._programs.get(key)
+        if program is None:
+            program = self._programs[key] = compile(self._tokens)
+        return program
+
     def file(self):
         """Get filename of the main file of this template.
         @hidden
@@ -1473,20 +2060,22 @@ class Template:
     ##############################################
 
     def __getstate__(self):
-        """Used by pickle when the class is serialized.
+        """Used by pickle and save_precompiled() when the class is serialized.
         Remove the 'debug' attribute before serialization.
         @hidden
         """
         dict = copy.copy(self.__dict__)
         del dict["_debug"]
+        dict.pop("_programs", None)
         return dict
 
     def __setstate__(self, dict):
-        """Used by pickle when the class is unserialized.
+        """Used by pickle and load_precompiled() when the class is unserialized.
         Add the 'debug' attribute.
         @hidden
         """
         dict["_debug"] = 0
+        dict["_programs"] = {}
         self.__dict__ = dict
 
     def DEB(self, str):
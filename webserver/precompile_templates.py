@@ -21,22 +21,17 @@ def precompile_templates(htdocs_dir):
     mgr = TemplateManager(precompile=True)
 
     # Only compile top-level templates - they will pull in includes
-    count = 0
-    errors = 0
-    for filename in os.listdir(templates_dir):
-        if filename.endswith(".tmpl"):
-            filepath = os.path.join(templates_dir, filename)
-            try:
-                # Loading the template will trigger precompilation
-                mgr.prepare(filepath)
-                print(f"Precompiled: {filepath}")
-                count += 1
-            except Exception as e:
-                print(f"Warning: Could not precompile {filepath}: {e}", file=sys.stderr)
-                errors += 1
-
-    print(f"Precompiled {count} templates ({errors} errors)")
-    return 0
+    files = sorted(
+        os.path.join(templates_dir, filename)
+        for filename in os.listdir(templates_dir)
+        if filename.endswith(".tmpl")
+    )
+    failed = mgr.precompile_all(files)
+    for filepath, error in failed:
+        print(f"Error: Could not precompile {filepath}: {error}", file=sys.stderr)
+
+    print(f"Precompiled {len(files) - len(failed)} templates ({len(failed)} errors)")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -6,14 +6,100 @@
 
 import sys
 import os
+import ast
+import collections
+import email.utils
+import http.client
 import http.server
 import io
 import posixpath
 import urllib.parse
 import time
 
+import api
+
 __version__ = "0.1"
 
+# Files up to this size are kept in memory, larger ones are sent by Honeyd
+SENDFILE_THRESHOLD = 64 * 1024
+
+# Upper bound for the memory used by cached files
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+
+class StaticCache:
+    """Keeps the contents of small static files in memory.
+
+    Entries are keyed by path and revalidated against the modification
+    time and size of the file.  Once the cache holds more than max_bytes,
+    the least recently used files are evicted."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, path, st):
+        """Returns the contents of path, which has been stat'ed as st."""
+        key = (st.st_mtime_ns, st.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == key:
+            self.entries.move_to_end(path)
+            return entry[1]
+
+        with open(path, "rb") as f:
+            data = f.read()
+        self.put(path, key, data)
+        return data
+
+    def put(self, path, key, data):
+        old = self.entries.pop(path, None)
+        if old is not None:
+            self.size -= len(old[1])
+        if len(data) > self.max_bytes:
+            return
+
+        self.entries[path] = (key, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, old_data) = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+
+
+class ScriptCache:
+    """Keeps compiled Python pages, revalidated against their mtime.
+
+    A page that defines handle(request) is executed once when it is
+    loaded and then called for every request; its globals persist
+    between requests.  Other pages are executed from the cached code
+    object with request in their globals."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, path):
+        """Returns (code, handle) for path; handle may be None."""
+        mtime = os.stat(path).st_mtime_ns
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1], entry[2]
+
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        code = compile(tree, path, "exec")
+
+        handle = None
+        if any(
+            isinstance(node, ast.FunctionDef) and node.name == "handle"
+            for node in tree.body
+        ):
+            namespace = {"__name__": "__main__", "__file__": path}
+            exec(code, namespace)
+            handle = namespace["handle"]
+
+        self.entries[path] = (mtime, code, handle)
+        return code, handle
+
 
 class HoneydServer:
     """Base Honeyd Web Server."""
@@ -21,10 +107,21 @@ class HoneydServer:
     def __init__(self, RequestHandlerClass, root):
         self.root = root
         self.RequestHandlerClass = RequestHandlerClass
+        self.static_cache = StaticCache()
+        self.script_cache = ScriptCache()
+
+    def handle_request(self, request, client_address, keep_alive=False):
+        """Handle one request, possibly blocking.
 
-    def handle_request(self, request, client_address):
-        """Handle one request, possibly blocking."""
+        Honeyd passes exactly one request at a time, parsed into a
+        dictionary with method, path, version, headers and body.
+        keep_alive is False if Honeyd is going to close the connection
+        after this request."""
 
+        self.keep_alive = keep_alive
+        self.close_connection = True
+        self.sendfile = None
+        self.stream = None
         if self.verify_request(request, client_address):
             self.finish_request(request, client_address)
             self.close_request(request)
@@ -47,25 +144,108 @@ class HoneydRequestHandler(http.server.SimpleHTTPRequestHandler):
 
     server_version = "HoneydHTTP/" + __version__
 
+    # Keeps connections open; every response needs a Content-Length
+    protocol_version = "HTTP/1.1"
+
     def __init__(self, request, client_address, server):
         self.request = request
         self.client_address = client_address
         self.server = server
         self.root = server.root
+        self.defer_headers = False
+        self.sent_length = False
+        self.chunks = None
 
         self.setup()
-        self.handle()
+        if isinstance(request, dict):
+            self.handle_parsed(request)
+        else:
+            self.handle_one_request()
         self.finish()
 
+    def handle_parsed(self, request):
+        """Handles a request that Honeyd has parsed already."""
+        self.command = request["method"]
+        self.path = request["path"]
+        self.request_version = request["version"]
+        self.requestline = f"{self.command} {self.path} {self.request_version}"
+
+        self.headers = http.client.HTTPMessage()
+        for name, value in request["headers"]:
+            self.headers[name] = value
+
+        if self.request_version not in ("HTTP/1.0", "HTTP/1.1"):
+            self.close_connection = True
+            self.send_error(505, f"Invalid HTTP version ({self.request_version})")
+            return
+
+        self.close_connection = self.request_version == "HTTP/1.0"
+        conntype = self.headers.get("Connection", "").lower()
+        if conntype == "close":
+            self.close_connection = True
+        elif conntype == "keep-alive":
+            self.close_connection = False
+
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(501, f"Unsupported method ({self.command!r})")
+            return
+        method()
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        if not self.server.keep_alive:
+            self.send_header("Connection", "close")
+        elif not self.close_connection and self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "content-length":
+            self.sent_length = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        # Headers of scripts are sent once we know the length of the page
+        if not self.defer_headers:
+            super().end_headers()
+
+    def send_stream(self, chunks):
+        """Sends the str or bytes in chunks as the body of the response
+        after anything written to wfile.  Honeyd asks for the next chunk
+        whenever the client has read the previous ones; HTTP/1.1 clients
+        get them with chunked transfer encoding.  Only for Python pages."""
+        self.chunks = chunks
+
+    def chunked(self, head, chunks):
+        """Frames head and chunks for chunked transfer encoding."""
+        if head:
+            yield b"%x\r\n%s\r\n" % (len(head), head)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                yield b"%x\r\n%s\r\n" % (len(chunk), chunk)
+        yield b"0\r\n\r\n"
+
+    def do_POST(self):
+        """Serve a POST request; only Python pages accept one.  The body
+        can be read from rfile."""
+
+        if not self.is_python():
+            self.send_error(405, "Method not allowed")
+            return
+        self.run_python()
+
     def send_head(self):
         """Serve a GET request."""
 
+        if self.is_api():
+            return api.handle(self)
         if self.is_python():
             return self.run_python()
 
         # Regular file
         path = self.translate_path(self.path)
-        f = None
         if os.path.isdir(path):
             for index in "index.html", "index.htm":
                 index = os.path.join(path, index)
@@ -75,22 +255,69 @@ class HoneydRequestHandler(http.server.SimpleHTTPRequestHandler):
             else:
                 return self.list_directory(path)
         ctype = self.guess_type(path)
-        if ctype.startswith("text/"):
-            mode = "r"
-        else:
-            mode = "rb"
+
+        # Large files are handed to Honeyd, which sends them on its own
         try:
-            f = open(path, mode)
+            if os.path.getsize(path) > SENDFILE_THRESHOLD:
+                fd = os.open(path, os.O_RDONLY)
+                st = os.fstat(fd)
+            else:
+                fd = None
+                st = os.stat(path)
         except OSError:
             self.send_error(404, "File not found")
             return None
+
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        if self.not_modified(etag, st.st_mtime):
+            if fd is not None:
+                os.close(fd)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        if fd is None:
+            try:
+                data = self.server.static_cache.get(path, st)
+            except OSError:
+                self.send_error(404, "File not found")
+                return None
+            length = len(data)
+        else:
+            length = st.st_size
+
         self.send_response(200)
         self.send_header("Content-type", ctype)
-        sb = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(sb[6]))
-        self.send_header("Last-Modified", self.date_time_string(sb[8]))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+        self.send_header("ETag", etag)
         self.end_headers()
-        return f
+
+        if fd is None:
+            if self.command != "HEAD":
+                self.wfile.write(data)
+        elif self.command != "HEAD":
+            self.server.sendfile = (fd, length)
+        else:
+            os.close(fd)
+        return None
+
+    def not_modified(self, etag, mtime):
+        """Checks the conditional headers of a GET request."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return etag in tags or "*" in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        return int(mtime) <= since.timestamp()
 
     def date_time_string(self, now=0):
         """Return the current date and time formatted for a message header."""
@@ -108,6 +335,11 @@ class HoneydRequestHandler(http.server.SimpleHTTPRequestHandler):
         )
         return s
 
+    def is_api(self):
+        """Determines if the request is for the machine readable views."""
+        path = self.path.partition("?")[0]
+        return path == "/api" or path.startswith("/api/")
+
     def is_python(self):
         """Determines if the request is for a python script."""
         path = self.translate_path(self.path)
@@ -118,27 +350,82 @@ class HoneydRequestHandler(http.server.SimpleHTTPRequestHandler):
         return tail.lower() in (".py", ".pyw")
 
     def run_python(self):
-        path = self.translate_path(self.path)
-        head, tail = os.path.split(path)
-
-        i = tail.rfind("?")
-        if i >= 0:
-            tail, query = tail[:i], tail[i + 1 :]
-            entries = query.split("&")
-            self.query = {}
-            for entry in entries:
-                kv = entry.split("=")
-                self.query[kv[0]] = "=".join(kv[1:])
+        path, _, query = self.path.partition("?")
+        scriptname = self.translate_path(path)
+
+        # Repeated parameters keep their last value
+        if query:
+            self.query = {
+                key: values[-1]
+                for key, values in urllib.parse.parse_qs(
+                    query, keep_blank_values=True
+                ).items()
+            }
         else:
             self.query = None
 
-        scriptname = head + "/" + tail
-        if not os.path.exists(scriptname):
+        try:
+            code, handle = self.server.script_cache.get(scriptname)
+        except OSError:
             self.send_error(404, "File not found")
             return
 
-        with open(scriptname) as f:
-            exec(f.read(), {"__name__": "__main__", "__file__": scriptname, "request": self})
+        # Buffer the page so that we can send a Content-Length
+        wfile, self.wfile = self.wfile, io.BytesIO()
+        self.defer_headers = True
+        self.sent_length = False
+        try:
+            if handle is not None:
+                handle(self)
+            else:
+                exec(
+                    code,
+                    {"__name__": "__main__", "__file__": scriptname, "request": self},
+                )
+        finally:
+            body, self.wfile = self.wfile.getvalue(), wfile
+            self.defer_headers = False
+
+        self.send_page(body)
+
+    def send_page(self, body):
+        """Ends the headers and sends body, followed by the chunks given
+        to send_stream().  Adds a Content-Length unless the page is sent
+        in chunks or the headers have one already."""
+        if self.chunks is not None and self.command == "HEAD":
+            # Only the headers; the page is not rendered to count its length
+            close = getattr(self.chunks, "close", None)
+            if close is not None:
+                close()
+            self.chunks = None
+            if getattr(self, "_headers_buffer", None):
+                self.end_headers()
+            return
+
+        if self.chunks is not None:
+            if (
+                self.request_version == "HTTP/1.1"
+                and not self.sent_length
+                and getattr(self, "_headers_buffer", None)
+            ):
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.server.stream = self.chunked(body, self.chunks)
+                return
+
+            # Clients that do not know chunks get the page in one piece
+            body += b"".join(
+                chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                for chunk in self.chunks
+            )
+
+        if getattr(self, "_headers_buffer", None):
+            if not self.sent_length:
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+        # HEAD gets the headers, including the length, but no body
+        if self.command != "HEAD":
+            self.wfile.write(body)
 
     def log_message(self, format, *args):
         """Logs a message to Honeyd via syslog."""
@@ -157,9 +444,12 @@ class HoneydRequestHandler(http.server.SimpleHTTPRequestHandler):
         return self.client_address
 
     def setup(self):
-        self.rfile = io.BytesIO(
-            self.request.encode() if isinstance(self.request, str) else self.request
-        )
+        if isinstance(self.request, dict):
+            self.rfile = io.BytesIO(self.request["body"])
+        else:
+            self.rfile = io.BytesIO(
+                self.request.encode() if isinstance(self.request, str) else self.request
+            )
         self.wfile = io.BytesIO()
 
     def translate_path(self, path):
@@ -197,26 +487,36 @@ class HoneydRequestHandler(http.server.SimpleHTTPRequestHandler):
 
     def finish(self):
         self.server.result = self.wfile.getvalue()
+        self.server.close_connection = (
+            self.close_connection or not self.server.keep_alive
+        )
 
 
 def make_server(root):
     return HoneydServer(HoneydRequestHandler, root)
 
 
-def handle_request(server, request, client_address):
-    server.handle_request(request, client_address)
-    return server.result
+def handle_request(server, request, client_address, keep_alive=False):
+    """Returns the response, whether the connection can stay open and
+    what Honeyd sends after the response: None, the (fd, length) pair of
+    a file or an iterator of bytes that is read as the client keeps up."""
+    server.handle_request(request, client_address, keep_alive)
+    if server.stream is not None:
+        return server.result, not server.close_connection, server.stream
+    return server.result, not server.close_connection, server.sendfile
 
 
-def test():
-    request = "GET / HTTP/1.0\r\n\r\n"
-    server = HoneydServer(HoneydRequestHandler)
-    server.handle_request(request, "127.0.0.1")
-    print(server.result)
+def test(root=None):
+    """Serves a few requests from root, by default the htdocs next to
+    this file, and prints the responses.  The pages need the honeyd
+    module."""
+    if root is None:
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "htdocs")
+    server = make_server(root)
 
-    request = "GET /test.py HTTP/1.0\r\n\r\n"
-    server.handle_request(request, "127.0.0.1")
-    print(server.result)
+    for request in ("GET / HTTP/1.0\r\n\r\n", "GET /test.py HTTP/1.0\r\n\r\n"):
+        result, _, _ = handle_request(server, request, "127.0.0.1")
+        print(result.decode("utf-8", "replace"))
 
 
 if __name__ == "__main__":
@@ -1,13 +1,13 @@
 import honeyd
+import sys
 import urllib.parse
-import html
-from htmltmpl import TemplateManager, TemplateProcessor
+from htmltmpl import TemplateManager, TemplateProcessor, escape_html
 
 
 def quote(data):
     """Escapes a string so that it can safely be displayed
     in an HTML document"""
-    return html.escape(data, quote=True)
+    return escape_html(data)
 
 
 def parse_query(query):
@@ -158,6 +158,7 @@ def interface_table():
 
 
 def config_ips(root):
+    """Returns the table of bound addresses as a generator of chunks."""
     ips = honeyd.config_ips()
 
     template = TemplateManager().prepare(root + "/templates/config_ip.tmpl")
@@ -171,20 +172,81 @@ def config_ips(root):
     )
     tproc.set("Ips", ips)
 
-    content = tproc.process(template)
+    return tproc.generate(template)
+
+
+# Number of connections shown on one page of the status table
+CONNECTIONS_PER_PAGE = 50
+
+# Larger page numbers are clamped, so that offsets fit into Py_ssize_t
+MAX_CONNECTION_PAGE = sys.maxsize // CONNECTIONS_PER_PAGE - 1
+
+CONNECTION_COLUMNS = ("src", "sport", "dst", "dport", "received", "sent")
 
-    return content
 
+def connection_query(query, which):
+    """Extracts the filter, sort order and page of a connection table
+    from the query string.  All parameters are prefixed with the
+    protocol, so that the TCP and UDP tables can be browsed separately."""
+    if not query:
+        query = {}
+
+    def get(name):
+        return query.get("%s_%s" % (which, name), "").strip()
+
+    params = {}
+    for name in ("src", "dst", "sort"):
+        if get(name):
+            params[name] = get(name)
+    if get("port").isdigit() and int(get("port")) <= 65535:
+        params["port"] = int(get("port"))
+    if get("page").isdigit():
+        params["page"] = min(int(get("page")), MAX_CONNECTION_PAGE)
+    if params.get("sort", "").lstrip("-") not in CONNECTION_COLUMNS:
+        params.pop("sort", None)
+    return params
+
+
+def connection_link(which, params, **changes):
+    """Returns the URL of the connection table with some parameters
+    changed."""
+    params = dict(params, **changes)
+    query = [
+        ("%s_%s" % (which, name), value)
+        for name, value in sorted(params.items())
+        if value not in (None, "", 0)
+    ]
+    return quote("/index.py?" + urllib.parse.urlencode(query))
+
+
+def status_connections(root, which, query=None):
+    which = which.lower()
+    params = connection_query(query, which)
+    page = params.get("page", 0)
+
+    try:
+        result = honeyd.query_connections(
+            which,
+            offset=page * CONNECTIONS_PER_PAGE,
+            limit=CONNECTIONS_PER_PAGE,
+            src=params.get("src"),
+            dst=params.get("dst"),
+            port=params.get("port", 0),
+            sort=params.get("sort"),
+        )
+    except ValueError as e:
+        return "Bad %s connection filter: %s" % (which.upper(), quote(str(e)))
 
-def status_connections(root, which):
-    connections = honeyd.status_connections(which.lower())
+    total = result["total"]
+    connections = result["connections"]
+    filtered = any(name in params for name in ("src", "dst", "port"))
 
-    if not len(connections):
+    if not total and not filtered:
         return "There are currently no active %s connections." % which.upper()
 
     for connection in connections:
         id = "%s,%s,%d,%s,%d" % (
-            which.lower(),
+            which,
             connection["src"],
             connection["sport"],
             connection["dst"],
@@ -202,6 +264,26 @@ def status_connections(root, which):
     )
     tproc.set("Connections", connections)
 
+    # Filter form and sortable column headers
+    tproc.set("proto", which)
+    for name in ("src", "dst", "port", "sort"):
+        tproc.set("filter_" + name, quote(str(params.get(name, ""))))
+    for column in CONNECTION_COLUMNS:
+        order = "-" + column if params.get("sort") == column else column
+        tproc.set("sort_" + column, connection_link(which, params, sort=order, page=0))
+
+    # Pagination
+    first = page * CONNECTIONS_PER_PAGE
+    tproc.set(
+        "shown",
+        "Showing %d-%d of %d"
+        % (min(first + 1, total), first + len(connections), total),
+    )
+    if page > 0:
+        tproc.set("previous", connection_link(which, params, page=page - 1))
+    if first + len(connections) < total:
+        tproc.set("next", connection_link(which, params, page=page + 1))
+
     content = tproc.process(template)
 
     return content